@@ -17,15 +17,29 @@ SUBSCRIPTION_FREQUENCY = [
     "yearly"
 ]
 
+# Quota units granted by each subscription plan. The plan_catalog table is
+# seeded with these, and app.services.plans falls back to them until the
+# catalog has been loaded.
+QUOTA_LIMITS = {
+    "light": 2000,
+    "standard": 5000,
+    "pro": 12000,
+    "free": 100
+}
+
 class UserSubscription(models.Model):
     id = fields.IntField(pk=True)
-    user = fields.CharField(max_length=255)
+    # One subscription row per user, so writes can upsert on it
+    user = fields.CharField(max_length=255, unique=True)
     subscription_plan = fields.CharField(max_length=10, choices=SUBSCRIPTION_TYPES)
     subscription_frequency = fields.CharField(max_length=7, choices=SUBSCRIPTION_FREQUENCY)
     start_date = fields.DatetimeField(auto_now_add=True)
     end_date = fields.DatetimeField(null=True)
-    stripe_subscription_id = fields.CharField(max_length=255, null=True)
+    stripe_subscription_id = fields.CharField(max_length=255, null=True, index=True)
+    # Amount billed per period, in dollars
+    price = fields.DecimalField(max_digits=10, decimal_places=2, null=True)
     is_active = fields.BooleanField(default=True)
+    updated_at = fields.DatetimeField(auto_now=True, index=True)
 
     def __str__(self):
         return f"{self.subscription_plan}"
@@ -60,11 +74,17 @@ UserSubscriptionIn_Pydantic = pydantic_model_creator(
 
 class Quota(models.Model):
     id = fields.IntField(pk=True)
-    user = fields.CharField(max_length=255)
+    user = fields.CharField(max_length=255, unique=True)
     total = fields.IntField()
+    # Units used up to the checkpoint; ledger rows from transactions at or
+    # after checkpoint_txid are summed from the usage_event ledger
     used = fields.IntField()
+    # Units held by open reservations (see app.services.reservations)
+    reserved = fields.IntField(default=0)
+    checkpoint_at = fields.DatetimeField(auto_now_add=True)
+    checkpoint_txid = fields.BigIntField(default=0)
     created_at = fields.DatetimeField(auto_now_add=True)
-    updated_at = fields.DatetimeField(auto_now=True)
+    updated_at = fields.DatetimeField(auto_now=True, index=True)
 
     def __str__(self):
         return f"{self.user}"
@@ -80,5 +100,133 @@ class Quota(models.Model):
     @property
     async def is_empty(self):
         return self.used == 0
-    
-    
+
+
+# Units of a user's quota held for a long-running job until committed,
+# released or expired
+class QuotaReservation(models.Model):
+    id = fields.UUIDField(pk=True)
+    user = fields.CharField(max_length=255, index=True)
+    feature = fields.CharField(max_length=50)
+    units = fields.IntField()
+    expires_at = fields.DatetimeField(index=True)
+    created_at = fields.DatetimeField(auto_now_add=True)
+
+    class Meta:
+        table = "quota_reservation"
+
+    def __str__(self):
+        return str(self.id)
+
+
+# Open Stripe Checkout Session, reused while it is unexpired
+class CheckoutSession(models.Model):
+    id = fields.IntField(pk=True)
+    user = fields.CharField(max_length=255)
+    subscription_plan = fields.CharField(max_length=10, choices=SUBSCRIPTION_TYPES)
+    subscription_frequency = fields.CharField(max_length=7, choices=SUBSCRIPTION_FREQUENCY)
+    session_id = fields.CharField(max_length=255)
+    url = fields.TextField()
+    expires_at = fields.DatetimeField(index=True)
+    created_at = fields.DatetimeField(auto_now_add=True)
+
+    class Meta:
+        table = "checkout_session"
+        unique_together = (("user", "subscription_plan", "subscription_frequency"),)
+
+    def __str__(self):
+        return self.session_id
+
+
+# Plans on sale, served from memory by app.services.plans
+class PlanCatalog(models.Model):
+    id = fields.IntField(pk=True)
+    plan = fields.CharField(max_length=10, choices=SUBSCRIPTION_TYPES)
+    frequency = fields.CharField(max_length=7, choices=SUBSCRIPTION_FREQUENCY)
+    stripe_price_id = fields.CharField(max_length=255, null=True)
+    quota = fields.IntField()
+    # Names of the features the plan unlocks
+    features = fields.JSONField(default=list)
+    updated_at = fields.DatetimeField(auto_now=True)
+
+    class Meta:
+        table = "plan_catalog"
+        unique_together = (("plan", "frequency"),)
+
+    def __str__(self):
+        return f"{self.plan} {self.frequency}"
+
+
+# Progress markers of background sync jobs, e.g. the Stripe reconciliation
+class SyncState(models.Model):
+    key = fields.CharField(max_length=100, pk=True)
+    value = fields.TextField()
+    updated_at = fields.DatetimeField(auto_now=True)
+
+    class Meta:
+        table = "sync_state"
+
+    def __str__(self):
+        return self.key
+
+
+# Stored response of a POST sent with an Idempotency-Key header, see
+# app.services.idempotency. A row without a status is a claim held by the
+# request still running.
+class IdempotencyRecord(models.Model):
+    # sha256 of the method, path and Idempotency-Key
+    key = fields.CharField(max_length=64, pk=True)
+    # sha256 of the request body, so a key reused for another request is refused
+    request_hash = fields.CharField(max_length=64)
+    status = fields.IntField(null=True)
+    headers = fields.JSONField(null=True)
+    body = fields.BinaryField(null=True)
+    expires_at = fields.DatetimeField(index=True)
+    created_at = fields.DatetimeField(auto_now_add=True)
+
+    class Meta:
+        table = "idempotency_record"
+
+    def __str__(self):
+        return self.key
+
+
+# Counts of users and subscribers kept current by triggers, see
+# app.services.stats. Each counter is spread over a few slots so
+# concurrent writers rarely update the same row.
+class StatCounter(models.Model):
+    id = fields.IntField(pk=True)
+    name = fields.CharField(max_length=100)
+    slot = fields.SmallIntField(default=0)
+    value = fields.BigIntField(default=0)
+
+    class Meta:
+        table = "stat_counter"
+        unique_together = (("name", "slot"),)
+
+    def __str__(self):
+        return self.name
+
+
+# Units used per user and day, rolled up from the usage_event ledger
+class UsageDailyUser(models.Model):
+    id = fields.IntField(pk=True)
+    day = fields.DateField()
+    user = fields.CharField(max_length=255, index=True)
+    units = fields.BigIntField(default=0)
+
+    class Meta:
+        table = "usage_daily_user"
+        unique_together = (("day", "user"),)
+
+
+# Units used per plan and day, rolled up from the usage_event ledger
+class UsageDailyPlan(models.Model):
+    id = fields.IntField(pk=True)
+    day = fields.DateField()
+    plan = fields.CharField(max_length=10)
+    units = fields.BigIntField(default=0)
+
+    class Meta:
+        table = "usage_daily_plan"
+        unique_together = (("day", "plan"),)
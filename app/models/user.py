@@ -15,6 +15,8 @@ class User(models.Model):
     is_superuser = fields.BooleanField(default=False)
     created_at = fields.DatetimeField(auto_now_add=True)
     updated_at = fields.DatetimeField(auto_now=True)
+    # Set when the account is deleted; the purger removes the row later
+    deleted_at = fields.DatetimeField(null=True)
 
     class Meta:
         table = "users"
@@ -74,6 +76,57 @@ class OTPVerify(BaseModel):
     )
 
 
+# Login model
+class LoginRequest(BaseModel):
+    email: EmailStr
+    password: constr(min_length=1, max_length=50)
+
+    model_config = ConfigDict(
+        json_schema_extra={
+            "example": {
+                "email": "user@example.com",
+                "password": "SecurePass123!"
+            }
+        }
+    )
+
+
+# Token refresh model
+class TokenRefresh(BaseModel):
+    refresh_token: str
+
+
+class RevokedToken(models.Model):
+    id = fields.IntField(pk=True)
+    jti = fields.CharField(max_length=64, unique=True)
+    expires_at = fields.DatetimeField(index=True)
+    created_at = fields.DatetimeField(auto_now_add=True, index=True)
+
+    class Meta:
+        table = "revoked_token"
+
+    def __str__(self):
+        return self.jti
+
+
+# Every email and username taken on any shard. It lives on the default
+# connection only, so its unique indexes keep emails and usernames unique
+# across all shards. A row without a user_id is a claim whose user is
+# still being created.
+class UserDirectory(models.Model):
+    id = fields.IntField(pk=True)
+    email = fields.CharField(max_length=255, unique=True)
+    username = fields.CharField(max_length=255, unique=True)
+    user_id = fields.IntField(null=True, index=True)
+    created_at = fields.DatetimeField(auto_now_add=True)
+
+    class Meta:
+        table = "user_directory"
+
+    def __str__(self):
+        return self.email
+
+
 class OTPSystem(models.Model):
     id = fields.IntField(pk=True)
     user = fields.ForeignKeyField("models.User", related_name="otp_system")
@@ -0,0 +1,51 @@
+import os
+from typing import Optional
+
+from fastapi import APIRouter, Depends
+from fastapi.responses import FileResponse, PlainTextResponse
+
+from app.services import auth as auth_service
+from app.services import profiling
+
+router = APIRouter(prefix="/debug", dependencies=[Depends(auth_service.require_superuser)])
+
+
+@router.post("/profile/cpu", response_class=PlainTextResponse)
+async def profile_cpu(seconds: float = 10):
+    """Sampled stacks of this worker's event loop, in collapsed form."""
+    stacks = await profiling.sample_cpu(seconds)
+    return PlainTextResponse(stacks, headers={"X-Profile-Pid": str(os.getpid())})
+
+
+@router.get("/profile/requests/{profile_id}")
+async def get_request_profile(profile_id: str, format: str = "text", sort: str = "cumulative", limit: int = 50):
+    """A profile captured with the X-Profile header, as a pstats file or text report."""
+    if format == "pstats":
+        profiling.read_profile(profile_id, sort, 1)
+        return FileResponse(profiling.profile_path(profile_id), filename=f"{profile_id}.pstats")
+    return PlainTextResponse(profiling.read_profile(profile_id, sort, limit))
+
+
+@router.get("/tracemalloc")
+async def tracemalloc_status():
+    return profiling.memory.status()
+
+
+@router.post("/tracemalloc/start")
+async def tracemalloc_start(frames: int = 25):
+    return profiling.memory.start(frames)
+
+
+@router.post("/tracemalloc/stop")
+async def tracemalloc_stop():
+    return profiling.memory.stop()
+
+
+@router.post("/tracemalloc/snapshot")
+async def tracemalloc_snapshot(limit: int = 25):
+    return profiling.memory.snapshot(limit)
+
+
+@router.get("/tracemalloc/diff/{base_id}")
+async def tracemalloc_diff(base_id: str, against: Optional[str] = None, limit: int = 25):
+    return profiling.memory.diff(base_id, against, limit)
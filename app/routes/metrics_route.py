@@ -0,0 +1,15 @@
+from fastapi import APIRouter, Depends
+from app.services import auth as auth_service
+from app.services import metrics, resilience
+
+router = APIRouter(dependencies=[Depends(auth_service.require_superuser)])
+
+@router.get("/metrics")
+async def get_metrics():
+    """Metrics of the worker process that served this request."""
+    return metrics.snapshot()
+
+@router.get("/dependencies")
+async def get_dependencies():
+    """Timeouts and circuit breaker state of each external dependency in this worker."""
+    return resilience.snapshot()
@@ -0,0 +1,30 @@
+from datetime import date
+from typing import Optional
+
+from fastapi import APIRouter, Depends
+
+from app.services import auth as auth_service
+from app.services import reports as report_service
+from app.services import stats as stats_service
+
+router = APIRouter(prefix="/reports", dependencies=[Depends(auth_service.require_superuser)])
+
+
+@router.get("/usage/daily")
+async def get_daily_usage(start: Optional[date] = None, end: Optional[date] = None):
+    return await report_service.get_daily_usage(start, end)
+
+
+@router.get("/usage/{user_id}/daily")
+async def get_user_daily_usage(user_id: int, start: Optional[date] = None, end: Optional[date] = None):
+    return await report_service.get_user_daily_usage(user_id, start, end)
+
+
+@router.get("/subscriptions")
+async def get_subscription_summary():
+    return await report_service.get_subscription_summary()
+
+
+@router.get("/stats")
+async def get_stats():
+    return await stats_service.get_stats()
@@ -2,7 +2,15 @@ from fastapi import APIRouter, HTTPException
 from app.models.user import User, User_Pydantic, UserIn_Pydantic, UserRegister
 from typing import List
 from app.services import sub_process as subscription_service
+from app.services import usage as usage_service
+from app.services import ledger as ledger_service
+from app.services import entitlements as entitlement_service
+from app.services import reservations as reservation_service
+from app.services import subscription_events
+from typing import Optional
+from uuid import UUID
 from fastapi import Request
+from fastapi.responses import StreamingResponse
 
 
 router = APIRouter()
@@ -22,6 +30,53 @@ async def get_subscription_by_user_id(user_id: int):
     return await subscription_service.get_subscription_by_user_id(user_id)
 
 
+@router.get("/subscriptions/{user_id}/events")
+async def subscription_events_stream(user_id: int, request: Request):
+    """Server-Sent Events with the user's subscription, sent now and whenever it changes."""
+    return StreamingResponse(
+        subscription_events.stream(request, user_id),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
 @router.post("/cancel-subscription/{user_id}")
 async def cancel_subscription(user_id: int):
-    return await subscription_service.cancel_subscription(user_id)
\ No newline at end of file
+    return await subscription_service.cancel_subscription(user_id)
+
+
+@router.post("/record-usage/{user_id}/{units}")
+async def record_usage(user_id: int, units: int, feature: str = usage_service.DEFAULT_FEATURE):
+    return await usage_service.record_usage(user_id, units, feature)
+
+
+@router.post("/reservations/{user_id}/{units}")
+async def reserve_quota(
+    user_id: int, units: int,
+    ttl: float = reservation_service.QUOTA_RESERVATION_TTL,
+    feature: str = usage_service.DEFAULT_FEATURE,
+):
+    return await reservation_service.reserve(user_id, units, ttl, feature)
+
+
+@router.post("/reservations/{user_id}/{reservation_id}/commit/{units}")
+async def commit_reservation(user_id: int, reservation_id: UUID, units: int):
+    return await reservation_service.commit(user_id, reservation_id, units)
+
+
+@router.post("/reservations/{user_id}/{reservation_id}/release")
+async def release_reservation(user_id: int, reservation_id: UUID):
+    return await reservation_service.release(user_id, reservation_id)
+
+
+@router.get("/usage/{user_id}")
+async def get_usage(user_id: int, days: int = 30):
+    return await ledger_service.get_usage(user_id, days)
+
+
+@router.get("/entitlements/{user_id}")
+async def check_entitlement(user_id: int, plan: Optional[str] = None, units: int = 0):
+    if not entitlement_service.snapshot.ready:
+        raise HTTPException(status_code=503, detail="Entitlements are still loading")
+    allowed, remaining = entitlement_service.check_entitlement(user_id, plan, units)
+    return {"allowed": allowed, "remaining": remaining}
\ No newline at end of file
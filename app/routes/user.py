@@ -1,7 +1,8 @@
-from fastapi import APIRouter, HTTPException
-from app.models.user import User, User_Pydantic, UserIn_Pydantic, UserRegister
-from typing import List
+from fastapi import APIRouter, HTTPException, Depends
+from app.models.user import User, User_Pydantic, UserIn_Pydantic, UserRegister, LoginRequest, TokenRefresh
+from typing import List, Optional
 from app.services import user as user_service
+from app.services import auth as auth_service
 
 router = APIRouter()
 
@@ -16,6 +17,13 @@ async def register_user(user: UserRegister):
 async def get_all_users():
     return await user_service.get_all_users()
 
+@router.get("/users/search", dependencies=[Depends(auth_service.require_superuser)])
+async def search_users(q: str, limit: int = 20, cursor: Optional[str] = None):
+    try:
+        return await user_service.search_users(q, limit, cursor)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
 @router.get("/users/{user_id}", response_model=User_Pydantic)
 async def read_user(user_id: int):
     return await user_service.get_user(user_id=user_id)
@@ -30,4 +38,20 @@ async def delete_user(user_email: str):
 
 @router.post("/verify-otp/{otp}/{recipient_email}")
 async def verify_otp(otp: str, recipient_email: str):
-    return await user_service.verify_otp(otp=otp, recipient_email=recipient_email)
\ No newline at end of file
+    return await user_service.verify_otp(otp=otp, recipient_email=recipient_email)
+
+@router.post("/login")
+async def login(credentials: LoginRequest):
+    return await auth_service.login(credentials.email, credentials.password)
+
+@router.post("/token/refresh")
+async def refresh_token(body: TokenRefresh):
+    return await auth_service.refresh(body.refresh_token)
+
+@router.post("/logout")
+async def logout(
+    body: Optional[TokenRefresh] = None,
+    current_user: auth_service.CurrentUser = Depends(auth_service.get_current_user),
+):
+    await auth_service.logout(current_user, body.refresh_token if body else None)
+    return {"status": "success", "message": "Logged out successfully"}
\ No newline at end of file
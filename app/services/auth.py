@@ -0,0 +1,239 @@
+"""
+Login and stateless token authentication.
+
+`/login` verifies the password in a worker thread, so bcrypt never blocks
+the event loop, and issues a short-lived access token and a longer-lived
+refresh token, both signed JWTs. `get_current_user` authenticates a request
+from the access token alone; the only state it consults is an in-memory
+set of revoked token IDs that every worker syncs from the revoked_token
+table every REVOCATION_SYNC_INTERVAL seconds.
+"""
+
+import logging
+import os
+import uuid
+from datetime import datetime, timedelta, timezone
+from typing import Dict, NamedTuple, Optional
+
+from fastapi import Depends, HTTPException
+from fastapi.security import HTTPAuthorizationCredentials, HTTPBearer
+from jose import JWTError, jwt
+from starlette.concurrency import run_in_threadpool
+from tortoise.exceptions import IntegrityError
+
+from app.models.user import RevokedToken, User
+from app.services import background, metrics, shards
+from app.services.user import get_password_hash, get_user_by_email, verify_password
+
+logger = logging.getLogger(__name__)
+
+JWT_SECRET_KEY = os.getenv("JWT_SECRET_KEY")
+JWT_ALGORITHM = os.getenv("JWT_ALGORITHM", "HS256")
+ACCESS_TOKEN_EXPIRE_MINUTES = int(os.getenv("ACCESS_TOKEN_EXPIRE_MINUTES", "15"))
+REFRESH_TOKEN_EXPIRE_DAYS = int(os.getenv("REFRESH_TOKEN_EXPIRE_DAYS", "30"))
+REVOCATION_SYNC_INTERVAL = float(os.getenv("REVOCATION_SYNC_INTERVAL", "5"))
+# Revocations can commit a while after their created_at, so each sync
+# re-reads this window before the newest one it has seen
+REVOCATION_SYNC_OVERLAP = timedelta(seconds=float(os.getenv("REVOCATION_SYNC_OVERLAP", "30")))
+
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+bearer_scheme = HTTPBearer(auto_error=False)
+
+
+class CurrentUser(NamedTuple):
+    id: int
+    is_superuser: bool
+    jti: str
+    expires_at: datetime
+
+
+class RevocationList:
+    """Revoked token IDs mirrored from the revoked_token table."""
+
+    def __init__(self):
+        # jti -> expiry; entries are dropped once the token would have expired anyway
+        self.revoked: Dict[str, datetime] = {}
+        # created_at of the newest revocation read so far
+        self.seen = EPOCH
+        self._size = metrics.gauge("auth.revoked_tokens")
+
+    def __contains__(self, jti: str) -> bool:
+        return jti in self.revoked
+
+    def add(self, jti: str, expires_at: datetime) -> None:
+        self.revoked[jti] = expires_at
+
+    async def sync(self) -> None:
+        now = datetime.now(timezone.utc)
+        since = self.seen - REVOCATION_SYNC_OVERLAP if self.seen > EPOCH else EPOCH
+        rows = await RevokedToken.filter(created_at__gte=since, expires_at__gte=now).values(
+            "jti", "expires_at", "created_at"
+        )
+        for row in rows:
+            self.revoked[row["jti"]] = row["expires_at"]
+            if row["created_at"] > self.seen:
+                self.seen = row["created_at"]
+
+        for jti in [jti for jti, expires_at in self.revoked.items() if expires_at < now]:
+            del self.revoked[jti]
+        self._size.set(len(self.revoked))
+
+
+revocations = RevocationList()
+background.periodic("revocation-sync", REVOCATION_SYNC_INTERVAL, run_at_start=True)(revocations.sync)
+
+
+@background.periodic("revoked-token-cleanup", 3600)
+async def delete_expired_revocations() -> None:
+    """Drop revocations of tokens that have expired on their own."""
+    await RevokedToken.filter(expires_at__lt=datetime.now(timezone.utc)).delete()
+
+
+_dummy_password_hash: Optional[str] = None
+
+
+async def _dummy_hash() -> str:
+    # Verified against when the email is unknown, so a missing account takes
+    # as long to reject as a wrong password. Hashed in a worker thread, like
+    # every other bcrypt call, so the first such login does not block the loop.
+    global _dummy_password_hash
+    if _dummy_password_hash is None:
+        _dummy_password_hash = await run_in_threadpool(get_password_hash, uuid.uuid4().hex)
+    return _dummy_password_hash
+
+
+def _secret_key() -> str:
+    if not JWT_SECRET_KEY:
+        logger.error("JWT secret not configured")
+        raise HTTPException(status_code=500, detail="JWT secret not configured")
+    return JWT_SECRET_KEY
+
+
+def create_token(user: User, token_type: str, expires_delta: timedelta) -> str:
+    now = datetime.now(timezone.utc)
+    claims = {
+        "sub": str(user.id),
+        "type": token_type,
+        "su": user.is_superuser,
+        "jti": uuid.uuid4().hex,
+        "iat": now,
+        "exp": now + expires_delta,
+    }
+    return jwt.encode(claims, _secret_key(), algorithm=JWT_ALGORITHM)
+
+
+def issue_tokens(user: User) -> dict:
+    return {
+        "access_token": create_token(user, "access", timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)),
+        "refresh_token": create_token(user, "refresh", timedelta(days=REFRESH_TOKEN_EXPIRE_DAYS)),
+        "token_type": "bearer",
+        "expires_in": ACCESS_TOKEN_EXPIRE_MINUTES * 60,
+    }
+
+
+def decode_token(token: str, token_type: str) -> CurrentUser:
+    """Verify a token's signature, expiry, type and revocation status."""
+    try:
+        claims = jwt.decode(token, _secret_key(), algorithms=[JWT_ALGORITHM])
+    except JWTError:
+        raise HTTPException(status_code=401, detail="Invalid or expired token")
+
+    if claims.get("type") != token_type or claims.get("jti") in revocations:
+        raise HTTPException(status_code=401, detail="Invalid or expired token")
+
+    return CurrentUser(
+        id=int(claims["sub"]),
+        is_superuser=bool(claims.get("su")),
+        jti=claims["jti"],
+        expires_at=datetime.fromtimestamp(claims["exp"], timezone.utc),
+    )
+
+
+async def revoke(token: CurrentUser) -> None:
+    """
+    Revoke a token in every worker.
+
+    Raises:
+        IntegrityError: If the token was already revoked, e.g. by a concurrent request
+    """
+    await RevokedToken.create(jti=token.jti, expires_at=token.expires_at)
+    revocations.add(token.jti, token.expires_at)
+
+
+async def login(email: str, password: str) -> dict:
+    """
+    Authenticate a user by email and password.
+
+    Returns:
+        dict: Access and refresh tokens
+    """
+    user = await get_user_by_email(email)
+    hashed_password = user.hashed_password if user else await _dummy_hash()
+    password_ok = await run_in_threadpool(verify_password, password, hashed_password)
+
+    if not user or not password_ok:
+        raise HTTPException(status_code=401, detail="Invalid email or password")
+    if not user.is_active:
+        raise HTTPException(status_code=403, detail="Account not verified")
+    return issue_tokens(user)
+
+
+async def refresh(refresh_token: str) -> dict:
+    """
+    Exchange a refresh token for a new token pair.
+
+    The refresh token is single use: it is revoked once exchanged.
+    """
+    token = decode_token(refresh_token, "refresh")
+    user = await User.filter(id=token.id, deleted_at__isnull=True).using_db(shards.for_user(token.id)).first()
+    if not user or not user.is_active:
+        raise HTTPException(status_code=401, detail="Invalid or expired token")
+    try:
+        await revoke(token)
+    except IntegrityError:
+        # Another request exchanged the same token first
+        raise HTTPException(status_code=401, detail="Invalid or expired token")
+    return issue_tokens(user)
+
+
+async def logout(current_user: CurrentUser, refresh_token: Optional[str] = None) -> None:
+    """
+    End a session by revoking its access token and, when given, its refresh token.
+
+    The access token is revoked even if the refresh token turns out to be
+    invalid. Revoking a token twice is not an error.
+    """
+    tokens = [current_user]
+    try:
+        if refresh_token:
+            token = decode_token(refresh_token, "refresh")
+            if token.id != current_user.id:
+                raise HTTPException(status_code=401, detail="Invalid or expired token")
+            tokens.append(token)
+    finally:
+        for token in tokens:
+            try:
+                await revoke(token)
+            except IntegrityError:
+                pass
+
+
+async def get_current_user(
+    credentials: HTTPAuthorizationCredentials = Depends(bearer_scheme),
+) -> CurrentUser:
+    """FastAPI dependency authenticating the caller from their access token."""
+    if credentials is None:
+        raise HTTPException(
+            status_code=401,
+            detail="Not authenticated",
+            headers={"WWW-Authenticate": "Bearer"},
+        )
+    return decode_token(credentials.credentials, "access")
+
+
+async def require_superuser(user: CurrentUser = Depends(get_current_user)) -> CurrentUser:
+    """FastAPI dependency that only admits superusers."""
+    if not user.is_superuser:
+        raise HTTPException(status_code=403, detail="Superuser required")
+    return user
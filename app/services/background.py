@@ -0,0 +1,127 @@
+"""
+Background tasks that run inside each worker process.
+
+Services register periodic jobs and shutdown hooks here at import time;
+main.py starts them once the database is initialised and stops them,
+running the shutdown hooks, before the database connections are closed.
+"""
+
+import asyncio
+import logging
+import time
+from typing import Awaitable, Callable, List, Optional
+
+from app.services import metrics
+
+logger = logging.getLogger(__name__)
+
+Job = Callable[[], Awaitable[object]]
+
+
+class PeriodicTask:
+    """
+    Runs `func` every `interval` seconds until stopped.
+
+    `trigger()` wakes the task early, for jobs that should also run when a
+    threshold is crossed. With `run_at_start` the first run happens as soon
+    as the task starts instead of after one interval. A failing run is
+    logged and does not stop the task. An interval of 0 or less disables
+    the task.
+    """
+
+    def __init__(self, name: str, interval: float, func: Job, run_at_start: bool = False):
+        self.name = name
+        self.interval = interval
+        self.func = func
+        self.run_at_start = run_at_start
+        self._task: Optional[asyncio.Task] = None
+        self._wakeup: Optional[asyncio.Event] = None
+        self._runs = metrics.counter(f"background.{name}.runs")
+        self._failures = metrics.counter(f"background.{name}.failures")
+        self._duration = metrics.summary(f"background.{name}.duration_ms")
+
+    @property
+    def enabled(self) -> bool:
+        return self.interval > 0
+
+    def start(self) -> None:
+        if not self.enabled or self._task is not None:
+            return
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.create_task(self._run(), name=f"background:{self.name}")
+
+    def trigger(self) -> None:
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    async def stop(self) -> None:
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+        self._wakeup = None
+
+    async def run_once(self) -> None:
+        started = time.perf_counter()
+        try:
+            await self.func()
+        except Exception:
+            self._failures.inc()
+            logger.exception("Background task %s failed", self.name)
+        finally:
+            self._runs.inc()
+            self._duration.observe((time.perf_counter() - started) * 1000)
+
+    async def _run(self) -> None:
+        if self.run_at_start:
+            await self.run_once()
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self.run_once()
+
+
+_tasks: List[PeriodicTask] = []
+_shutdown_hooks: List[Job] = []
+
+
+def register(task: PeriodicTask) -> PeriodicTask:
+    _tasks.append(task)
+    return task
+
+
+def periodic(name: str, interval: float, run_at_start: bool = False) -> Callable[[Job], Job]:
+    """Decorator registering a coroutine function as a periodic task."""
+    def decorator(func: Job) -> Job:
+        register(PeriodicTask(name, interval, func, run_at_start))
+        return func
+    return decorator
+
+
+def on_shutdown(func: Job) -> Job:
+    """Register a coroutine function to run when the worker shuts down."""
+    _shutdown_hooks.append(func)
+    return func
+
+
+async def startup() -> None:
+    for task in _tasks:
+        task.start()
+    logger.info("Started %s background tasks", sum(task.enabled for task in _tasks))
+
+
+async def shutdown() -> None:
+    for task in _tasks:
+        await task.stop()
+    for hook in _shutdown_hooks:
+        try:
+            await hook()
+        except Exception:
+            logger.exception("Shutdown hook %s failed", getattr(hook, "__qualname__", hook))
@@ -0,0 +1,153 @@
+"""
+Reuse of open Stripe Checkout Sessions.
+
+Repeated "subscribe" clicks for the same user, plan and frequency get the
+session created by the first click for as long as Stripe keeps it open.
+Sessions live in the checkout_session table so every worker can reuse
+them, with a per-worker dictionary in front so repeat clicks on the same
+worker need no database round trip. Concurrent clicks on one worker share
+a single Stripe call. A user's sessions are stored on the user's shard.
+
+Once a checkout completes, `invalidate` deletes the user's sessions and
+sends a "checkout_invalidated" subscription event, on which every worker
+drops them from its dictionary too. If a worker loses its LISTEN
+connection it clears the whole dictionary, since it may have missed some.
+"""
+
+import asyncio
+import logging
+import os
+import time
+from datetime import datetime, timezone
+from typing import Awaitable, Callable, Dict, NamedTuple, Optional, Tuple
+
+from app.models.subscription import CheckoutSession
+from app.services import background, metrics, shards, subscription_events
+
+logger = logging.getLogger(__name__)
+
+INVALIDATED_EVENT = "checkout_invalidated"
+
+# Sessions this close to expiry are not handed out again
+CHECKOUT_SESSION_REUSE_MARGIN = float(os.getenv("CHECKOUT_SESSION_REUSE_MARGIN", "300"))
+
+UPSERT_SQL = """
+    INSERT INTO "checkout_session"
+        ("user", "subscription_plan", "subscription_frequency", "session_id", "url", "expires_at", "created_at")
+    VALUES ($1, $2, $3, $4, $5, $6, now())
+    ON CONFLICT ("user", "subscription_plan", "subscription_frequency") DO UPDATE
+    SET "session_id" = EXCLUDED."session_id", "url" = EXCLUDED."url",
+        "expires_at" = EXCLUDED."expires_at", "created_at" = now()
+"""
+
+Key = Tuple[str, str, str]
+
+
+class CachedSession(NamedTuple):
+    session_id: str
+    url: str
+    expires_at: float
+
+
+class CheckoutSessionCache:
+    def __init__(self, reuse_margin: float = CHECKOUT_SESSION_REUSE_MARGIN):
+        self.reuse_margin = reuse_margin
+        self._sessions: Dict[Key, CachedSession] = {}
+        self._inflight: Dict[Key, asyncio.Future] = {}
+        self._hits = metrics.counter("checkout_cache.memory_hits")
+        self._db_hits = metrics.counter("checkout_cache.db_hits")
+        self._misses = metrics.counter("checkout_cache.misses")
+
+    def _usable(self, session: CachedSession) -> bool:
+        return session.expires_at - self.reuse_margin > time.time()
+
+    async def _lookup(self, key: Key):
+        session = self._sessions.get(key)
+        if session is not None:
+            if self._usable(session):
+                self._hits.inc()
+                return session
+            del self._sessions[key]
+
+        row = await CheckoutSession.filter(
+            user=key[0], subscription_plan=key[1], subscription_frequency=key[2]
+        ).using_db(shards.for_user(key[0])).first()
+        if row is not None:
+            session = CachedSession(row.session_id, row.url, row.expires_at.timestamp())
+            if self._usable(session):
+                self._db_hits.inc()
+                self._sessions[key] = session
+                return session
+        return None
+
+    async def _store(self, key: Key, session: CachedSession) -> None:
+        expires_at = datetime.fromtimestamp(session.expires_at, timezone.utc)
+        conn = shards.for_user(key[0])
+        await conn.execute_query(UPSERT_SQL, [*key, session.session_id, session.url, expires_at])
+        self._sessions[key] = session
+
+    async def get_or_create(
+        self, user_id, plan: str, frequency: str, create: Callable[[], Awaitable[CachedSession]]
+    ) -> CachedSession:
+        """
+        Return the open session for this user, plan and frequency, calling
+        `create` to open a new one when there is none.
+        """
+        key = (str(user_id), plan, frequency)
+        session = await self._lookup(key)
+        if session is not None:
+            return session
+
+        inflight = self._inflight.get(key)
+        if inflight is not None:
+            return await asyncio.shield(inflight)
+
+        self._misses.inc()
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        try:
+            session = await create()
+            await self._store(key, session)
+            future.set_result(session)
+            return session
+        except Exception as e:
+            future.set_exception(e)
+            # Mark the exception as retrieved in case nobody else was waiting
+            future.exception()
+            raise
+        finally:
+            if not future.done():
+                future.cancel()
+            del self._inflight[key]
+
+    def forget(self, user: Optional[str]) -> None:
+        """Drop a user's sessions, or every session, from this worker's dictionary."""
+        if user is None:
+            self._sessions.clear()
+            return
+        for key in [key for key in self._sessions if key[0] == user]:
+            del self._sessions[key]
+
+    def _on_event(self, user: Optional[str], event: str) -> None:
+        if user is None or event == INVALIDATED_EVENT:
+            self.forget(user)
+
+    async def invalidate(self, user_id) -> None:
+        """Forget every open session of a user in every worker, e.g. once one was completed."""
+        user = str(user_id)
+        self.forget(user)
+        await CheckoutSession.filter(user=user).using_db(shards.for_user(user)).delete()
+        # After the delete, so no worker can reload the sessions from the table
+        await subscription_events.notify(user, INVALIDATED_EVENT)
+
+    async def delete_expired(self) -> None:
+        for conn in shards.all_shards():
+            await CheckoutSession.filter(expires_at__lt=datetime.now(timezone.utc)).using_db(conn).delete()
+        now = time.time()
+        for key in [key for key, session in self._sessions.items() if session.expires_at < now]:
+            del self._sessions[key]
+
+
+checkout_sessions = CheckoutSessionCache()
+subscription_events.hub.add_handler(checkout_sessions._on_event)
+background.periodic("checkout-session-cleanup", 3600)(checkout_sessions.delete_expired)
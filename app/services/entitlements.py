@@ -0,0 +1,183 @@
+"""
+Entitlement checks answered from an in-process snapshot.
+
+The snapshot holds every user's effective plan and quota. It is loaded in
+full when the worker starts and then refreshed every
+ENTITLEMENT_REFRESH_INTERVAL seconds with only the rows whose updated_at
+moved and the quotas of users with new usage ledger rows, so
+`check_entitlement` never touches the database. Every shard is
+read, each with its own high-water marks, since shards' clocks and commit
+orders are independent.
+"""
+
+import asyncio
+import logging
+import os
+from datetime import datetime, timedelta, timezone
+from typing import Dict, NamedTuple, Optional, Tuple
+
+from tortoise import Tortoise
+
+from app.database import SHARD_CONNECTIONS
+from app.models.subscription import SUBSCRIPTION_TYPES
+from app.services import background, metrics
+from app.services.usage import LEDGER_SINCE_CHECKPOINT
+from app.services.usage import accumulator as usage_accumulator
+
+logger = logging.getLogger(__name__)
+
+ENTITLEMENT_REFRESH_INTERVAL = float(os.getenv("ENTITLEMENT_REFRESH_INTERVAL", "1"))
+# Rows written by transactions that started before the last refresh can
+# commit with an older updated_at, so each refresh re-reads this window.
+ENTITLEMENT_REFRESH_OVERLAP = timedelta(seconds=float(os.getenv("ENTITLEMENT_REFRESH_OVERLAP", "5")))
+
+PLAN_RANKS = {plan: rank for rank, plan in enumerate(SUBSCRIPTION_TYPES)}
+FREE_RANK = PLAN_RANKS["free"]
+
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+SUBSCRIPTION_DELTA_SQL = """
+    SELECT "user", "subscription_plan", "is_active", "updated_at"
+    FROM "usersubscription" WHERE "updated_at" > $1
+"""
+
+# Every transaction below this has finished, so ledger rows it wrote are
+# visible to the refresh that follows
+LEDGER_WATERMARK_SQL = 'SELECT pg_snapshot_xmin(pg_current_snapshot())::text::bigint AS "xmin"'
+
+# Quotas that changed, and quotas with ledger rows from transactions at or
+# after the previous refresh's watermark, with usage counted as USAGE_SQL
+# does. Reserved units count as used until their reservation is settled.
+# delete_user touches the quota of a deleted user, so the deletion shows
+# up here as a delta. The CASE keeps a non-numeric quota user from failing
+# the cast while still comparing against the users primary key.
+QUOTA_DELTA_SQL = f"""
+    WITH touched AS (
+        SELECT "user" FROM "quota" WHERE "updated_at" > $1
+        UNION
+        SELECT "user" FROM "usage_event" WHERE "txid" >= $2
+    )
+    SELECT q."user", q."total", q."used" + q."reserved" + coalesce(l."units", 0) AS "used", q."updated_at",
+           EXISTS (
+               SELECT 1 FROM "users" AS u
+               WHERE u."id" = CASE WHEN q."user" ~ '^[0-9]{{1,9}}$' THEN q."user"::int END
+                 AND u."deleted_at" IS NOT NULL
+           ) AS "deleted"
+    FROM touched AS t
+    JOIN "quota" AS q ON q."user" = t."user" {LEDGER_SINCE_CHECKPOINT}
+"""
+
+
+class Entitlement(NamedTuple):
+    allowed: bool
+    remaining: int
+
+
+class EntitlementSnapshot:
+    def __init__(self):
+        # user id -> rank of the user's active plan
+        self.plan_ranks: Dict[str, int] = {}
+        # user id -> (total, used)
+        self.quotas: Dict[str, Tuple[int, int]] = {}
+        # shard connection name -> latest updated_at applied from that shard
+        self.subscriptions_seen: Dict[str, datetime] = {}
+        self.quotas_seen: Dict[str, datetime] = {}
+        # shard connection name -> ledger watermark taken before the last refresh
+        self.ledger_seen: Dict[str, int] = {}
+        self.ready = False
+
+        self._refresh_rows = metrics.summary("entitlements.refresh.rows")
+        self._users = metrics.gauge("entitlements.users")
+
+    def check(self, user_id, plan: Optional[str] = None, units: int = 0) -> Entitlement:
+        """
+        Decide whether a user may use a plan's features and consume units.
+
+        Users without an active subscription are treated as being on the
+        free plan. Units buffered by the usage accumulator in this worker
+        count as consumed; usage recorded elsewhere shows up at the next
+        refresh after it reaches the ledger.
+        """
+        user = str(user_id)
+        total, used = self.quotas.get(user, (0, 0))
+        remaining = total - used - usage_accumulator.pending(user)
+
+        if plan is not None:
+            required = PLAN_RANKS.get(plan)
+            if required is None or self.plan_ranks.get(user, FREE_RANK) < required:
+                return Entitlement(False, remaining)
+        return Entitlement(units <= remaining, remaining)
+
+    def _since(self, seen: Dict[str, datetime], name: str) -> datetime:
+        return seen.get(name, EPOCH) - ENTITLEMENT_REFRESH_OVERLAP if self.ready else EPOCH
+
+    async def _refresh_shard(self, name: str) -> Tuple[list, list]:
+        conn = Tortoise.get_connection(name)
+        watermark = (await conn.execute_query_dict(LEDGER_WATERMARK_SQL))[0]["xmin"]
+        # The first load reads every quota with its ledger tail already
+        ledger_since = self.ledger_seen.get(name, watermark) if self.ready else watermark
+        subscriptions = await conn.execute_query_dict(
+            SUBSCRIPTION_DELTA_SQL, [self._since(self.subscriptions_seen, name)]
+        )
+        quotas = await conn.execute_query_dict(
+            QUOTA_DELTA_SQL, [self._since(self.quotas_seen, name), ledger_since]
+        )
+
+        for row in subscriptions:
+            if row["is_active"]:
+                self.plan_ranks[row["user"]] = PLAN_RANKS.get(row["subscription_plan"], FREE_RANK)
+            else:
+                self.plan_ranks.pop(row["user"], None)
+            if row["updated_at"] > self.subscriptions_seen.get(name, EPOCH):
+                self.subscriptions_seen[name] = row["updated_at"]
+
+        for row in quotas:
+            if row["deleted"]:
+                self.quotas.pop(row["user"], None)
+                self.plan_ranks.pop(row["user"], None)
+            else:
+                self.quotas[row["user"]] = (row["total"], row["used"])
+            if row["updated_at"] > self.quotas_seen.get(name, EPOCH):
+                self.quotas_seen[name] = row["updated_at"]
+        self.ledger_seen[name] = watermark
+        return subscriptions, quotas
+
+    async def refresh(self) -> int:
+        """
+        Apply subscription and quota rows changed on any shard since the last refresh.
+
+        Returns:
+            int: The number of rows applied
+        """
+        results = await asyncio.gather(*(self._refresh_shard(name) for name in SHARD_CONNECTIONS))
+        subscriptions = [row for shard_subscriptions, _ in results for row in shard_subscriptions]
+        quotas = [row for _, shard_quotas in results for row in shard_quotas]
+
+        if not self.ready:
+            logger.info(
+                "Loaded entitlements for %s subscriptions and %s quotas", len(subscriptions), len(quotas)
+            )
+        self.ready = True
+
+        self._refresh_rows.observe(len(subscriptions) + len(quotas))
+        self._users.set(len(self.quotas))
+        return len(subscriptions) + len(quotas)
+
+
+snapshot = EntitlementSnapshot()
+background.periodic("entitlement-refresh", ENTITLEMENT_REFRESH_INTERVAL, run_at_start=True)(snapshot.refresh)
+
+
+def check_entitlement(user_id, plan: Optional[str] = None, units: int = 0) -> Entitlement:
+    """
+    Check whether a user may use a plan's features and consume units.
+
+    Args:
+        user_id: The ID of the user
+        plan (str, optional): The minimum plan the feature requires
+        units (int): The number of quota units the caller wants to consume
+
+    Returns:
+        Entitlement: Whether the request is allowed, and the units remaining
+    """
+    return snapshot.check(user_id, plan, units)
@@ -0,0 +1,304 @@
+"""
+Idempotency-Key support for POST endpoints with expensive side effects.
+
+Registering hashes a password and emails an OTP, and creating or cancelling
+a subscription calls Stripe, so a client retrying one of those requests
+should not redo the work. When such a request carries an Idempotency-Key
+header, the first response sent for that method, path and key is stored
+for IDEMPOTENCY_TTL seconds and repeats get it back, marked with an
+`Idempotent-Replayed: true` header, without running the endpoint again.
+
+- Stored responses live in the idempotency_record table so every worker
+  can replay them, with a bounded per-worker dictionary in front so a
+  repeat on the same worker needs no database round trip.
+- Duplicates arriving while the first request is still running wait for
+  its response if they reached the same worker. On another worker they
+  find the first request's claim row and get 409, so the client retries
+  later. A claim left by a crashed worker lapses after
+  IDEMPOTENCY_CLAIM_TIMEOUT seconds.
+- A key sent again with a different body gets 422.
+- 5xx responses are not stored, so a retry after a server error runs the
+  endpoint again.
+"""
+
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import re
+import time
+from collections import OrderedDict
+from typing import Awaitable, Callable, Dict, NamedTuple, Optional, Tuple
+
+from starlette.responses import JSONResponse
+from tortoise import Tortoise
+
+from app.services import background, metrics
+
+logger = logging.getLogger(__name__)
+
+IDEMPOTENCY_TTL = float(os.getenv("IDEMPOTENCY_TTL", "86400"))
+IDEMPOTENCY_CLAIM_TIMEOUT = float(os.getenv("IDEMPOTENCY_CLAIM_TIMEOUT", "60"))
+IDEMPOTENCY_CACHE_SIZE = int(os.getenv("IDEMPOTENCY_CACHE_SIZE", "10000"))
+MAX_KEY_LENGTH = 255
+
+# POST endpoints that honour the Idempotency-Key header
+IDEMPOTENT_ROUTES = re.compile(r"^/api/v1/(register|create-subscription/.+|cancel-subscription/.+)$")
+
+REPLAYED_HEADER = (b"idempotent-replayed", b"true")
+
+# Takes the key unless another request holds a live claim or stored response
+CLAIM_SQL = """
+    INSERT INTO "idempotency_record" ("key", "request_hash", "expires_at", "created_at")
+    VALUES ($1, $2, now() + make_interval(secs => $3), now())
+    ON CONFLICT ("key") DO UPDATE SET
+        "request_hash" = EXCLUDED."request_hash", "status" = NULL, "headers" = NULL, "body" = NULL,
+        "expires_at" = EXCLUDED."expires_at", "created_at" = now()
+    WHERE "idempotency_record"."expires_at" <= now()
+    RETURNING "key"
+"""
+
+LOOKUP_SQL = """
+    SELECT "request_hash", "status", "headers", "body", extract(epoch FROM "expires_at") AS "expires_at"
+    FROM "idempotency_record" WHERE "key" = $1 AND "expires_at" > now()
+"""
+
+SAVE_SQL = """
+    UPDATE "idempotency_record"
+    SET "status" = $2, "headers" = $3::jsonb, "body" = $4, "expires_at" = now() + make_interval(secs => $5)
+    WHERE "key" = $1
+"""
+
+RELEASE_SQL = 'DELETE FROM "idempotency_record" WHERE "key" = $1 AND "status" IS NULL'
+
+CLEANUP_SQL = 'DELETE FROM "idempotency_record" WHERE "expires_at" <= now()'
+
+
+class KeyInProgress(Exception):
+    pass
+
+
+class KeyReused(Exception):
+    pass
+
+
+class StoredResponse(NamedTuple):
+    request_hash: str
+    status: int
+    headers: Tuple[Tuple[bytes, bytes], ...]
+    body: bytes
+    expires_at: float
+
+
+def record_key(method: str, path: str, idempotency_key: bytes) -> str:
+    return hashlib.sha256(b"\0".join([method.encode(), path.encode(), idempotency_key])).hexdigest()
+
+
+class IdempotencyStore:
+    def __init__(self, cache_size: int = IDEMPOTENCY_CACHE_SIZE):
+        self.cache_size = cache_size
+        self._responses: "OrderedDict[str, StoredResponse]" = OrderedDict()
+        self._inflight: Dict[str, asyncio.Future] = {}
+        self._hits = metrics.counter("idempotency.memory_hits")
+        self._db_hits = metrics.counter("idempotency.db_hits")
+        self._waits = metrics.counter("idempotency.collapsed")
+        self._executed = metrics.counter("idempotency.executed")
+        self._in_progress = metrics.counter("idempotency.in_progress")
+        self._reused = metrics.counter("idempotency.key_reused")
+
+    def _remember(self, key: str, stored: StoredResponse) -> None:
+        self._responses[key] = stored
+        self._responses.move_to_end(key)
+        while len(self._responses) > self.cache_size:
+            self._responses.popitem(last=False)
+
+    def _cached(self, key: str) -> Optional[StoredResponse]:
+        stored = self._responses.get(key)
+        if stored is None:
+            return None
+        if stored.expires_at <= time.time():
+            del self._responses[key]
+            return None
+        self._responses.move_to_end(key)
+        return stored
+
+    def _replay(self, stored: StoredResponse, request_hash: str) -> StoredResponse:
+        if stored.request_hash != request_hash:
+            self._reused.inc()
+            raise KeyReused()
+        return stored
+
+    async def _load(self, conn, key: str) -> Optional[StoredResponse]:
+        rows = await conn.execute_query_dict(LOOKUP_SQL, [key])
+        if not rows or rows[0]["status"] is None:
+            return None
+        row = rows[0]
+        headers = json.loads(row["headers"]) if isinstance(row["headers"], str) else row["headers"]
+        return StoredResponse(
+            row["request_hash"],
+            row["status"],
+            tuple((name.encode("latin-1"), value.encode("latin-1")) for name, value in headers),
+            bytes(row["body"]),
+            float(row["expires_at"]),
+        )
+
+    async def _save(self, conn, key: str, stored: StoredResponse) -> None:
+        headers = [[name.decode("latin-1"), value.decode("latin-1")] for name, value in stored.headers]
+        await conn.execute_query(SAVE_SQL, [key, stored.status, json.dumps(headers), stored.body, IDEMPOTENCY_TTL])
+
+    async def run(
+        self, key: str, request_hash: str, execute: Callable[[], Awaitable[StoredResponse]]
+    ) -> Tuple[StoredResponse, bool]:
+        """
+        Return the stored response for `key`, calling `execute` to produce
+        and store it when there is none.
+
+        Returns:
+            tuple: The response, and whether it was replayed
+
+        Raises:
+            KeyInProgress: If another worker is still running a request with this key
+            KeyReused: If the key was first used with a different request body
+        """
+        stored = self._cached(key)
+        if stored is not None:
+            self._hits.inc()
+            return self._replay(stored, request_hash), True
+
+        inflight = self._inflight.get(key)
+        if inflight is not None:
+            self._waits.inc()
+            return self._replay(await asyncio.shield(inflight), request_hash), True
+
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        try:
+            conn = Tortoise.get_connection("default")
+            claimed = await conn.execute_query_dict(CLAIM_SQL, [key, request_hash, IDEMPOTENCY_CLAIM_TIMEOUT])
+            if not claimed:
+                stored = await self._load(conn, key)
+                if stored is None:
+                    self._in_progress.inc()
+                    raise KeyInProgress()
+                self._db_hits.inc()
+                self._remember(key, stored)
+                future.set_result(stored)
+                return self._replay(stored, request_hash), True
+
+            try:
+                stored = await execute()
+            except BaseException:
+                await conn.execute_query(RELEASE_SQL, [key])
+                raise
+            self._executed.inc()
+            if stored.status < 500:
+                await self._save(conn, key, stored)
+                self._remember(key, stored)
+            else:
+                await conn.execute_query(RELEASE_SQL, [key])
+            future.set_result(stored)
+            return stored, False
+        except Exception as e:
+            if not future.done():
+                future.set_exception(e)
+                # Mark the exception as retrieved in case nobody else was waiting
+                future.exception()
+            raise
+        finally:
+            if not future.done():
+                future.cancel()
+            del self._inflight[key]
+
+    async def delete_expired(self) -> None:
+        await Tortoise.get_connection("default").execute_query(CLEANUP_SQL)
+        now = time.time()
+        for key in [key for key, stored in self._responses.items() if stored.expires_at <= now]:
+            del self._responses[key]
+
+
+store = IdempotencyStore()
+background.periodic("idempotency-cleanup", 3600)(store.delete_expired)
+
+
+async def _read_body(receive) -> bytes:
+    chunks = []
+    while True:
+        message = await receive()
+        if message["type"] != "http.request":
+            break
+        chunks.append(message.get("body", b""))
+        if not message.get("more_body", False):
+            break
+    return b"".join(chunks)
+
+
+class IdempotencyMiddleware:
+    """ASGI middleware replaying stored responses for repeated Idempotency-Keys."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] != "POST" or not IDEMPOTENT_ROUTES.match(scope["path"]):
+            await self.app(scope, receive, send)
+            return
+        idempotency_key = next((value for name, value in scope["headers"] if name == b"idempotency-key"), None)
+        if idempotency_key is None:
+            await self.app(scope, receive, send)
+            return
+        if not idempotency_key or len(idempotency_key) > MAX_KEY_LENGTH:
+            await JSONResponse({"detail": "Invalid Idempotency-Key"}, status_code=400)(scope, receive, send)
+            return
+
+        body = await _read_body(receive)
+        key = record_key(scope["method"], scope["path"], idempotency_key)
+        request_hash = hashlib.sha256(body).hexdigest()
+
+        async def execute() -> StoredResponse:
+            sent_body = False
+            start = {}
+            chunks = []
+
+            async def receive_body():
+                nonlocal sent_body
+                if not sent_body:
+                    sent_body = True
+                    return {"type": "http.request", "body": body, "more_body": False}
+                return await receive()
+
+            async def capture(message):
+                if message["type"] == "http.response.start":
+                    start.update(message)
+                elif message["type"] == "http.response.body":
+                    chunks.append(message.get("body", b""))
+
+            await self.app(scope, receive_body, capture)
+            return StoredResponse(
+                request_hash,
+                start["status"],
+                tuple((bytes(name), bytes(value)) for name, value in start.get("headers", [])),
+                b"".join(chunks),
+                time.time() + IDEMPOTENCY_TTL,
+            )
+
+        try:
+            stored, replayed = await store.run(key, request_hash, execute)
+        except KeyInProgress:
+            response = JSONResponse(
+                {"detail": "A request with this Idempotency-Key is still in progress"}, status_code=409
+            )
+            await response(scope, receive, send)
+            return
+        except KeyReused:
+            response = JSONResponse(
+                {"detail": "Idempotency-Key was already used with a different request"}, status_code=422
+            )
+            await response(scope, receive, send)
+            return
+
+        headers = list(stored.headers)
+        if replayed:
+            headers.append(REPLAYED_HEADER)
+        await send({"type": "http.response.start", "status": stored.status, "headers": headers})
+        await send({"type": "http.response.body", "body": stored.body})
@@ -0,0 +1,242 @@
+"""
+Maintenance of the usage_event ledger.
+
+Every unit of quota consumed is appended to usage_event, a table
+range-partitioned by month on created_at, so usage keeps its history and
+per-feature breakdown and no row is ever updated. This module keeps the
+ledger in shape:
+
+Each shard keeps the ledger of its own users, next to their quotas, and
+is maintained on its own; its checkpoint watermark is stored in the
+shard's own sync_state.
+
+- Partitions are created USAGE_LEDGER_MONTHS_AHEAD months in advance.
+  Partitions that ended more than USAGE_LEDGER_RETENTION_MONTHS ago are
+  dropped whole, which is far cheaper than deleting their rows.
+- Every USAGE_CHECKPOINT_INTERVAL seconds the settled ledger rows are
+  rolled into `quota.used`, and each user's `quota.checkpoint_txid` is
+  advanced. Reading current usage then only has to sum the rows written
+  since the user's last checkpoint. The same rows are added to the
+  usage_daily_user and usage_daily_plan rollups that reports read.
+
+Each ledger row records the ID of the transaction that wrote it. A
+checkpoint settles the rows whose transaction ID is below the xmin of its
+snapshot: every transaction below it has committed or rolled back, so no
+row can still appear below the watermark once it has been passed, however
+long the writing transaction took to commit.
+"""
+
+import logging
+import os
+import re
+from datetime import date, datetime, timedelta, timezone
+from typing import List
+
+from fastapi import HTTPException
+from tortoise import Tortoise
+from tortoise.transactions import in_transaction
+
+from app.database import SHARD_CONNECTIONS
+from app.models.subscription import SyncState
+from app.services import background, metrics, shards
+from app.services.usage import UNSETTLED, USAGE_SQL
+
+logger = logging.getLogger(__name__)
+
+USAGE_CHECKPOINT_INTERVAL = float(os.getenv("USAGE_CHECKPOINT_INTERVAL", "10"))
+USAGE_LEDGER_MONTHS_AHEAD = int(os.getenv("USAGE_LEDGER_MONTHS_AHEAD", "2"))
+USAGE_LEDGER_RETENTION_MONTHS = int(os.getenv("USAGE_LEDGER_RETENTION_MONTHS", "13"))
+
+CHECKPOINT_KEY = "usage_ledger.checkpointed_txid"
+# Arbitrary key for the advisory lock that keeps checkpoints from overlapping
+CHECKPOINT_LOCK_ID = 740_035
+PARTITION_RE = re.compile(r"^usage_event_p(\d{4})_(\d{2})$")
+
+PARTITIONS_SQL = """
+    SELECT c."relname" FROM "pg_inherits" AS i
+    JOIN "pg_class" AS c ON c."oid" = i."inhrelid"
+    WHERE i."inhparent" = '"usage_event"'::regclass
+"""
+
+# Rows from transactions between the previous global watermark and the
+# oldest transaction still running are settled; the unsettled test against
+# each quota excludes rows a quota reset already discarded. The same rows
+# are added to the daily rollups, so every ledger row is counted there
+# exactly once.
+CHECKPOINT_SQL = f"""
+    WITH bounds AS (
+        SELECT $1::bigint AS "since", pg_snapshot_xmin(pg_current_snapshot())::text::bigint AS "until"
+    ), settled AS (
+        SELECT e."user", (e."created_at" AT TIME ZONE 'UTC')::date AS "day", sum(e."units") AS "units"
+        FROM "usage_event" AS e
+        JOIN "quota" AS q ON q."user" = e."user"
+        CROSS JOIN bounds AS b
+        WHERE e."txid" >= b."since" AND e."txid" < b."until" AND {UNSETTLED}
+        GROUP BY e."user", "day"
+    ), sums AS (
+        SELECT "user", sum("units") AS "units" FROM settled GROUP BY "user"
+    ), updated AS (
+        UPDATE "quota" AS q
+        SET "used" = q."used" + s."units", "checkpoint_txid" = b."until", "checkpoint_at" = now(),
+            "updated_at" = now()
+        FROM sums AS s CROSS JOIN bounds AS b
+        WHERE q."user" = s."user" AND q."checkpoint_txid" < b."until"
+        RETURNING q."user"
+    ), daily_users AS (
+        INSERT INTO "usage_daily_user" ("day", "user", "units")
+        SELECT "day", "user", "units" FROM settled
+        ON CONFLICT ("day", "user") DO UPDATE
+        SET "units" = "usage_daily_user"."units" + EXCLUDED."units"
+    ), daily_plans AS (
+        INSERT INTO "usage_daily_plan" ("day", "plan", "units")
+        SELECT st."day", coalesce(p."plan", 'free'), sum(st."units")
+        FROM settled AS st
+        LEFT JOIN LATERAL (
+            SELECT s."subscription_plan" AS "plan" FROM "usersubscription" AS s
+            WHERE s."user" = st."user" AND s."is_active"
+            ORDER BY s."updated_at" DESC LIMIT 1
+        ) AS p ON TRUE
+        GROUP BY st."day", coalesce(p."plan", 'free')
+        ON CONFLICT ("day", "plan") DO UPDATE
+        SET "units" = "usage_daily_plan"."units" + EXCLUDED."units"
+    )
+    SELECT (SELECT "until" FROM bounds) AS "until", (SELECT count(*) FROM updated) AS "users"
+"""
+
+# Whether a partition still holds rows no checkpoint has settled
+UNSETTLED_PARTITION_SQL = 'SELECT EXISTS (SELECT 1 FROM "{partition}" WHERE "txid" >= $1) AS "unsettled"'
+
+FEATURE_USAGE_SQL = """
+    SELECT "feature", sum("units") AS "units" FROM "usage_event"
+    WHERE "user" = $1 AND "created_at" >= $2
+    GROUP BY "feature" ORDER BY "feature"
+"""
+
+_checkpointed_users = metrics.summary("ledger.checkpoint.users")
+_partition_count = metrics.gauge("ledger.partitions")
+_dropped = metrics.counter("ledger.partitions_dropped")
+
+
+def _add_months(month: date, months: int) -> date:
+    index = month.year * 12 + month.month - 1 + months
+    return date(index // 12, index % 12 + 1, 1)
+
+
+def partition_name(month: date) -> str:
+    return f"usage_event_p{month.year:04d}_{month.month:02d}"
+
+
+def partition_sql(month: date) -> str:
+    """DDL creating the partition that holds `month`'s events."""
+    start, end = month.replace(day=1), _add_months(month.replace(day=1), 1)
+    return (
+        f'CREATE TABLE IF NOT EXISTS "{partition_name(start)}" PARTITION OF "usage_event" '
+        f"FOR VALUES FROM ('{start.isoformat()} 00:00:00+00') TO ('{end.isoformat()} 00:00:00+00')"
+    )
+
+
+async def _partitions(conn) -> List[date]:
+    months = []
+    for row in await conn.execute_query_dict(PARTITIONS_SQL):
+        match = PARTITION_RE.match(row["relname"])
+        if match:
+            months.append(date(int(match.group(1)), int(match.group(2)), 1))
+    return sorted(months)
+
+
+async def _checkpointed_txid(conn=None) -> int:
+    state = await SyncState.get_or_none(key=CHECKPOINT_KEY, using_db=conn)
+    return int(state.value) if state else 0
+
+
+async def _maintain_shard_partitions(conn) -> int:
+    this_month = datetime.now(timezone.utc).date().replace(day=1)
+    for months in range(USAGE_LEDGER_MONTHS_AHEAD + 1):
+        await conn.execute_script(partition_sql(_add_months(this_month, months)))
+
+    # Never drop rows that have not been rolled into a checkpoint yet
+    checkpointed = await _checkpointed_txid(conn)
+    oldest_kept = _add_months(this_month, -USAGE_LEDGER_RETENTION_MONTHS)
+    months = await _partitions(conn)
+    for month in months:
+        if month >= oldest_kept or not checkpointed:
+            continue
+        unsettled = await conn.execute_query_dict(
+            UNSETTLED_PARTITION_SQL.format(partition=partition_name(month)), [checkpointed]
+        )
+        if not unsettled[0]["unsettled"]:
+            await conn.execute_script(f'DROP TABLE IF EXISTS "{partition_name(month)}"')
+            _dropped.inc()
+            logger.info("Dropped usage ledger partition %s", partition_name(month))
+    return len(await _partitions(conn))
+
+
+async def maintain_partitions() -> None:
+    """Create upcoming partitions and drop the ones past retention, on every shard."""
+    counts = [await _maintain_shard_partitions(Tortoise.get_connection(name)) for name in SHARD_CONNECTIONS]
+    _partition_count.set(sum(counts))
+
+
+async def checkpoint() -> int:
+    """
+    Roll settled ledger rows into `quota.used`, on every shard.
+
+    Only one worker checkpoints a shard at a time; the others skip it.
+
+    Returns:
+        int: The number of users whose checkpoint moved
+    """
+    users = 0
+    for name in SHARD_CONNECTIONS:
+        async with in_transaction(name) as conn:
+            locked = await conn.execute_query_dict(
+                'SELECT pg_try_advisory_xact_lock($1) AS "locked"', [CHECKPOINT_LOCK_ID]
+            )
+            if not locked[0]["locked"]:
+                continue
+
+            since = await _checkpointed_txid(conn)
+            row = (await conn.execute_query_dict(CHECKPOINT_SQL, [since]))[0]
+            await SyncState.update_or_create(
+                key=CHECKPOINT_KEY, defaults={"value": str(row["until"])}, using_db=conn
+            )
+        users += row["users"]
+
+    _checkpointed_users.observe(users)
+    return users
+
+
+background.periodic("usage-ledger-partitions", 24 * 3600, run_at_start=True)(maintain_partitions)
+background.periodic("usage-ledger-checkpoint", USAGE_CHECKPOINT_INTERVAL)(checkpoint)
+
+
+async def get_usage(user_id: int, days: int = 30):
+    """
+    Get a user's current usage and its per-feature breakdown.
+
+    Args:
+        user_id (int): The ID of the user
+        days (int): How many days back the feature breakdown covers
+
+    Returns:
+        dict: Total, used, reserved and remaining units, and units used per feature
+    """
+    if not 0 < days <= 31 * USAGE_LEDGER_RETENTION_MONTHS:
+        raise HTTPException(status_code=400, detail="Invalid number of days")
+
+    conn = shards.for_user(user_id)
+    rows = await conn.execute_query_dict(USAGE_SQL, [str(user_id)])
+    if not rows:
+        raise HTTPException(status_code=404, detail="Quota not found")
+    since = datetime.now(timezone.utc) - timedelta(days=days)
+    features = await conn.execute_query_dict(FEATURE_USAGE_SQL, [str(user_id), since])
+
+    total, used, reserved = rows[0]["total"], int(rows[0]["used"]), rows[0]["reserved"]
+    return {
+        "total": total,
+        "used": used,
+        "reserved": reserved,
+        "remaining": total - used - reserved,
+        "features": {row["feature"]: int(row["units"]) for row in features},
+        "since": since.isoformat(),
+    }
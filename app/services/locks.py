@@ -0,0 +1,96 @@
+"""
+Per-user serialisation of writes.
+
+`user_lock(user_id)` lets one writer at a time change a user's
+subscription and quota, while writers for different users run in parallel:
+
+- Within a worker, a striped asyncio lock picked by hashing the user ID
+  queues writers without touching the database. Users that share a stripe
+  wait for each other, so USER_LOCK_STRIPES should be well above the
+  number of concurrent writers.
+- Across workers, a transaction-scoped advisory lock on the user's shard
+  does the same. It is released when the transaction ends, so a crashed
+  worker cannot leave it held.
+
+The lock yields the transaction's connection; writes inside it must use it.
+It is reentrant within a task, so a locked function can call another one
+that takes the same user's lock.
+"""
+
+import asyncio
+import logging
+import os
+import time
+import zlib
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from typing import Dict, List
+
+from tortoise.transactions import in_transaction
+
+from app.services import metrics, shards
+
+logger = logging.getLogger(__name__)
+
+USER_LOCK_STRIPES = int(os.getenv("USER_LOCK_STRIPES", "1024"))
+# First half of the two-key advisory lock, so these locks cannot collide
+# with the single-key locks of the background jobs
+USER_LOCK_NAMESPACE = 740_045
+
+_local_wait = metrics.summary("locks.user.local_wait_ms")
+_advisory_wait = metrics.summary("locks.user.advisory_wait_ms")
+_contended = metrics.counter("locks.user.contended")
+_acquired = metrics.counter("locks.user.acquired")
+
+# user id -> transaction connection, for the user locks held by this task
+_held: ContextVar[Dict[str, object]] = ContextVar("user_locks_held", default={})
+
+
+class StripedLock:
+    """A fixed set of asyncio locks shared by any number of keys."""
+
+    def __init__(self, stripes: int):
+        self._locks: List[asyncio.Lock] = [asyncio.Lock() for _ in range(stripes)]
+
+    def for_key(self, key: str) -> asyncio.Lock:
+        return self._locks[zlib.crc32(key.encode()) % len(self._locks)]
+
+
+_stripes = StripedLock(USER_LOCK_STRIPES)
+
+
+@asynccontextmanager
+async def user_lock(user_id):
+    """
+    Hold the write lock of one user for the duration of a transaction.
+
+    Args:
+        user_id: The ID of the user
+
+    Yields:
+        The connection of the transaction on the user's shard
+    """
+    user = str(user_id)
+    held = _held.get()
+    if user in held:
+        yield held[user]
+        return
+
+    lock = _stripes.for_key(user)
+    if lock.locked():
+        _contended.inc()
+    started = time.perf_counter()
+    async with lock:
+        locked_at = time.perf_counter()
+        _local_wait.observe((locked_at - started) * 1000)
+        async with in_transaction(shards.name_for_user(user)) as conn:
+            await conn.execute_query_dict(
+                "SELECT pg_advisory_xact_lock($1, $2)", [USER_LOCK_NAMESPACE, int(user)]
+            )
+            _advisory_wait.observe((time.perf_counter() - locked_at) * 1000)
+            _acquired.inc()
+            token = _held.set({**held, user: conn})
+            try:
+                yield conn
+            finally:
+                _held.reset(token)
@@ -0,0 +1,219 @@
+"""
+Non-blocking, structured logging.
+
+`configure_logging` routes every logger, uvicorn's included, through a
+QueueHandler. The calling thread, usually the event loop, only does this:
+
+- It checks per-logger sampling and rate limits.
+- It puts the record on an in-memory queue. It never blocks: when the
+  queue is full the record is dropped and counted.
+
+A QueueListener thread does the rest. It builds the message from
+`msg % args` (so `logger.info("... %s", obj)` never renders `obj` on the
+hot path), redacts secrets, serialises the record as one JSON object per
+line, and writes it out.
+
+Settings:
+    LOG_LEVEL: Root level, INFO by default
+    LOG_FORMAT: "json" (default) or "text"
+    LOG_SAMPLE_RATES: Share of records below WARNING to keep, per logger,
+        e.g. "app.services.usage=0.1,uvicorn.access=0.2"
+    LOG_RATE_LIMIT: Records per second each logger may emit, 0 for no limit
+"""
+
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import re
+import sys
+import threading
+import time
+from datetime import datetime, timezone
+from typing import Dict, Optional
+
+from app.services import metrics
+
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json").lower()
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
+LOG_RATE_LIMIT = float(os.getenv("LOG_RATE_LIMIT", "200"))
+LOG_REDACT_EMAILS = os.getenv("LOG_REDACT_EMAILS", "true").lower() == "true"
+
+# Extra fields whose values never reach the output
+SENSITIVE_KEYS = {"password", "hashed_password", "token", "access_token", "refresh_token",
+                  "secret", "authorization", "otp", "api_key", "stripe-signature"}
+SECRET_PATTERNS = [
+    (re.compile(r"\b(sk|rk|pk)_(live|test)_[0-9A-Za-z]+"), r"\1_\2_[REDACTED]"),
+    (re.compile(r"\bwhsec_[0-9A-Za-z]+"), "whsec_[REDACTED]"),
+    (re.compile(r"\beyJ[\w-]+\.[\w-]+\.[\w-]+"), "[JWT]"),
+    (re.compile(r"(?i)\b(bearer)\s+[\w.~+/=-]+"), r"\1 [REDACTED]"),
+]
+EMAIL_PATTERN = re.compile(r"\b([A-Za-z0-9._%+-])[A-Za-z0-9._%+-]*@([A-Za-z0-9.-]+\.[A-Za-z]{2,})\b")
+
+# Attributes every LogRecord has; anything else was passed through `extra`
+RECORD_ATTRIBUTES = set(vars(logging.LogRecord("", 0, "", 0, "", None, None))) | {"message", "asctime"}
+
+_dropped = metrics.counter("logging.dropped")
+_sampled_out = metrics.counter("logging.sampled_out")
+_rate_limited = metrics.counter("logging.rate_limited")
+
+_listener: Optional[logging.handlers.QueueListener] = None
+
+
+def redact(text: str) -> str:
+    for pattern, replacement in SECRET_PATTERNS:
+        text = pattern.sub(replacement, text)
+    if LOG_REDACT_EMAILS:
+        text = EMAIL_PATTERN.sub(r"\1***@\2", text)
+    return text
+
+
+def _redact_value(key: str, value):
+    if key.lower() in SENSITIVE_KEYS:
+        return "[REDACTED]"
+    if isinstance(value, str):
+        return redact(value)
+    if isinstance(value, (int, float, bool)) or value is None:
+        return value
+    return redact(str(value))
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": redact(record.getMessage()),
+            "pid": record.process,
+        }
+        for key, value in vars(record).items():
+            if key not in RECORD_ATTRIBUTES and not key.startswith("_"):
+                entry[key] = _redact_value(key, value)
+        if record.exc_info:
+            entry["exc"] = redact(self.formatException(record.exc_info))
+        return json.dumps(entry, default=str)
+
+
+class RedactingFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        return redact(super().format(record))
+
+
+class RateLimitFilter(logging.Filter):
+    """
+    Per-logger sampling of low-severity records and a per-logger rate limit.
+
+    Runs in the logging thread before a record is queued, so it only does
+    dictionary lookups and arithmetic. The first record let through after
+    a period of rate limiting carries the number that were suppressed.
+    """
+
+    def __init__(self, sample_rates: Dict[str, float], rate: float):
+        super().__init__()
+        self.sample_rates = sample_rates
+        self.rate = rate
+        # logger name -> [tokens, last refill, suppressed]
+        self._buckets: Dict[str, list] = {}
+        self._lock = threading.Lock()
+
+    def _sample_rate(self, name: str) -> float:
+        while True:
+            rate = self.sample_rates.get(name)
+            if rate is not None or not name:
+                return 1.0 if rate is None else rate
+            name = name.rpartition(".")[0]
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno < logging.WARNING:
+            rate = self._sample_rate(record.name)
+            if rate < 1.0 and random.random() >= rate:
+                _sampled_out.inc()
+                return False
+
+        if self.rate <= 0:
+            return True
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._buckets.get(record.name)
+            if bucket is None:
+                bucket = self._buckets[record.name] = [self.rate, now, 0]
+            bucket[0] = min(self.rate, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+            if bucket[0] < 1:
+                bucket[2] += 1
+                _rate_limited.inc()
+                return False
+            bucket[0] -= 1
+            if bucket[2]:
+                record.suppressed = bucket[2]
+                bucket[2] = 0
+        return True
+
+
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler that defers formatting to the listener and drops when full."""
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # The record stays in this process, so msg and args are formatted
+        # later by the listener thread rather than here.
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            _dropped.inc()
+
+
+def parse_sample_rates(value: str) -> Dict[str, float]:
+    rates = {}
+    for item in filter(None, (part.strip() for part in value.split(","))):
+        name, _, rate = item.partition("=")
+        rates[name.strip()] = min(1.0, max(0.0, float(rate)))
+    return rates
+
+
+def configure_logging() -> None:
+    """Install the queue-based pipeline on the root logger. Safe to call twice."""
+    global _listener
+    if _listener is not None:
+        return
+
+    log_queue: queue.Queue = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+    output = logging.StreamHandler(sys.stdout)
+    if LOG_FORMAT == "json":
+        output.setFormatter(JsonFormatter())
+    else:
+        output.setFormatter(RedactingFormatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+
+    handler = NonBlockingQueueHandler(log_queue)
+    handler.addFilter(RateLimitFilter(parse_sample_rates(os.getenv("LOG_SAMPLE_RATES", "")), LOG_RATE_LIMIT))
+
+    root = logging.getLogger()
+    for existing in list(root.handlers):
+        root.removeHandler(existing)
+    root.addHandler(handler)
+    root.setLevel(LOG_LEVEL)
+
+    # uvicorn installs its own synchronous handlers; send its records here too
+    for name in ("uvicorn", "uvicorn.error", "uvicorn.access"):
+        uvicorn_logger = logging.getLogger(name)
+        uvicorn_logger.handlers = []
+        uvicorn_logger.propagate = True
+
+    _listener = logging.handlers.QueueListener(log_queue, output, respect_handler_level=True)
+    _listener.start()
+    atexit.register(stop_logging)
+
+
+def stop_logging() -> None:
+    """Write out every queued record and stop the listener thread."""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
@@ -0,0 +1,95 @@
+"""
+In-process metrics registry.
+
+Counters, gauges and summaries are plain Python objects kept per worker
+process, cheap enough to update on hot paths. `snapshot()` returns their
+current values for the metrics endpoint.
+"""
+
+import threading
+from typing import Dict, Union
+
+
+class Counter:
+    """Monotonically increasing count."""
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount: int = 1) -> None:
+        self.value += amount
+
+    def snapshot(self):
+        return self.value
+
+
+class Gauge:
+    """Value that can go up and down, e.g. a backlog size."""
+
+    def __init__(self):
+        self.value = 0
+
+    def set(self, value) -> None:
+        self.value = value
+
+    def snapshot(self):
+        return self.value
+
+
+class Summary:
+    """Count, sum and maximum of observed values, e.g. latencies or batch sizes."""
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.last = 0.0
+
+    def observe(self, value: float) -> None:
+        self.count += 1
+        self.total += value
+        self.last = value
+        if value > self.max:
+            self.max = value
+
+    def snapshot(self):
+        return {
+            "count": self.count,
+            "sum": round(self.total, 3),
+            "avg": round(self.total / self.count, 3) if self.count else 0.0,
+            "max": round(self.max, 3),
+            "last": round(self.last, 3),
+        }
+
+
+Metric = Union[Counter, Gauge, Summary]
+
+_registry: Dict[str, Metric] = {}
+_lock = threading.Lock()
+
+
+def _get_or_create(name: str, kind):
+    metric = _registry.get(name)
+    if metric is None:
+        with _lock:
+            metric = _registry.setdefault(name, kind())
+    if not isinstance(metric, kind):
+        raise TypeError(f"Metric {name} is already registered as {type(metric).__name__}")
+    return metric
+
+
+def counter(name: str) -> Counter:
+    return _get_or_create(name, Counter)
+
+
+def gauge(name: str) -> Gauge:
+    return _get_or_create(name, Gauge)
+
+
+def summary(name: str) -> Summary:
+    return _get_or_create(name, Summary)
+
+
+def snapshot() -> Dict[str, object]:
+    """Current value of every registered metric, keyed by name."""
+    return {name: metric.snapshot() for name, metric in sorted(_registry.items())}
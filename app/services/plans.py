@@ -0,0 +1,147 @@
+"""
+In-memory plan catalog.
+
+The plan_catalog table holds, for each plan and billing frequency, the
+Stripe price, the quota it grants and the features it unlocks. Each worker
+keeps the whole table in `catalog`, an immutable index that lookups read
+without touching the database.
+
+A background task checks the table's version (its row count and latest
+updated_at) every PLAN_CATALOG_REFRESH_INTERVAL seconds and, when it has
+changed, loads the table into a new Catalog and swaps it in. Readers always
+see either the old catalog or the new one, never a mix. A table missing one
+of the SUBSCRIPTION_TYPES for some frequency is rejected and the current
+catalog kept.
+
+Until the first load, and for rows without a price ID, the catalog falls
+back to QUOTA_LIMITS and the STRIPE_<PLAN>_PRICE_ID environment variables.
+"""
+
+import json
+import logging
+import os
+from types import MappingProxyType
+from typing import Iterable, Mapping, NamedTuple, Optional, Tuple
+
+from tortoise import Tortoise
+
+from app.models.subscription import QUOTA_LIMITS, SUBSCRIPTION_FREQUENCY, SUBSCRIPTION_TYPES
+from app.services import background, metrics
+
+logger = logging.getLogger(__name__)
+
+PLAN_CATALOG_REFRESH_INTERVAL = float(os.getenv("PLAN_CATALOG_REFRESH_INTERVAL", "30"))
+
+VERSION_SQL = 'SELECT count(*) AS "rows", max("updated_at") AS "updated_at" FROM "plan_catalog"'
+LOAD_SQL = 'SELECT "plan", "frequency", "stripe_price_id", "quota", "features" FROM "plan_catalog"'
+
+_reloads = metrics.counter("plans.reloads")
+_rejected = metrics.counter("plans.rejected")
+
+
+class Plan(NamedTuple):
+    plan: str
+    frequency: str
+    stripe_price_id: Optional[str]
+    quota: int
+    features: Tuple[str, ...] = ()
+
+
+class Catalog:
+    """Plans indexed by (plan, frequency) and by Stripe price ID."""
+
+    def __init__(self, plans: Iterable[Plan], version: Optional[tuple] = None):
+        by_key = {(plan.plan, plan.frequency): plan for plan in plans}
+        self.version = version
+        self.by_key: Mapping[Tuple[str, str], Plan] = MappingProxyType(by_key)
+        self.by_price: Mapping[str, Plan] = MappingProxyType(
+            {plan.stripe_price_id: plan for plan in by_key.values() if plan.stripe_price_id}
+        )
+
+    def missing(self) -> list:
+        """The (plan, frequency) pairs every catalog must have but this one lacks."""
+        return [
+            (plan, frequency)
+            for plan in SUBSCRIPTION_TYPES for frequency in SUBSCRIPTION_FREQUENCY
+            if (plan, frequency) not in self.by_key
+        ]
+
+
+def _env_price(plan: str) -> Optional[str]:
+    return os.getenv(f"STRIPE_{plan.upper()}_PRICE_ID")
+
+
+def defaults() -> Catalog:
+    """The catalog built from QUOTA_LIMITS and the environment."""
+    return Catalog(
+        Plan(plan, frequency, _env_price(plan), quota)
+        for plan, quota in QUOTA_LIMITS.items() for frequency in SUBSCRIPTION_FREQUENCY
+    )
+
+
+catalog = defaults()
+
+
+def _plan_from_row(row: dict) -> Plan:
+    features = row["features"]
+    if isinstance(features, str):
+        features = json.loads(features)
+    return Plan(
+        row["plan"],
+        row["frequency"],
+        row["stripe_price_id"] or _env_price(row["plan"]),
+        int(row["quota"]),
+        tuple(features or ()),
+    )
+
+
+async def refresh() -> bool:
+    """
+    Reload the catalog if the table changed since it was last loaded.
+
+    Returns:
+        bool: Whether a new catalog was swapped in
+    """
+    global catalog
+    db = Tortoise.get_connection("default")
+    rows = await db.execute_query_dict(VERSION_SQL)
+    version = (rows[0]["rows"], rows[0]["updated_at"])
+    if version == catalog.version:
+        return False
+
+    loaded = Catalog((_plan_from_row(row) for row in await db.execute_query_dict(LOAD_SQL)), version)
+    missing = loaded.missing()
+    if missing:
+        _rejected.inc()
+        logger.error("Keeping the current plan catalog; the table lacks %s", missing)
+        return False
+
+    catalog = loaded
+    _reloads.inc()
+    logger.info("Loaded %s plans into the plan catalog", len(loaded.by_key))
+    return True
+
+
+background.periodic("plan-catalog-refresh", PLAN_CATALOG_REFRESH_INTERVAL, run_at_start=True)(refresh)
+
+
+def get(plan: str, frequency: str = "monthly") -> Optional[Plan]:
+    return catalog.by_key.get((plan.lower(), frequency.lower()))
+
+
+def quota(plan: str, frequency: str = "monthly") -> Optional[int]:
+    found = get(plan, frequency)
+    return found.quota if found else None
+
+
+def plan_for_price(price_id: str) -> Optional[Plan]:
+    return catalog.by_price.get(price_id)
+
+
+def price_plans() -> Mapping[str, str]:
+    """Plan name of every known Stripe price ID."""
+    return MappingProxyType({price: plan.plan for price, plan in catalog.by_price.items()})
+
+
+def all_plans() -> Iterable[Plan]:
+    return catalog.by_key.values()
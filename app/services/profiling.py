@@ -0,0 +1,240 @@
+"""
+On-demand CPU and memory profiling of a live worker.
+
+Nothing here runs unless PROFILING_ENABLED is set, in which case main.py
+mounts the /debug routes and RequestProfilerMiddleware. Even then nothing
+is sampled or traced until a superuser asks for it:
+
+- `sample_cpu` samples the event loop thread's stack from another thread
+  for N seconds and returns the stacks in collapsed form, ready for
+  flamegraph.pl or speedscope.
+- A request sent by a superuser with an `X-Profile: 1` header runs under
+  cProfile. The pstats file is written to PROFILE_DIR, which all workers
+  on the host share, and its ID is returned in the `X-Profile-Id` header.
+  cProfile sees the whole thread, so requests served concurrently show
+  up in the profile too.
+- `memory` starts and stops tracemalloc, takes snapshots, and diffs them.
+
+Each worker profiles only itself; responses carry the worker's PID.
+"""
+
+import cProfile
+import io
+import logging
+import os
+import pstats
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import uuid
+from collections import Counter, OrderedDict
+from typing import List, Optional
+
+from fastapi import HTTPException
+from starlette.concurrency import run_in_threadpool
+
+from app.services import auth
+
+logger = logging.getLogger(__name__)
+
+PROFILING_ENABLED = os.getenv("PROFILING_ENABLED", "false").lower() == "true"
+PROFILE_DIR = os.getenv("PROFILE_DIR", os.path.join(tempfile.gettempdir(), "summit-profiles"))
+PROFILE_MAX_SECONDS = float(os.getenv("PROFILE_MAX_SECONDS", "60"))
+PROFILE_SAMPLE_INTERVAL_MS = float(os.getenv("PROFILE_SAMPLE_INTERVAL_MS", "5"))
+TRACEMALLOC_MAX_SNAPSHOTS = int(os.getenv("TRACEMALLOC_MAX_SNAPSHOTS", "10"))
+
+_cpu_lock = threading.Lock()
+_request_profile_active = False
+
+
+def _frame_label(frame) -> str:
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+def sample_stacks(thread_id: int, seconds: float, interval: float) -> Counter:
+    """
+    Sample the stack of a thread at a fixed interval.
+
+    Runs in a separate thread; the sampled thread keeps running.
+
+    Returns:
+        Counter: Number of samples per root-first stack
+    """
+    stacks: Counter = Counter()
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        frame = sys._current_frames().get(thread_id)
+        if frame is None:
+            break
+        labels = []
+        while frame is not None:
+            labels.append(_frame_label(frame))
+            frame = frame.f_back
+        stacks[";".join(reversed(labels))] += 1
+        time.sleep(interval)
+    return stacks
+
+
+def collapsed(stacks: Counter) -> str:
+    return "".join(f"{stack} {count}\n" for stack, count in stacks.most_common())
+
+
+async def sample_cpu(seconds: float) -> str:
+    """
+    Profile the event loop thread of this worker for `seconds`.
+
+    Returns:
+        str: Collapsed stacks, one "frame;frame;... count" line per stack
+    """
+    if not 0 < seconds <= PROFILE_MAX_SECONDS:
+        raise HTTPException(status_code=400, detail=f"Seconds must be between 0 and {PROFILE_MAX_SECONDS:g}")
+    if not _cpu_lock.acquire(blocking=False):
+        raise HTTPException(status_code=409, detail="A CPU profile is already running")
+    try:
+        loop_thread = threading.get_ident()
+        stacks = await run_in_threadpool(
+            sample_stacks, loop_thread, seconds, PROFILE_SAMPLE_INTERVAL_MS / 1000
+        )
+    finally:
+        _cpu_lock.release()
+    logger.info("CPU profile of %.1fs collected %s samples", seconds, sum(stacks.values()))
+    return collapsed(stacks)
+
+
+def profile_path(profile_id: str) -> str:
+    if not profile_id.isalnum():
+        raise HTTPException(status_code=400, detail="Invalid profile ID")
+    return os.path.join(PROFILE_DIR, f"{profile_id}.pstats")
+
+
+def read_profile(profile_id: str, sort: str = "cumulative", limit: int = 50) -> str:
+    """Render a stored request profile as a pstats text report."""
+    path = profile_path(profile_id)
+    if not os.path.exists(path):
+        raise HTTPException(status_code=404, detail="Profile not found")
+    if sort not in ("cumulative", "tottime", "calls"):
+        raise HTTPException(status_code=400, detail="Invalid sort order")
+    out = io.StringIO()
+    pstats.Stats(path, stream=out).sort_stats(sort).print_stats(limit)
+    return out.getvalue()
+
+
+def _is_superuser_request(scope) -> bool:
+    headers = dict(scope.get("headers", []))
+    if headers.get(b"x-profile") != b"1":
+        return False
+    scheme, _, token = headers.get(b"authorization", b"").decode("latin-1").partition(" ")
+    if scheme.lower() != "bearer" or not token:
+        return False
+    try:
+        return auth.decode_token(token, "access").is_superuser
+    except HTTPException:
+        return False
+
+
+class RequestProfilerMiddleware:
+    """ASGI middleware running superuser requests marked `X-Profile: 1` under cProfile."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        global _request_profile_active
+        if scope["type"] != "http" or _request_profile_active or not _is_superuser_request(scope):
+            await self.app(scope, receive, send)
+            return
+
+        profile_id = uuid.uuid4().hex
+
+        async def send_with_id(message):
+            if message["type"] == "http.response.start":
+                headers = list(message.get("headers", []))
+                headers.append((b"x-profile-id", profile_id.encode()))
+                headers.append((b"x-profile-pid", str(os.getpid()).encode()))
+                message = {**message, "headers": headers}
+            await send(message)
+
+        profiler = cProfile.Profile()
+        _request_profile_active = True
+        profiler.enable()
+        try:
+            await self.app(scope, receive, send_with_id)
+        finally:
+            profiler.disable()
+            _request_profile_active = False
+            os.makedirs(PROFILE_DIR, exist_ok=True)
+            profiler.dump_stats(profile_path(profile_id))
+
+
+class MemoryTracer:
+    """tracemalloc snapshots of this worker, kept in memory."""
+
+    def __init__(self, max_snapshots: int = TRACEMALLOC_MAX_SNAPSHOTS):
+        self.max_snapshots = max_snapshots
+        self.snapshots: "OrderedDict[str, tracemalloc.Snapshot]" = OrderedDict()
+
+    def start(self, frames: int = 25) -> dict:
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(frames)
+        return self.status()
+
+    def stop(self) -> dict:
+        tracemalloc.stop()
+        self.snapshots.clear()
+        return self.status()
+
+    def status(self) -> dict:
+        current, peak = tracemalloc.get_traced_memory()
+        return {
+            "pid": os.getpid(),
+            "tracing": tracemalloc.is_tracing(),
+            "traced_bytes": current,
+            "peak_bytes": peak,
+            "snapshots": list(self.snapshots),
+        }
+
+    def _take(self) -> tracemalloc.Snapshot:
+        if not tracemalloc.is_tracing():
+            raise HTTPException(status_code=409, detail="tracemalloc is not running")
+        return tracemalloc.take_snapshot().filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+        ))
+
+    def _get(self, snapshot_id: str) -> tracemalloc.Snapshot:
+        snapshot = self.snapshots.get(snapshot_id)
+        if snapshot is None:
+            raise HTTPException(status_code=404, detail="Snapshot not found")
+        return snapshot
+
+    def snapshot(self, limit: int = 25) -> dict:
+        """Take and keep a snapshot, returning its largest allocation sites."""
+        snapshot = self._take()
+        snapshot_id = uuid.uuid4().hex[:12]
+        self.snapshots[snapshot_id] = snapshot
+        while len(self.snapshots) > self.max_snapshots:
+            self.snapshots.popitem(last=False)
+        return {
+            "id": snapshot_id,
+            "pid": os.getpid(),
+            "top": [str(stat) for stat in snapshot.statistics("lineno")[:limit]],
+        }
+
+    def diff(self, base_id: str, against_id: Optional[str] = None, limit: int = 25) -> dict:
+        """Compare a kept snapshot with another one, or with memory right now."""
+        base = self._get(base_id)
+        against = self._get(against_id) if against_id else self._take()
+        stats: List[tracemalloc.StatisticDiff] = against.compare_to(base, "lineno")
+        return {
+            "pid": os.getpid(),
+            "base": base_id,
+            "against": against_id or "now",
+            "size_diff_bytes": sum(stat.size_diff for stat in stats),
+            "top": [str(stat) for stat in stats[:limit]],
+        }
+
+
+memory = MemoryTracer()
@@ -0,0 +1,176 @@
+"""
+Background purge of deleted users.
+
+`delete_user` only stamps `users.deleted_at`. Every USER_PURGE_INTERVAL
+seconds this task takes up to USER_PURGE_USERS_PER_BATCH deleted users and
+removes their dependent rows table by table, at most USER_PURGE_ROWS_PER_BATCH
+rows per statement, before deleting the users themselves. Every statement
+commits on its own, so no lock is held for longer than one small batch and
+a purge interrupted part-way simply resumes on the next run. Each shard
+purges the users it holds, whose dependent rows live on the same shard.
+Only one worker purges a shard at a time, holding a session advisory lock
+on a connection of its own while the purge statements run; the others
+skip the shard rather than deleting the same batch twice.
+
+Purged users' emails and usernames are then released from the user
+directory on the default connection, along with claims that create_user
+left behind without a user for longer than USER_DIRECTORY_CLAIM_TIMEOUT.
+"""
+
+import logging
+import os
+import time
+from typing import List, Tuple
+
+from tortoise import Tortoise
+
+from app.database import SHARD_CONNECTIONS
+from app.services import background, metrics
+from app.services.entitlements import snapshot as entitlement_snapshot
+
+logger = logging.getLogger(__name__)
+
+USER_PURGE_INTERVAL = float(os.getenv("USER_PURGE_INTERVAL", "10"))
+USER_PURGE_USERS_PER_BATCH = int(os.getenv("USER_PURGE_USERS_PER_BATCH", "100"))
+USER_PURGE_ROWS_PER_BATCH = int(os.getenv("USER_PURGE_ROWS_PER_BATCH", "1000"))
+USER_DIRECTORY_CLAIM_TIMEOUT = float(os.getenv("USER_DIRECTORY_CLAIM_TIMEOUT", "3600"))
+
+# Arbitrary key for the advisory lock that keeps purges of a shard from overlapping
+PURGE_LOCK_ID = 740_032
+
+# (table, column holding the user's id, SQL type of the ids passed in)
+# The tables after otp_system key users by the string form of their ID.
+DEPENDENT_TABLES = [
+    ("otp_system", "user_id", "int"),
+    ("usersubscription", "user", "varchar"),
+    ("quota_reservation", "user", "varchar"),
+    ("quota", "user", "varchar"),
+    ("usage_event", "user", "varchar"),
+    ("usage_daily_user", "user", "varchar"),
+]
+
+DELETED_USERS_SQL = """
+    SELECT "id" FROM "users" WHERE "deleted_at" IS NOT NULL
+    ORDER BY "deleted_at" LIMIT $1
+"""
+
+BACKLOG_SQL = 'SELECT count(*) AS "backlog" FROM "users" WHERE "deleted_at" IS NOT NULL'
+
+DELETE_USERS_SQL = """
+    WITH purged AS (
+        DELETE FROM "users" WHERE "id" = ANY($1::int[]) AND "deleted_at" IS NOT NULL
+        RETURNING "id"
+    )
+    SELECT count(*) AS "deleted" FROM purged
+"""
+
+RELEASE_DIRECTORY_SQL = 'DELETE FROM "user_directory" WHERE "user_id" = ANY($1::int[])'
+
+STALE_CLAIMS_SQL = """
+    DELETE FROM "user_directory"
+    WHERE "user_id" IS NULL AND "created_at" < now() - make_interval(secs => $1)
+"""
+
+_users_purged = metrics.counter("purge.users")
+_rows_deleted = {table: metrics.counter(f"purge.rows.{table}") for table, _, _ in DEPENDENT_TABLES}
+_backlog = metrics.gauge("purge.backlog")
+_batch_latency = metrics.summary("purge.batch_latency_ms")
+_throughput = metrics.gauge("purge.last_run_rows_per_second")
+
+
+def _delete_batch_sql(table: str, column: str, key_type: str) -> str:
+    return f"""
+        WITH purged AS (
+            DELETE FROM "{table}" WHERE "id" IN (
+                SELECT "id" FROM "{table}" WHERE "{column}" = ANY($1::{key_type}[]) LIMIT $2
+            )
+            RETURNING 1
+        )
+        SELECT count(*) AS "deleted" FROM purged
+    """
+
+
+async def _delete_in_batches(conn, table: str, column: str, key_type: str, keys: List) -> int:
+    sql = _delete_batch_sql(table, column, key_type)
+    total = 0
+    while True:
+        started = time.perf_counter()
+        rows = await conn.execute_query_dict(sql, [keys, USER_PURGE_ROWS_PER_BATCH])
+        _batch_latency.observe((time.perf_counter() - started) * 1000)
+        deleted = rows[0]["deleted"]
+        total += deleted
+        _rows_deleted[table].inc(deleted)
+        if deleted < USER_PURGE_ROWS_PER_BATCH:
+            return total
+
+
+async def _purge_shard(conn) -> Tuple[int, int, int]:
+    async with conn.acquire_connection() as lock_conn:
+        if not await lock_conn.fetchval("SELECT pg_try_advisory_lock($1)", PURGE_LOCK_ID):
+            logger.info("Purge of shard %s already running elsewhere, skipping", conn.connection_name)
+            return 0, 0, 0
+        try:
+            return await _purge_shard_batches(conn)
+        finally:
+            await lock_conn.execute("SELECT pg_advisory_unlock($1)", PURGE_LOCK_ID)
+
+
+async def _purge_shard_batches(conn) -> Tuple[int, int, int]:
+    purged_users = 0
+    purged_rows = 0
+
+    while True:
+        rows = await conn.execute_query_dict(DELETED_USERS_SQL, [USER_PURGE_USERS_PER_BATCH])
+        user_ids = [row["id"] for row in rows]
+        if not user_ids:
+            break
+
+        for table, column, key_type in DEPENDENT_TABLES:
+            keys = user_ids if key_type == "int" else [str(user_id) for user_id in user_ids]
+            purged_rows += await _delete_in_batches(conn, table, column, key_type, keys)
+
+        deleted = (await conn.execute_query_dict(DELETE_USERS_SQL, [user_ids]))[0]["deleted"]
+        await Tortoise.get_connection("default").execute_query(RELEASE_DIRECTORY_SQL, [user_ids])
+        purged_users += deleted
+        purged_rows += deleted
+        _users_purged.inc(deleted)
+
+        for user_id in user_ids:
+            entitlement_snapshot.plan_ranks.pop(str(user_id), None)
+            entitlement_snapshot.quotas.pop(str(user_id), None)
+
+        if len(user_ids) < USER_PURGE_USERS_PER_BATCH:
+            break
+
+    backlog = (await conn.execute_query_dict(BACKLOG_SQL))[0]["backlog"]
+    return purged_users, purged_rows, backlog
+
+
+async def purge_deleted_users() -> int:
+    """
+    Remove deleted users and their dependent rows, on every shard.
+
+    Returns:
+        int: The number of users purged
+    """
+    started = time.perf_counter()
+    purged_users = purged_rows = backlog = 0
+    for name in SHARD_CONNECTIONS:
+        users, rows, shard_backlog = await _purge_shard(Tortoise.get_connection(name))
+        purged_users += users
+        purged_rows += rows
+        backlog += shard_backlog
+
+    await Tortoise.get_connection("default").execute_query(STALE_CLAIMS_SQL, [USER_DIRECTORY_CLAIM_TIMEOUT])
+    _backlog.set(backlog)
+    elapsed = time.perf_counter() - started
+    if purged_rows:
+        _throughput.set(round(purged_rows / elapsed, 1))
+        logger.info(
+            "Purged %s deleted users (%s rows) in %.2fs (%.0f rows/s)",
+            purged_users, purged_rows, elapsed, purged_rows / elapsed,
+        )
+    return purged_users
+
+
+background.periodic("user-purge", USER_PURGE_INTERVAL)(purge_deleted_users)
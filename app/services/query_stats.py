@@ -0,0 +1,126 @@
+"""
+Per-request accounting of database queries.
+
+`install()` wraps the single method every Tortoise asyncpg query passes
+through, so ORM calls and raw SQL alike are counted. While a request is
+being served, a QueryStats object in a context variable adds up how many
+SQL statements ran and how long they took, pool waits included; starting
+a transaction is not counted as a statement. Queries made
+outside a request, e.g. by background tasks, are not counted.
+
+QueryAccountingMiddleware reports the totals in a Server-Timing header
+and logs requests that make more than SLOW_REQUEST_QUERY_COUNT queries or
+spend more than SLOW_REQUEST_DB_MS in the database.
+"""
+
+import logging
+import os
+import time
+from contextvars import ContextVar
+from typing import Optional
+
+from tortoise.backends.asyncpg.client import AsyncpgDBClient
+
+from app.services import metrics
+
+logger = logging.getLogger(__name__)
+
+QUERY_ACCOUNTING_ENABLED = os.getenv("QUERY_ACCOUNTING_ENABLED", "true").lower() == "true"
+SERVER_TIMING_ENABLED = os.getenv("SERVER_TIMING_ENABLED", "true").lower() == "true"
+SLOW_REQUEST_QUERY_COUNT = int(os.getenv("SLOW_REQUEST_QUERY_COUNT", "20"))
+SLOW_REQUEST_DB_MS = float(os.getenv("SLOW_REQUEST_DB_MS", "200"))
+
+
+class QueryStats:
+    __slots__ = ("count", "seconds", "slowest_seconds", "slowest_query")
+
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+        self.slowest_seconds = 0.0
+        self.slowest_query: Optional[str] = None
+
+    def add(self, query: Optional[str], seconds: float) -> None:
+        self.count += 1
+        self.seconds += seconds
+        if seconds > self.slowest_seconds:
+            self.slowest_seconds = seconds
+            self.slowest_query = query
+
+
+current: ContextVar[Optional[QueryStats]] = ContextVar("query_stats", default=None)
+
+_queries_per_request = metrics.summary("http.db_queries_per_request")
+_db_ms_per_request = metrics.summary("http.db_ms_per_request")
+_slow_requests = metrics.counter("http.slow_db_requests")
+
+_original_translate_exceptions = AsyncpgDBClient._translate_exceptions
+
+
+async def _counted_translate_exceptions(self, func, *args, **kwargs):
+    stats = current.get()
+    # Starting a transaction passes through here too, without any SQL
+    query = args[0] if args else kwargs.get("query")
+    if stats is None or not isinstance(query, str):
+        return await _original_translate_exceptions(self, func, *args, **kwargs)
+
+    started = time.perf_counter()
+    try:
+        return await _original_translate_exceptions(self, func, *args, **kwargs)
+    finally:
+        stats.add(query, time.perf_counter() - started)
+
+
+def install() -> None:
+    """Start counting the queries every Tortoise asyncpg connection runs."""
+    if QUERY_ACCOUNTING_ENABLED:
+        AsyncpgDBClient._translate_exceptions = _counted_translate_exceptions
+
+
+def server_timing(stats: QueryStats, total_seconds: float) -> str:
+    return (
+        f'db;desc="{stats.count} queries";dur={stats.seconds * 1000:.2f}, '
+        f"total;dur={total_seconds * 1000:.2f}"
+    )
+
+
+class QueryAccountingMiddleware:
+    """ASGI middleware that reports the database work of each HTTP request."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not QUERY_ACCOUNTING_ENABLED:
+            await self.app(scope, receive, send)
+            return
+
+        stats = QueryStats()
+        token = current.set(stats)
+        started = time.perf_counter()
+
+        async def send_with_timing(message):
+            if message["type"] == "http.response.start" and SERVER_TIMING_ENABLED:
+                headers = list(message.get("headers", []))
+                value = server_timing(stats, time.perf_counter() - started)
+                headers.append((b"server-timing", value.encode("latin-1")))
+                message = {**message, "headers": headers}
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            current.reset(token)
+            self._report(scope, stats, time.perf_counter() - started)
+
+    def _report(self, scope, stats: QueryStats, total_seconds: float) -> None:
+        db_ms = stats.seconds * 1000
+        _queries_per_request.observe(stats.count)
+        _db_ms_per_request.observe(db_ms)
+        if stats.count > SLOW_REQUEST_QUERY_COUNT or db_ms > SLOW_REQUEST_DB_MS:
+            _slow_requests.inc()
+            logger.warning(
+                "%s %s made %s queries taking %.1fms of %.1fms; slowest %.1fms: %.200s",
+                scope["method"], scope["path"], stats.count, db_ms, total_seconds * 1000,
+                stats.slowest_seconds * 1000, stats.slowest_query,
+            )
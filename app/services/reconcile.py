@@ -0,0 +1,397 @@
+"""
+Reconciliation of local subscriptions with Stripe.
+
+Webhooks that are lost or fail for good leave UserSubscription and Quota
+behind Stripe. This job brings them back in line without fetching
+subscriptions one at a time:
+
+- A full sync walks every Stripe subscription with cursor pagination. Its
+  cursor is saved after every batch, so an interrupted full sync resumes
+  where it stopped.
+- Later runs only replay the customer.subscription.* events created after
+  the stored high-water mark. Stripe cannot filter subscriptions by update
+  time, and its events carry the subscription as it was when it changed.
+  Events are only kept for 30 days, so a high-water mark older than that
+  falls back to a full sync.
+
+Differences are written STRIPE_RECONCILE_BATCH_SIZE subscriptions at a
+time with one statement per batch, which also provisions the matching
+quota. Rows that already match Stripe are left untouched. Each batch is
+split by the shard of its users, and subscriptions created without
+metadata are matched to their users on every shard. The sync state and
+the lock that keeps runs from overlapping live on the default connection.
+"""
+
+import asyncio
+import logging
+import os
+import sys
+import time
+from datetime import datetime, timezone
+from decimal import Decimal
+from typing import Dict, List, Mapping, Optional
+
+import stripe
+from tortoise import Tortoise
+
+from app.models.subscription import SUBSCRIPTION_TYPES, SyncState
+from app.services import background, metrics, plans, shards
+from app.services.sub_process import ACTIVE_STATUSES, stripe_api
+from app.services.usage import accumulator as usage_accumulator
+
+logger = logging.getLogger(__name__)
+
+STRIPE_RECONCILE_INTERVAL = float(os.getenv("STRIPE_RECONCILE_INTERVAL", "900"))
+STRIPE_RECONCILE_BATCH_SIZE = int(os.getenv("STRIPE_RECONCILE_BATCH_SIZE", "500"))
+STRIPE_PAGE_SIZE = 100
+# Stripe keeps events for 30 days; stay clear of the edge
+STRIPE_EVENT_RETENTION = 29 * 24 * 3600
+# Events created in the same second as the high-water mark may not have
+# been listed yet when it was taken, so each run re-reads this window.
+STRIPE_EVENT_OVERLAP = 60
+
+EVENT_HWM_KEY = "stripe_reconcile.event_created"
+FULL_SYNC_CURSOR_KEY = "stripe_reconcile.full_sync_cursor"
+# Arbitrary key for the advisory lock that keeps runs from overlapping
+RECONCILE_LOCK_ID = 740_034
+
+SUBSCRIPTION_EVENTS = [
+    "customer.subscription.created",
+    "customer.subscription.updated",
+    "customer.subscription.deleted",
+]
+
+LOCAL_USERS_SQL = """
+    SELECT "stripe_subscription_id", "user" FROM "usersubscription"
+    WHERE "stripe_subscription_id" = ANY($1::varchar[])
+"""
+
+UPSERT_SQL = """
+    WITH incoming AS (
+        SELECT * FROM unnest(
+            $1::varchar[], $2::varchar[], $3::varchar[], $4::bool[],
+            $5::timestamptz[], $6::timestamptz[], $7::varchar[], $11::numeric[]
+        ) AS t("user", "subscription_plan", "subscription_frequency", "is_active",
+               "start_date", "end_date", "stripe_subscription_id", "price")
+    ), updated AS (
+        UPDATE "usersubscription" AS s
+        SET "subscription_plan" = i."subscription_plan",
+            "subscription_frequency" = i."subscription_frequency",
+            "is_active" = i."is_active",
+            "start_date" = i."start_date",
+            "end_date" = i."end_date",
+            "stripe_subscription_id" = i."stripe_subscription_id",
+            "price" = i."price",
+            "updated_at" = now()
+        FROM incoming AS i
+        WHERE s."user" = i."user"
+          -- an old, ended subscription must not replace a newer active one
+          AND (i."is_active" OR NOT s."is_active"
+               OR s."stripe_subscription_id" IS NOT DISTINCT FROM i."stripe_subscription_id")
+          AND (s."subscription_plan", s."subscription_frequency", s."is_active",
+               s."end_date", s."stripe_subscription_id", s."price")
+              IS DISTINCT FROM
+              (i."subscription_plan", i."subscription_frequency", i."is_active",
+               i."end_date", i."stripe_subscription_id", i."price")
+        RETURNING s."user", s."subscription_plan", s."subscription_frequency", s."is_active"
+    ), inserted AS (
+        INSERT INTO "usersubscription"
+            ("user", "subscription_plan", "subscription_frequency", "is_active",
+             "start_date", "end_date", "stripe_subscription_id", "price", "updated_at")
+        SELECT i."user", i."subscription_plan", i."subscription_frequency", i."is_active",
+               i."start_date", i."end_date", i."stripe_subscription_id", i."price", now()
+        FROM incoming AS i
+        WHERE NOT EXISTS (SELECT 1 FROM "usersubscription" AS s WHERE s."user" = i."user")
+        -- a webhook inserting the same user concurrently wins; the next run catches up
+        ON CONFLICT ("user") DO NOTHING
+        RETURNING "user", "subscription_plan", "subscription_frequency", "is_active"
+    ), changed AS (
+        SELECT * FROM updated UNION ALL SELECT * FROM inserted
+    ), wanted AS (
+        SELECT c."user", CASE WHEN c."is_active" THEN l."total" ELSE $10 END AS "total"
+        FROM changed AS c
+        LEFT JOIN unnest($8::varchar[], $12::varchar[], $9::int[]) AS l("plan", "frequency", "total")
+            ON l."plan" = lower(c."subscription_plan") AND l."frequency" = lower(c."subscription_frequency")
+    ), quota_updated AS (
+        UPDATE "quota" AS q
+        SET "total" = w."total", "used" = 0, "checkpoint_at" = now(),
+            "checkpoint_txid" = pg_current_xact_id()::text::bigint, "updated_at" = now()
+        FROM wanted AS w
+        WHERE q."user" = w."user" AND w."total" IS NOT NULL AND q."total" <> w."total"
+        RETURNING q."id"
+    ), quota_inserted AS (
+        INSERT INTO "quota" ("user", "total", "used", "created_at", "updated_at")
+        SELECT w."user", w."total", 0, now(), now()
+        FROM wanted AS w
+        WHERE w."total" IS NOT NULL
+          AND NOT EXISTS (SELECT 1 FROM "quota" AS q WHERE q."user" = w."user")
+        ON CONFLICT ("user") DO NOTHING
+        RETURNING "id"
+    )
+    SELECT
+        (SELECT coalesce(array_agg("user"), '{}') FROM changed) AS "users",
+        (SELECT count(*) FROM updated) AS "updated",
+        (SELECT count(*) FROM inserted) AS "inserted",
+        (SELECT count(*) FROM quota_updated) + (SELECT count(*) FROM quota_inserted) AS "quotas"
+"""
+
+_read = metrics.counter("reconcile.stripe_objects_read")
+_updated = metrics.counter("reconcile.subscriptions_updated")
+_inserted = metrics.counter("reconcile.subscriptions_inserted")
+_quotas = metrics.counter("reconcile.quotas_changed")
+_skipped = metrics.counter("reconcile.skipped")
+_batch_latency = metrics.summary("reconcile.batch_latency_ms")
+_lag = metrics.gauge("reconcile.high_water_mark_age_seconds")
+
+
+def _timestamp(value) -> Optional[datetime]:
+    return datetime.fromtimestamp(int(value), timezone.utc) if value else None
+
+
+def subscription_row(subscription, user: Optional[str], price_plans: Mapping[str, str]) -> Optional[dict]:
+    """
+    Translate a Stripe subscription into a usersubscription row.
+
+    Args:
+        subscription: The Stripe subscription object or its dict form
+        user (str, optional): The local user ID, if not in the metadata
+        price_plans (dict): Stripe price ID to plan name
+
+    Returns:
+        dict: The row, or None if the subscription can not be attributed
+    """
+    metadata = subscription.get("metadata") or {}
+    user = metadata.get("user_id") or user
+    items = (subscription.get("items") or {}).get("data") or []
+    if not user or not items:
+        return None
+
+    item = items[0]
+    price = item.get("price") or {}
+    plan = metadata.get("subscription_plan") or price_plans.get(price.get("id"))
+    if plan not in SUBSCRIPTION_TYPES:
+        return None
+
+    interval = (price.get("recurring") or {}).get("interval")
+    frequency = metadata.get("subscription_frequency") or ("yearly" if interval == "year" else "monthly")
+
+    return {
+        "user": str(user),
+        "subscription_plan": plan,
+        "subscription_frequency": frequency,
+        "is_active": subscription.get("status") in ACTIVE_STATUSES,
+        "start_date": _timestamp(item.get("current_period_start") or subscription.get("start_date")),
+        "end_date": _timestamp(item.get("current_period_end")),
+        "stripe_subscription_id": subscription["id"],
+        "price": Decimal(price["unit_amount"]) / 100 if price.get("unit_amount") is not None else None,
+        "created": subscription.get("created") or 0,
+    }
+
+
+class Reconciler:
+    def __init__(self, batch_size: int = STRIPE_RECONCILE_BATCH_SIZE):
+        self.batch_size = batch_size
+
+    async def _attribute(self, subscriptions: List) -> List[dict]:
+        """Build rows, looking up users of subscriptions created without metadata."""
+        unattributed = [
+            s["id"] for s in subscriptions if not (s.get("metadata") or {}).get("user_id")
+        ]
+        local_users = {}
+        if unattributed:
+            for rows in await shards.fan_out(lambda db: db.execute_query_dict(LOCAL_USERS_SQL, [unattributed])):
+                local_users.update({row["stripe_subscription_id"]: row["user"] for row in rows})
+
+        price_plans = plans.price_plans()
+        rows = []
+        for subscription in subscriptions:
+            row = subscription_row(subscription, local_users.get(subscription["id"]), price_plans)
+            if row is None or not str(row["user"]).isdigit():
+                _skipped.inc()
+            else:
+                rows.append(row)
+        return rows
+
+    async def _write(self, subscriptions: List) -> int:
+        """
+        Apply one batch of Stripe subscriptions.
+
+        Returns:
+            int: The number of usersubscription rows changed
+        """
+        rows = await self._attribute(subscriptions)
+
+        # One row per user: an active subscription wins, then the newest
+        by_user: Dict[str, dict] = {}
+        for row in rows:
+            current = by_user.get(row["user"])
+            if current is None or (row["is_active"], row["created"]) > (current["is_active"], current["created"]):
+                by_user[row["user"]] = row
+        if not by_user:
+            return 0
+
+        by_shard: Dict[str, List[dict]] = {}
+        for row in by_user.values():
+            by_shard.setdefault(shards.name_for_user(row["user"]), []).append(row)
+
+        changed = 0
+        for name, rows in by_shard.items():
+            changed += await self._write_shard(Tortoise.get_connection(name), rows)
+        return changed
+
+    async def _write_shard(self, conn, rows: List[dict]) -> int:
+        columns = ["user", "subscription_plan", "subscription_frequency", "is_active",
+                   "start_date", "end_date", "stripe_subscription_id"]
+        params = [[row[column] for row in rows] for column in columns]
+        catalog = list(plans.all_plans())
+        params += [[plan.plan for plan in catalog], [plan.quota for plan in catalog], plans.quota("free")]
+        params.append([row["price"] for row in rows])
+        params.append([plan.frequency for plan in catalog])
+
+        started = time.perf_counter()
+        result = (await conn.execute_query_dict(UPSERT_SQL, params))[0]
+        _batch_latency.observe((time.perf_counter() - started) * 1000)
+
+        _updated.inc(result["updated"])
+        _inserted.inc(result["inserted"])
+        _quotas.inc(result["quotas"])
+        for user in result["users"]:
+            usage_accumulator.invalidate(user)
+        return len(result["users"])
+
+    async def _list(self, resource, **params):
+        return await stripe_api.call(resource.list, limit=STRIPE_PAGE_SIZE, idempotent=True, **params)
+
+    async def full_sync(self, cursor: Optional[str] = None) -> int:
+        """Walk every Stripe subscription, resuming after `cursor`."""
+        started_at = int(time.time())
+        changed = 0
+        batch = []
+        while True:
+            params = {"status": "all"}
+            if cursor:
+                params["starting_after"] = cursor
+            page = await self._list(stripe.Subscription, **params)
+            batch.extend(page.data)
+            _read.inc(len(page.data))
+            if page.data:
+                cursor = page.data[-1]["id"]
+
+            if len(batch) >= self.batch_size or not page.has_more:
+                changed += await self._write(batch)
+                batch = []
+                if page.has_more:
+                    await _save_state(FULL_SYNC_CURSOR_KEY, cursor)
+            if not page.has_more:
+                break
+
+        await SyncState.filter(key=FULL_SYNC_CURSOR_KEY).delete()
+        # Changes made while the walk was running are replayed from events
+        await _save_state(EVENT_HWM_KEY, str(started_at))
+        return changed
+
+    async def delta_sync(self, since: int) -> int:
+        """Replay subscription events created after `since`."""
+        newest = since
+        changed = 0
+        seen = set()
+        batch = []
+        cursor = None
+        while True:
+            params = {"types": SUBSCRIPTION_EVENTS, "created": {"gt": since - STRIPE_EVENT_OVERLAP}}
+            if cursor:
+                params["starting_after"] = cursor
+            page = await self._list(stripe.Event, **params)
+
+            # Events arrive newest first, so the first one seen for a
+            # subscription carries its current state.
+            for event in page.data:
+                newest = max(newest, event["created"])
+                subscription = event["data"]["object"]
+                if subscription["id"] not in seen:
+                    seen.add(subscription["id"])
+                    batch.append(subscription)
+            _read.inc(len(page.data))
+            if page.data:
+                cursor = page.data[-1]["id"]
+
+            if len(batch) >= self.batch_size or not page.has_more:
+                changed += await self._write(batch)
+                batch = []
+            if not page.has_more:
+                break
+
+        await _save_state(EVENT_HWM_KEY, str(newest))
+        return changed
+
+    async def run(self, full: bool = False) -> int:
+        """
+        Reconcile local subscriptions with Stripe.
+
+        Only one worker reconciles at a time; the others skip the run.
+
+        Args:
+            full (bool): Walk every subscription even if deltas would do
+
+        Returns:
+            int: The number of subscriptions changed locally
+        """
+        client = Tortoise.get_connection("default")
+        async with client.acquire_connection() as lock_conn:
+            if not await lock_conn.fetchval("SELECT pg_try_advisory_lock($1)", RECONCILE_LOCK_ID):
+                logger.info("Stripe reconciliation already running elsewhere, skipping")
+                return 0
+            try:
+                started = time.perf_counter()
+                state = await _load_state()
+                since = int(state.get(EVENT_HWM_KEY, 0))
+                cursor = state.get(FULL_SYNC_CURSOR_KEY)
+
+                if full or cursor or time.time() - since > STRIPE_EVENT_RETENTION:
+                    mode = "full"
+                    changed = await self.full_sync(None if full else cursor)
+                else:
+                    mode = "delta"
+                    changed = await self.delta_sync(since)
+
+                hwm = int((await _load_state()).get(EVENT_HWM_KEY, 0))
+                _lag.set(round(time.time() - hwm))
+                logger.info(
+                    "Stripe %s reconciliation changed %s subscriptions in %.2fs",
+                    mode, changed, time.perf_counter() - started,
+                )
+                return changed
+            finally:
+                await lock_conn.execute("SELECT pg_advisory_unlock($1)", RECONCILE_LOCK_ID)
+
+
+async def _load_state() -> Dict[str, str]:
+    rows = await SyncState.filter(key__in=[EVENT_HWM_KEY, FULL_SYNC_CURSOR_KEY]).values("key", "value")
+    return {row["key"]: row["value"] for row in rows}
+
+
+async def _save_state(key: str, value: str) -> None:
+    await SyncState.update_or_create(key=key, defaults={"value": value})
+
+
+reconciler = Reconciler()
+background.periodic("stripe-reconcile", STRIPE_RECONCILE_INTERVAL)(reconciler.run)
+
+
+async def _main(full: bool) -> None:
+    from app.database import TORTOISE_ORM
+
+    stripe.api_key = os.getenv("STRIPE_SECRET_KEY")
+    await Tortoise.init(config=TORTOISE_ORM)
+    try:
+        print(f"Changed {await reconciler.run(full=full)} subscriptions")
+    finally:
+        await Tortoise.close_connections()
+
+
+if __name__ == "__main__":
+    # python -m app.services.reconcile [--full]
+    from app.services.logs import configure_logging
+
+    configure_logging()
+    asyncio.run(_main("--full" in sys.argv[1:]))
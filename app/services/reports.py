@@ -0,0 +1,162 @@
+"""
+Reporting queries served from pre-aggregated tables.
+
+Reports never scan quota, usersubscription or the usage ledger:
+
+- Daily usage per user and per plan is read from usage_daily_user and
+  usage_daily_plan, which the ledger checkpoint adds to incrementally.
+- Subscription counts and MRR per plan and frequency are read from the
+  subscription_rollup materialized view, refreshed CONCURRENTLY every
+  SUBSCRIPTION_ROLLUP_REFRESH_INTERVAL seconds so readers are never
+  blocked by a refresh.
+
+Each shard aggregates its own users, so every report sums the shards'
+figures, and a single user's report reads only that user's shard.
+"""
+
+import logging
+import os
+from datetime import date, datetime, timedelta, timezone
+from typing import Optional
+
+from fastapi import HTTPException
+from tortoise.transactions import in_transaction
+
+from app.database import SHARD_CONNECTIONS
+from app.models.subscription import SUBSCRIPTION_FREQUENCY, SyncState
+from app.services import background, metrics, shards
+
+logger = logging.getLogger(__name__)
+
+SUBSCRIPTION_ROLLUP_REFRESH_INTERVAL = float(os.getenv("SUBSCRIPTION_ROLLUP_REFRESH_INTERVAL", "300"))
+REPORT_MAX_DAYS = int(os.getenv("REPORT_MAX_DAYS", "400"))
+
+ROLLUP_REFRESHED_KEY = "reports.subscription_rollup_refreshed_at"
+# Arbitrary key for the advisory lock that keeps refreshes from queueing up
+ROLLUP_LOCK_ID = 740_036
+
+DAILY_PLAN_USAGE_SQL = """
+    SELECT "day", "plan", "units" FROM "usage_daily_plan"
+    WHERE "day" BETWEEN $1 AND $2
+    ORDER BY "day", "plan"
+"""
+
+DAILY_USER_USAGE_SQL = """
+    SELECT "day", "units" FROM "usage_daily_user"
+    WHERE "user" = $1 AND "day" BETWEEN $2 AND $3
+    ORDER BY "day"
+"""
+
+SUBSCRIPTION_ROLLUP_SQL = """
+    SELECT "subscription_plan", "subscription_frequency", "active", "total", "mrr"
+    FROM "subscription_rollup"
+    ORDER BY "subscription_plan", "subscription_frequency"
+"""
+
+_refresh_latency = metrics.summary("reports.rollup_refresh_ms")
+
+
+def _date_range(start: Optional[date], end: Optional[date]):
+    end = end or datetime.now(timezone.utc).date()
+    start = start or end - timedelta(days=29)
+    if start > end or (end - start).days >= REPORT_MAX_DAYS:
+        raise HTTPException(status_code=400, detail="Invalid date range")
+    return start, end
+
+
+async def refresh_subscription_rollup() -> None:
+    """Recompute every shard's subscription_rollup without blocking its readers."""
+    for name in SHARD_CONNECTIONS:
+        started = datetime.now(timezone.utc)
+        async with in_transaction(name) as conn:
+            locked = await conn.execute_query_dict(
+                'SELECT pg_try_advisory_xact_lock($1) AS "locked"', [ROLLUP_LOCK_ID]
+            )
+            if not locked[0]["locked"]:
+                continue
+            await conn.execute_script('REFRESH MATERIALIZED VIEW CONCURRENTLY "subscription_rollup"')
+            await SyncState.update_or_create(
+                key=ROLLUP_REFRESHED_KEY, defaults={"value": started.isoformat()}, using_db=conn
+            )
+        _refresh_latency.observe((datetime.now(timezone.utc) - started).total_seconds() * 1000)
+
+
+background.periodic("subscription-rollup-refresh", SUBSCRIPTION_ROLLUP_REFRESH_INTERVAL)(
+    refresh_subscription_rollup
+)
+
+
+async def get_daily_usage(start: Optional[date] = None, end: Optional[date] = None):
+    """
+    Get the units used per plan and day.
+
+    Args:
+        start (date, optional): First day, 30 days before `end` by default
+        end (date, optional): Last day, today by default
+
+    Returns:
+        dict: Units used per day, broken down by plan
+    """
+    start, end = _date_range(start, end)
+    days = {}
+    for rows in await shards.fan_out(lambda db: db.execute_query_dict(DAILY_PLAN_USAGE_SQL, [start, end])):
+        for row in rows:
+            plans = days.setdefault(row["day"].isoformat(), {})
+            plans[row["plan"]] = plans.get(row["plan"], 0) + row["units"]
+    days = dict(sorted(days.items()))
+    return {"start": start.isoformat(), "end": end.isoformat(), "days": days}
+
+
+async def get_user_daily_usage(user_id: int, start: Optional[date] = None, end: Optional[date] = None):
+    """
+    Get the units a user used per day.
+
+    Args:
+        user_id (int): The ID of the user
+        start (date, optional): First day, 30 days before `end` by default
+        end (date, optional): Last day, today by default
+
+    Returns:
+        dict: Units used per day
+    """
+    start, end = _date_range(start, end)
+    conn = shards.for_user(user_id)
+    rows = await conn.execute_query_dict(DAILY_USER_USAGE_SQL, [str(user_id), start, end])
+    return {
+        "start": start.isoformat(),
+        "end": end.isoformat(),
+        "days": {row["day"].isoformat(): row["units"] for row in rows},
+    }
+
+
+async def get_subscription_summary():
+    """
+    Get active subscriptions per plan and frequency, and MRR per frequency.
+
+    Returns:
+        dict: Subscription counts, MRR, and when the figures were computed
+    """
+    rows = [row for shard_rows in await shards.fan_out(
+        lambda db: db.execute_query_dict(SUBSCRIPTION_ROLLUP_SQL)
+    ) for row in shard_rows]
+    # The figures are as old as the least recently refreshed shard
+    refreshed = [await SyncState.get_or_none(key=ROLLUP_REFRESHED_KEY, using_db=db) for db in shards.all_shards()]
+
+    plans = {}
+    mrr = {frequency: 0.0 for frequency in SUBSCRIPTION_FREQUENCY}
+    for row in rows:
+        counts = plans.setdefault(row["subscription_plan"], {}).setdefault(
+            row["subscription_frequency"], {"active": 0, "total": 0}
+        )
+        counts["active"] += row["active"]
+        counts["total"] += row["total"]
+        frequency = row["subscription_frequency"]
+        mrr[frequency] = round(mrr.get(frequency, 0.0) + float(row["mrr"]), 2)
+
+    return {
+        "plans": plans,
+        "active": sum(row["active"] for row in rows),
+        "mrr": mrr,
+        "mrr_total": round(sum(mrr.values()), 2),
+        "refreshed_at": min(state.value for state in refreshed) if all(refreshed) else None,
+    }
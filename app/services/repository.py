@@ -0,0 +1,95 @@
+"""
+Fast path for the hottest lookups.
+
+The subscription, quota and user-by-email lookups run on most requests.
+Here they skip Tortoise's queryset compiler and model instantiation and run
+straight on the asyncpg connection behind the user's shard connection,
+inside the current transaction if there is one.
+
+Each statement is prepared once per pooled connection by asyncpg's statement
+cache, which also prepares it again after a migration invalidates it. Rows
+come back as Row records, which allow `row.field` as well as `row["field"]`,
+so they can stand in for model instances in read-only code.
+
+Lookups still count towards the request's query accounting. Writes, and
+every other query, stay on the ORM.
+"""
+
+import logging
+import time
+from typing import Optional
+
+import asyncpg
+from tortoise.backends.base.client import BaseDBAsyncClient
+
+from app.services import metrics, query_stats, shards
+
+logger = logging.getLogger(__name__)
+
+STATEMENTS = {
+    "subscription_by_user": """
+        SELECT "id", "user", "subscription_plan", "subscription_frequency", "start_date", "end_date",
+               "stripe_subscription_id", "price", "is_active", "updated_at"
+        FROM "usersubscription" WHERE "user" = $1
+        ORDER BY "id" LIMIT 1
+    """,
+    "quota_by_user": """
+        SELECT "id", "user", "total", "used", "checkpoint_at", "updated_at"
+        FROM "quota" WHERE "user" = $1
+        ORDER BY "id" LIMIT 1
+    """,
+    "user_by_email": """
+        SELECT "id", "email", "username", "hashed_password", "full_name", "is_active", "is_superuser",
+               "created_at", "updated_at", "deleted_at"
+        FROM "users" WHERE "email" = $1 AND "deleted_at" IS NULL
+    """,
+}
+
+_latency = {name: metrics.summary(f"repository.{name}_ms") for name in STATEMENTS}
+
+
+class Row(asyncpg.Record):
+    """asyncpg record that also exposes its columns as attributes."""
+
+    def __getattr__(self, name):
+        try:
+            return self[name]
+        except KeyError:
+            raise AttributeError(name) from None
+
+
+async def fetch_one(db: BaseDBAsyncClient, name: str, *args) -> Optional[Row]:
+    """
+    Run one of the STATEMENTS and return its first row.
+
+    Args:
+        db (BaseDBAsyncClient): The connection to run it on
+        name (str): Key of the statement in STATEMENTS
+
+    Returns:
+        Row: The first row, or None if there are no rows
+    """
+    sql = STATEMENTS[name]
+    stats = query_stats.current.get()
+    started = time.perf_counter()
+    async with db.acquire_connection() as connection:
+        row = await connection.fetchrow(sql, *args, record_class=Row)
+    elapsed = time.perf_counter() - started
+
+    _latency[name].observe(elapsed * 1000)
+    if stats is not None:
+        stats.add(sql, elapsed)
+    return row
+
+
+async def get_subscription(user_id) -> Optional[Row]:
+    return await fetch_one(shards.for_user(user_id), "subscription_by_user", str(user_id))
+
+
+async def get_quota(user_id) -> Optional[Row]:
+    return await fetch_one(shards.for_user(user_id), "quota_by_user", str(user_id))
+
+
+async def get_user_by_email(email: str) -> Optional[Row]:
+    rows = await shards.fan_out(lambda db: fetch_one(db, "user_by_email", email))
+    return next((row for row in rows if row is not None), None)
@@ -0,0 +1,225 @@
+"""
+Quota reservations for long-running jobs.
+
+A job that will consume an unknown number of units, up to a cap, reserves
+the cap before it starts and settles the reservation when it ends:
+
+- `reserve` holds units with a lease. It is one conditional UPDATE of the
+  user's quota row, which only succeeds while used + reserved + units stays
+  within the total, plus the INSERT of the reservation in the same
+  statement. The row lock taken by the UPDATE serialises concurrent
+  reservations of a user, so they can never overspend together.
+- `commit` charges the units the job actually used to the usage_event
+  ledger and returns the rest; `release` returns everything.
+- Leases that run out before they are settled are reclaimed in bulk by a
+  background task, which returns their units without charging them.
+
+Reserved units are kept in `quota.reserved` and count as used for metered
+actions (see app.services.usage) and entitlement checks. Reservations live
+on the shard of their user, next to the quota row they hold units of.
+"""
+
+import asyncio
+import logging
+import os
+import time
+import uuid
+
+from fastapi import HTTPException
+
+from app.services import background, metrics, shards
+from app.services.usage import DEFAULT_FEATURE, UNSETTLED, USAGE_SQL
+from app.services.usage import accumulator as usage_accumulator
+
+logger = logging.getLogger(__name__)
+
+QUOTA_RESERVATION_TTL = float(os.getenv("QUOTA_RESERVATION_TTL", "300"))
+QUOTA_RESERVATION_MAX_TTL = float(os.getenv("QUOTA_RESERVATION_MAX_TTL", "86400"))
+QUOTA_RESERVATION_REAP_INTERVAL = float(os.getenv("QUOTA_RESERVATION_REAP_INTERVAL", "30"))
+QUOTA_RESERVATION_REAP_BATCH_SIZE = int(os.getenv("QUOTA_RESERVATION_REAP_BATCH_SIZE", "1000"))
+
+# Usage since the checkpoint is summed from the ledger as in USAGE_SQL
+RESERVE_SQL = f"""
+    WITH held AS (
+        UPDATE "quota" AS q SET "reserved" = q."reserved" + $2, "updated_at" = now()
+        WHERE q."user" = $1
+          AND q."used" + q."reserved" + $2 + coalesce((
+              SELECT sum(e."units") FROM "usage_event" AS e
+              WHERE e."user" = q."user" AND {UNSETTLED}
+          ), 0) <= q."total"
+        RETURNING q."user"
+    )
+    INSERT INTO "quota_reservation" ("id", "user", "feature", "units", "expires_at", "created_at")
+    SELECT $3, "user", $4, $2, now() + make_interval(secs => $5), now() FROM held
+    RETURNING "id", "expires_at"
+"""
+
+# Settles an unexpired reservation, charging $3 of its units
+SETTLE_SQL = """
+    WITH lease AS (
+        DELETE FROM "quota_reservation"
+        WHERE "id" = $1 AND "user" = $2 AND "expires_at" > now() AND "units" >= $3
+        RETURNING "user", "feature", "units"
+    ), released AS (
+        UPDATE "quota" AS q SET "reserved" = greatest(q."reserved" - l."units", 0), "updated_at" = now()
+        FROM lease AS l WHERE q."user" = l."user"
+    ), charged AS (
+        INSERT INTO "usage_event" ("user", "feature", "units", "created_at")
+        SELECT "user", "feature", $3, now() FROM lease WHERE $3 > 0
+    )
+    SELECT "units" FROM lease
+"""
+
+RESERVATION_SQL = """
+    SELECT "units", "expires_at" > now() AS "live" FROM "quota_reservation"
+    WHERE "id" = $1 AND "user" = $2
+"""
+
+# Quota rows are locked in user order before they are updated, so
+# concurrent reapers and settlements cannot deadlock
+REAP_SQL = """
+    WITH expired AS (
+        DELETE FROM "quota_reservation"
+        WHERE "id" IN (
+            SELECT "id" FROM "quota_reservation" WHERE "expires_at" <= now()
+            ORDER BY "expires_at"
+            LIMIT $1
+            FOR UPDATE SKIP LOCKED
+        )
+        RETURNING "user", "units"
+    ), sums AS (
+        SELECT "user", sum("units") AS "units" FROM expired GROUP BY "user"
+    ), locked AS (
+        SELECT q."user" FROM "quota" AS q
+        WHERE q."user" IN (SELECT "user" FROM sums)
+        ORDER BY q."user"
+        FOR UPDATE
+    ), released AS (
+        UPDATE "quota" AS q SET "reserved" = greatest(q."reserved" - s."units", 0), "updated_at" = now()
+        FROM sums AS s JOIN locked AS l ON l."user" = s."user"
+        WHERE q."user" = s."user"
+    )
+    SELECT (SELECT count(*) FROM expired) AS "reclaimed",
+           (SELECT coalesce(array_agg("user"), '{}') FROM sums) AS "users"
+"""
+
+_reserved = metrics.counter("reservations.reserved")
+_rejected = metrics.counter("reservations.rejected")
+_committed_units = metrics.counter("reservations.committed_units")
+_released_units = metrics.counter("reservations.released_units")
+_reclaimed = metrics.counter("reservations.reclaimed")
+_reserve_latency = metrics.summary("reservations.reserve_latency_ms")
+
+
+async def reserve(user_id: int, units: int, ttl: float = QUOTA_RESERVATION_TTL, feature: str = DEFAULT_FEATURE):
+    """
+    Hold units of a user's quota for a job.
+
+    Args:
+        user_id (int): The ID of the user
+        units (int): The most units the job may consume
+        ttl (float): Seconds until the reservation expires unless settled
+        feature (str): The feature the units will be spent on
+
+    Returns:
+        dict: The reservation's ID and expiry
+    """
+    if units <= 0:
+        raise HTTPException(status_code=400, detail="Units must be positive")
+    if not 0 < ttl <= QUOTA_RESERVATION_MAX_TTL:
+        raise HTTPException(status_code=400, detail="Invalid reservation TTL")
+    if not feature or len(feature) > 50:
+        raise HTTPException(status_code=400, detail="Invalid feature")
+
+    user = str(user_id)
+    conn = shards.for_user(user_id)
+    started = time.perf_counter()
+    rows = await conn.execute_query_dict(RESERVE_SQL, [user, units, uuid.uuid4(), feature, float(ttl)])
+    _reserve_latency.observe((time.perf_counter() - started) * 1000)
+
+    if not rows:
+        if not await conn.execute_query_dict(USAGE_SQL, [user]):
+            raise HTTPException(status_code=404, detail="Quota not found")
+        _rejected.inc()
+        raise HTTPException(status_code=429, detail="Quota exceeded")
+
+    _reserved.inc()
+    usage_accumulator.invalidate(user)
+    return {
+        "status": "success",
+        "reservation_id": str(rows[0]["id"]),
+        "units": units,
+        "expires_at": rows[0]["expires_at"].isoformat(),
+    }
+
+
+async def commit(user_id: int, reservation_id: uuid.UUID, units: int):
+    """
+    Charge the units a job used and release the rest of its reservation.
+
+    Args:
+        user_id (int): The ID of the user
+        reservation_id (UUID): The ID returned by `reserve`
+        units (int): The units the job actually consumed
+
+    Returns:
+        dict: The units charged and released
+    """
+    if units < 0:
+        raise HTTPException(status_code=400, detail="Units must not be negative")
+
+    user = str(user_id)
+    conn = shards.for_user(user_id)
+    rows = await conn.execute_query_dict(SETTLE_SQL, [reservation_id, user, units])
+    if not rows:
+        # Nothing was settled; find out why
+        found = await conn.execute_query_dict(RESERVATION_SQL, [reservation_id, user])
+        if not found:
+            raise HTTPException(status_code=404, detail="Reservation not found")
+        if not found[0]["live"]:
+            raise HTTPException(status_code=410, detail="Reservation expired")
+        raise HTTPException(status_code=400, detail=f"Units exceed the reservation of {found[0]['units']}")
+
+    reserved = rows[0]["units"]
+    _committed_units.inc(units)
+    _released_units.inc(reserved - units)
+    usage_accumulator.invalidate(user)
+    return {
+        "status": "success",
+        "charged": units,
+        "released": reserved - units,
+    }
+
+
+async def release(user_id: int, reservation_id: uuid.UUID):
+    """Return every unit of a reservation without charging any."""
+    return await commit(user_id, reservation_id, 0)
+
+
+async def _reap_shard(conn, batch_size: int) -> int:
+    reclaimed = 0
+    while True:
+        row = (await conn.execute_query_dict(REAP_SQL, [batch_size]))[0]
+        for user in row["users"]:
+            usage_accumulator.invalidate(user)
+        reclaimed += row["reclaimed"]
+        if row["reclaimed"] < batch_size:
+            return reclaimed
+
+
+async def reap_expired(batch_size: int = QUOTA_RESERVATION_REAP_BATCH_SIZE) -> int:
+    """
+    Return the units of every expired reservation, on every shard, to their quotas.
+
+    Returns:
+        int: The number of reservations reclaimed
+    """
+    total = sum(await asyncio.gather(*(_reap_shard(conn, batch_size) for conn in shards.all_shards())))
+
+    if total:
+        _reclaimed.inc(total)
+        logger.info("Reclaimed %s expired quota reservations", total)
+    return total
+
+
+background.periodic("quota-reservation-reaper", QUOTA_RESERVATION_REAP_INTERVAL)(reap_expired)
@@ -0,0 +1,234 @@
+"""
+Guarding calls to external dependencies.
+
+Each Dependency wraps one provider, Stripe or the SMTP API, with the same
+policy:
+
+- Every attempt gets `timeout` seconds, and a whole call, retries
+  included, gets `deadline` seconds.
+- A circuit breaker opens after `failure_threshold` consecutive failures.
+  While it is open, calls fail at once with DependencyUnavailable instead
+  of tying up a worker. After `reset_timeout` seconds one trial call is
+  let through; its outcome closes the breaker or opens it again.
+- Calls marked idempotent are retried up to `retries` times with full
+  jitter backoff. Only failures of the provider count, such as
+  timeouts, connection errors and 5xx responses. A call that still fails
+  with one of them raises DependencyUnavailable. Client errors are
+  neither retried nor held against the breaker, and are raised as they
+  are; they do not clear the failures counted before them either.
+- Calls marked hedged start a second attempt when the first has not
+  answered after `hedge_after` seconds, and take whichever answers first.
+
+Blocking SDK calls run in the thread pool, so a timeout frees the event
+loop even though the thread finishes the request in the background.
+"""
+
+import asyncio
+import logging
+import random
+import time
+from functools import partial
+from typing import Callable, Dict, Optional, Tuple, Type
+
+from starlette.concurrency import run_in_threadpool
+
+from app.services import metrics
+
+logger = logging.getLogger(__name__)
+
+CLOSED, HALF_OPEN, OPEN = "closed", "half_open", "open"
+STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+
+class DependencyUnavailable(Exception):
+    """Raised when a dependency's breaker is open or it did not answer in time."""
+
+    def __init__(self, name: str, reason: str):
+        super().__init__(f"{name} unavailable: {reason}")
+        self.name = name
+        self.reason = reason
+
+
+class CircuitBreaker:
+    def __init__(self, name: str, failure_threshold: int = 5, reset_timeout: float = 30.0):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self._trial_running = False
+
+        self._state_gauge = metrics.gauge(f"resilience.{name}.breaker_state")
+        self._trips = metrics.counter(f"resilience.{name}.breaker_trips")
+        self._rejected = metrics.counter(f"resilience.{name}.rejected")
+
+    def _set_state(self, state: str) -> None:
+        if state != self.state:
+            logger.warning("Circuit breaker for %s is now %s", self.name, state)
+        self.state = state
+        self._state_gauge.set(STATE_VALUES[state])
+
+    def before_call(self) -> None:
+        """Raise DependencyUnavailable unless a call may go through now."""
+        if self.state == OPEN and time.monotonic() - self.opened_at >= self.reset_timeout:
+            self._set_state(HALF_OPEN)
+        if self.state == OPEN or (self.state == HALF_OPEN and self._trial_running):
+            self._rejected.inc()
+            raise DependencyUnavailable(self.name, "circuit open")
+        if self.state == HALF_OPEN:
+            self._trial_running = True
+
+    def record_success(self) -> None:
+        self.failures = 0
+        self._trial_running = False
+        self._set_state(CLOSED)
+
+    def record_failure(self) -> None:
+        self.failures += 1
+        self._trial_running = False
+        if self.state == HALF_OPEN or self.failures >= self.failure_threshold:
+            if self.state != OPEN:
+                self._trips.inc()
+            self.opened_at = time.monotonic()
+            self._set_state(OPEN)
+
+    def release(self) -> None:
+        """Give up a half-open trial that ended without a verdict."""
+        self._trial_running = False
+
+    def snapshot(self) -> dict:
+        return {
+            "state": self.state,
+            "consecutive_failures": self.failures,
+            "trips": self._trips.value,
+            "rejected": self._rejected.value,
+        }
+
+
+class Dependency:
+    def __init__(
+        self,
+        name: str,
+        timeout: float,
+        deadline: float,
+        failure_types: Tuple[Type[BaseException], ...] = (),
+        retries: int = 2,
+        backoff: float = 0.2,
+        hedge_after: Optional[float] = None,
+        failure_threshold: int = 5,
+        reset_timeout: float = 30.0,
+    ):
+        self.name = name
+        self.timeout = timeout
+        self.deadline = deadline
+        self.failure_types = (asyncio.TimeoutError, ConnectionError) + tuple(failure_types)
+        self.retries = retries
+        self.backoff = backoff
+        self.hedge_after = hedge_after
+        self.breaker = CircuitBreaker(name, failure_threshold, reset_timeout)
+
+        self._latency = metrics.summary(f"resilience.{name}.latency_ms")
+        self._timeouts = metrics.counter(f"resilience.{name}.timeouts")
+        self._retries = metrics.counter(f"resilience.{name}.retries")
+        self._hedges = metrics.counter(f"resilience.{name}.hedges")
+
+    async def _attempt(self, call: Callable, timeout: float):
+        self.breaker.before_call()
+        started = time.perf_counter()
+        try:
+            result = await asyncio.wait_for(call(), timeout)
+        except self.failure_types as e:
+            if isinstance(e, asyncio.TimeoutError):
+                self._timeouts.inc()
+            self.breaker.record_failure()
+            raise
+        except Exception:
+            # The provider answered; it was the request that was wrong, which
+            # says nothing either way about the provider's health
+            self.breaker.release()
+            raise
+        except BaseException:
+            self.breaker.release()
+            raise
+        finally:
+            self._latency.observe((time.perf_counter() - started) * 1000)
+        self.breaker.record_success()
+        return result
+
+    async def _hedged(self, call: Callable, timeout: float):
+        tasks = {asyncio.ensure_future(self._attempt(call, timeout))}
+        try:
+            done, _ = await asyncio.wait(tasks, timeout=self.hedge_after)
+            if not done:
+                self._hedges.inc()
+                tasks.add(asyncio.ensure_future(self._attempt(call, timeout - self.hedge_after)))
+
+            pending = set(tasks)
+            error: Optional[BaseException] = None
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            for task in tasks:
+                if not task.done():
+                    task.cancel()
+
+    async def call(self, func: Callable, *args, idempotent: bool = False, hedge: bool = False, **kwargs):
+        """
+        Call `func(*args, **kwargs)` under this dependency's policy.
+
+        Args:
+            func: A coroutine function, or a blocking function to run in the thread pool
+            idempotent (bool): Whether the call may be retried
+            hedge (bool): Whether a slow call may be raced by a second one
+
+        Raises:
+            DependencyUnavailable: If the breaker is open, or the call timed out or
+                failed with one of the dependency's failure types
+        """
+        if asyncio.iscoroutinefunction(func):
+            call = partial(func, *args, **kwargs)
+        else:
+            call = partial(run_in_threadpool, func, *args, **kwargs)
+
+        deadline = time.monotonic() + self.deadline
+        attempts = 1 + (self.retries if idempotent else 0)
+        for attempt in range(1, attempts + 1):
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise DependencyUnavailable(self.name, "deadline exceeded")
+            timeout = min(self.timeout, remaining)
+            try:
+                if hedge and self.hedge_after is not None and self.hedge_after < timeout:
+                    return await self._hedged(call, timeout)
+                return await self._attempt(call, timeout)
+            except self.failure_types as e:
+                delay = random.uniform(0, self.backoff * 2 ** (attempt - 1))
+                if attempt == attempts or time.monotonic() + delay >= deadline:
+                    if isinstance(e, asyncio.TimeoutError):
+                        raise DependencyUnavailable(self.name, "timed out") from e
+                    raise DependencyUnavailable(self.name, str(e) or type(e).__name__) from e
+                self._retries.inc()
+                await asyncio.sleep(delay)
+
+    def snapshot(self) -> dict:
+        return {"name": self.name, "timeout": self.timeout, "deadline": self.deadline, **self.breaker.snapshot()}
+
+
+_dependencies: Dict[str, Dependency] = {}
+
+
+def dependency(name: str, **kwargs) -> Dependency:
+    """Create a Dependency, or return the one already registered under `name`."""
+    if name not in _dependencies:
+        _dependencies[name] = Dependency(name, **kwargs)
+    return _dependencies[name]
+
+
+def snapshot() -> Dict[str, dict]:
+    return {name: dep.snapshot() for name, dep in _dependencies.items()}
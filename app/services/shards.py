@@ -0,0 +1,102 @@
+"""
+Routing of per-user rows to database shards.
+
+Sharding is off unless DB_SHARD_URLS configures more databases than the
+default one (see app/database.py). When it is on:
+
+- The rows of users, otp_system, usersubscription and quota belonging to a
+  user live on shard `user_id % shard_count()`, as do the rows derived from
+  them: the usage ledger and its daily rollups, quota reservations and
+  checkout sessions. Background jobs over those tables run on every shard.
+  Shard 0 is the "default" connection and also holds every table that is
+  not per user.
+- New users go to a random shard. Each shard's users_id_seq steps by the
+  shard count from the shard's own offset (see `align_user_sequences`),
+  so the ID a shard hands out always maps back to that shard.
+- Lookups without a user ID, such as by email, run on every shard
+  concurrently and merge what they find. Emails and usernames are kept
+  unique across shards by the user_directory table on shard 0, which
+  create_user writes to before it creates the user.
+
+Adding a shard changes where existing users belong, so their rows must be
+moved before the new configuration is deployed.
+"""
+
+import asyncio
+import logging
+import random
+from typing import Awaitable, Callable, List, TypeVar
+
+from tortoise import Tortoise
+from tortoise.backends.base.client import BaseDBAsyncClient
+from tortoise.transactions import in_transaction
+
+from app.database import SHARD_CONNECTIONS
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+# Arbitrary key for the advisory lock serialising sequence alignment
+ALIGN_LOCK_ID = 740_043
+
+USER_SEQUENCE_SQL = """
+    SELECT "increment_by",
+           greatest((SELECT coalesce(max("id"), 0) FROM "users"), coalesce("last_value", 0)) AS "last_id"
+    FROM pg_sequences WHERE "schemaname" = current_schema() AND "sequencename" = 'users_id_seq'
+"""
+
+
+def shard_count() -> int:
+    return len(SHARD_CONNECTIONS)
+
+
+def shard_index(user_id) -> int:
+    return int(user_id) % len(SHARD_CONNECTIONS)
+
+
+def name_for_user(user_id) -> str:
+    """The connection name of the shard holding a user's rows."""
+    return SHARD_CONNECTIONS[shard_index(user_id)]
+
+
+def for_user(user_id) -> BaseDBAsyncClient:
+    """The connection of the shard holding a user's rows."""
+    return Tortoise.get_connection(name_for_user(user_id))
+
+
+def for_new_user() -> BaseDBAsyncClient:
+    """The connection of the shard a new user is created on."""
+    return Tortoise.get_connection(random.choice(SHARD_CONNECTIONS))
+
+
+def all_shards() -> List[BaseDBAsyncClient]:
+    return [Tortoise.get_connection(name) for name in SHARD_CONNECTIONS]
+
+
+async def fan_out(query: Callable[[BaseDBAsyncClient], Awaitable[T]]) -> List[T]:
+    """Run `query` on every shard concurrently, returning the results in shard order."""
+    return list(await asyncio.gather(*(query(db) for db in all_shards())))
+
+
+async def align_user_sequences() -> None:
+    """
+    Make each shard's users_id_seq hand out only IDs that map to that shard.
+
+    Runs at startup. It does nothing without sharding, and nothing on a
+    shard whose sequence already steps by the shard count.
+    """
+    count = shard_count()
+    if count == 1:
+        return
+    for index, name in enumerate(SHARD_CONNECTIONS):
+        async with in_transaction(name) as conn:
+            await conn.execute_query_dict("SELECT pg_advisory_xact_lock($1)", [ALIGN_LOCK_ID])
+            rows = await conn.execute_query_dict(USER_SEQUENCE_SQL)
+            if not rows or rows[0]["increment_by"] == count:
+                continue
+            last_id = rows[0]["last_id"]
+            next_id = (last_id // count + 1) * count + index
+            await conn.execute_script(f'ALTER SEQUENCE "users_id_seq" INCREMENT BY {count}')
+            await conn.execute_query_dict("SELECT setval('users_id_seq', $1, false)", [next_id])
+            logger.info("Aligned users_id_seq on shard %s to step %s from %s", index, count, next_id)
@@ -13,6 +13,8 @@ from fastapi.responses import JSONResponse
 from dotenv import load_dotenv
 from pathlib import Path
 
+from app.services import resilience
+
 env_path = Path(__file__).parent.parent / '.env'
 load_dotenv(dotenv_path=env_path)
 
@@ -23,9 +25,30 @@ logger = logging.getLogger(__name__)
 SMTP_API_URL = os.getenv("SMTP_API_URL")
 SMTP_API_SECRET = os.getenv("SMTP_API_SECRET")
 SMTP_SENDER_EMAIL = os.getenv("SMTP_SENDER_EMAIL")
+SMTP_TIMEOUT = float(os.getenv("SMTP_TIMEOUT", "5"))
+
+# Sending is not idempotent, so a failed send is reported rather than retried
+smtp_api = resilience.dependency(
+    "smtp",
+    timeout=SMTP_TIMEOUT,
+    deadline=SMTP_TIMEOUT,
+    failure_types=(aiohttp.ClientError,),
+    retries=0,
+)
 
 print("SMTP_API_URL: ", SMTP_API_URL)
 
+async def _post(headers: Dict[str, str], payload: Dict[str, Any]):
+    timeout = aiohttp.ClientTimeout(total=SMTP_TIMEOUT)
+    async with aiohttp.ClientSession(timeout=timeout) as session:
+        async with session.post(SMTP_API_URL, headers=headers, json=payload) as response:
+            response_text = await response.text()
+            if response.status >= 500:
+                # Count server errors against the breaker like network errors
+                response.raise_for_status()
+            return response.status, response_text
+
+
 async def send_email(otp: str, recipient_name: str, recipient_email: str) -> Dict[str, Any]:
     """
     Send an OTP verification email to the specified recipient.
@@ -69,19 +92,25 @@ async def send_email(otp: str, recipient_name: str, recipient_email: str) -> Dic
 
         logger.debug("Sending email with payload: %s", json.dumps(payload))
 
-        async with aiohttp.ClientSession() as session:
-            async with session.post(SMTP_API_URL, headers=headers, json=payload) as response:
-                response_text = await response.text()
-                if response.status == 200:
-                    logger.info("Email sent successfully to %s", recipient_email)
-                    return {"status": "success", "message": "Email sent successfully"}
-                
-                logger.error("Failed to send email to %s: %s", recipient_email, response_text)
-                raise HTTPException(
-                    status_code=response.status,
-                    detail="Failed to send email"
-                )
+        response_status, response_text = await smtp_api.call(_post, headers, payload)
+        if response_status == 200:
+            logger.info("Email sent successfully to %s", recipient_email)
+            return {"status": "success", "message": "Email sent successfully"}
+
+        logger.error("Failed to send email to %s: %s", recipient_email, response_text)
+        raise HTTPException(
+            status_code=response_status,
+            detail="Failed to send email"
+        )
 
+    except HTTPException:
+        raise
+    except resilience.DependencyUnavailable as e:
+        logger.error("Error sending email: %s", e)
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Email service is unavailable"
+        )
     except aiohttp.ClientError as e:
         logger.error("Error sending email: %s", str(e))
         raise HTTPException(
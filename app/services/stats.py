@@ -0,0 +1,125 @@
+"""
+User and subscriber counts for admin dashboards.
+
+The stat_counter table holds the number of users, of active users and of
+active subscribers per plan and frequency. Triggers on users and
+usersubscription add each write's change to it in the same transaction,
+so every write path, including the raw upserts, the sweeper and the purge,
+keeps it current and reading the counts never scans either table. Each
+counter is split over 8 slots picked by backend PID, so concurrent writers
+rarely wait on the same counter row; a read sums the slots.
+
+Counts only drift if rows change with the triggers disabled, e.g. a
+TRUNCATE or a bulk load. Every STATS_RECOUNT_INTERVAL seconds one worker
+recounts every shard exactly and replaces its counters, logging any drift
+it corrected. The recount locks stat_counter, which holds up writes to
+users and subscriptions while it counts, so it gives up after
+STATS_RECOUNT_LOCK_TIMEOUT rather than queue in front of them.
+"""
+
+import logging
+import os
+from typing import Dict
+
+from tortoise.transactions import in_transaction
+
+from app.database import SHARD_CONNECTIONS
+from app.models.subscription import SUBSCRIPTION_FREQUENCY, SUBSCRIPTION_TYPES
+from app.services import background, metrics, shards
+
+logger = logging.getLogger(__name__)
+
+STATS_RECOUNT_INTERVAL = float(os.getenv("STATS_RECOUNT_INTERVAL", "3600"))
+STATS_RECOUNT_LOCK_TIMEOUT = os.getenv("STATS_RECOUNT_LOCK_TIMEOUT", "5s")
+# Arbitrary key for the advisory lock that keeps recounts from queueing up
+RECOUNT_LOCK_ID = 740_050
+
+COUNTERS_SQL = 'SELECT "name", sum("value") AS "value" FROM "stat_counter" GROUP BY "name"'
+
+RECOUNT_SQL = """
+    INSERT INTO "stat_counter" ("name", "slot", "value")
+    SELECT 'users.total', 0, count(*) FROM "users" WHERE "deleted_at" IS NULL
+    UNION ALL
+    SELECT 'users.active', 0, count(*) FROM "users" WHERE "deleted_at" IS NULL AND "is_active"
+    UNION ALL
+    SELECT 'subscribers.' || "subscription_plan" || '.' || "subscription_frequency", 0, count(*)
+    FROM "usersubscription" WHERE "is_active"
+    GROUP BY "subscription_plan", "subscription_frequency"
+    RETURNING "name", "value"
+"""
+
+_drift = metrics.counter("stats.recount.drift")
+_last_drift = metrics.gauge("stats.recount.last_drift")
+
+
+def _counters_to_stats(counters: Dict[str, int]) -> dict:
+    subscribers = {plan: {frequency: 0 for frequency in SUBSCRIPTION_FREQUENCY} for plan in SUBSCRIPTION_TYPES}
+    for name, value in counters.items():
+        kind, _, rest = name.partition(".")
+        plan, _, frequency = rest.partition(".")
+        if kind == "subscribers":
+            subscribers.setdefault(plan, {})[frequency] = value
+    return {
+        "users": {
+            "total": counters.get("users.total", 0),
+            "active": counters.get("users.active", 0),
+        },
+        "subscribers": subscribers,
+        "subscribers_total": sum(sum(by_frequency.values()) for by_frequency in subscribers.values()),
+    }
+
+
+async def get_stats():
+    """
+    Get the number of users and of subscribers per plan and frequency.
+
+    Returns:
+        dict: Total and active users, and active subscribers per plan and frequency
+    """
+    counters: Dict[str, int] = {}
+    for rows in await shards.fan_out(lambda db: db.execute_query_dict(COUNTERS_SQL)):
+        for row in rows:
+            counters[row["name"]] = counters.get(row["name"], 0) + int(row["value"])
+    return _counters_to_stats(counters)
+
+
+async def recount() -> int:
+    """
+    Replace every shard's counters with exact counts.
+
+    Only one worker recounts a shard at a time; the others skip it.
+
+    Returns:
+        int: The total drift corrected, summed over all counters
+    """
+    total = 0
+    for name in SHARD_CONNECTIONS:
+        async with in_transaction(name) as conn:
+            locked = await conn.execute_query_dict(
+                'SELECT pg_try_advisory_xact_lock($1) AS "locked"', [RECOUNT_LOCK_ID]
+            )
+            if not locked[0]["locked"]:
+                continue
+            await conn.execute_script(f"SET LOCAL lock_timeout = '{STATS_RECOUNT_LOCK_TIMEOUT}'")
+            # Writes that changed rows before the lock have committed their
+            # counter deltas by the time it is granted; later ones wait for it
+            await conn.execute_script('LOCK TABLE "stat_counter" IN EXCLUSIVE MODE')
+            previous = {row["name"]: int(row["value"]) for row in await conn.execute_query_dict(COUNTERS_SQL)}
+            await conn.execute_script('DELETE FROM "stat_counter"')
+            counted = {row["name"]: int(row["value"]) for row in await conn.execute_query_dict(RECOUNT_SQL)}
+
+        drift = {
+            counter: counted.get(counter, 0) - previous.get(counter, 0)
+            for counter in counted.keys() | previous.keys()
+        }
+        drift = {counter: delta for counter, delta in drift.items() if delta}
+        if drift:
+            logger.warning("Corrected stat counter drift on %s: %s", name, drift)
+        total += sum(abs(delta) for delta in drift.values())
+
+    _drift.inc(total)
+    _last_drift.set(total)
+    return total
+
+
+background.periodic("stats-recount", STATS_RECOUNT_INTERVAL)(recount)
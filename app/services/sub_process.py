@@ -6,10 +6,15 @@ import os
 import stripe
 from fastapi import HTTPException, Request
 import json
+import uuid
 import logging
-from datetime import datetime
+from datetime import datetime, timezone
+from decimal import Decimal
 from app.models.user import User
 from app.models.subscription import UserSubscription, Quota
+from app.services.usage import accumulator as usage_accumulator
+from app.services.checkout_cache import checkout_sessions, CachedSession
+from app.services import locks, plans, repository, resilience, shards, subscription_events
 from dotenv import load_dotenv
 from pathlib import Path
 
@@ -18,12 +23,107 @@ load_dotenv(dotenv_path=env_path)
 # Initialize Stripe with your secret key
 stripe.api_key = os.getenv("STRIPE_SECRET_KEY")
 
-print("STRIPE_SECRET_KEY", os.getenv("STRIPE_SECRET_KEY"))
+STRIPE_TIMEOUT = float(os.getenv("STRIPE_TIMEOUT", "10"))
+STRIPE_DEADLINE = float(os.getenv("STRIPE_DEADLINE", "20"))
+STRIPE_HEDGE_AFTER = float(os.getenv("STRIPE_HEDGE_AFTER", "2"))
+
+# Retries and timeouts are applied by stripe_api, so the SDK must not add its own
+stripe.max_network_retries = 0
+stripe.default_http_client = stripe.new_default_http_client(timeout=STRIPE_TIMEOUT)
+
+stripe_api = resilience.dependency(
+    "stripe",
+    timeout=STRIPE_TIMEOUT,
+    deadline=STRIPE_DEADLINE,
+    # A rejected API key fails every call until it is replaced, so it counts
+    # against the breaker like an outage
+    failure_types=(
+        stripe.error.APIConnectionError,
+        stripe.error.APIError,
+        stripe.error.RateLimitError,
+        stripe.error.AuthenticationError,
+    ),
+    hedge_after=STRIPE_HEDGE_AFTER,
+)
 
-# Set up logging
-logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# A quota whose total changes starts over, as a reconciliation reset
+# would: its used units and the ledger rows before this transaction are
+# discarded. A quota keeping its total keeps its used units.
+QUOTA_RESET = (
+    '"used" = CASE WHEN q."total" = EXCLUDED."total" THEN q."used" ELSE 0 END, '
+    '"checkpoint_at" = CASE WHEN q."total" = EXCLUDED."total" THEN q."checkpoint_at" ELSE now() END, '
+    '"checkpoint_txid" = CASE WHEN q."total" = EXCLUDED."total" THEN q."checkpoint_txid" '
+    'ELSE pg_current_xact_id()::text::bigint END, '
+    '"total" = EXCLUDED."total", "updated_at" = now()'
+)
+
+# Both tables hold one row per user, so concurrent events for a user cannot
+# create duplicates; whichever commits last wins.
+ACTIVATE_SUBSCRIPTION_SQL = f"""
+    WITH subscription AS (
+        INSERT INTO "usersubscription" AS s
+            ("user", "subscription_plan", "subscription_frequency", "price", "is_active",
+             "start_date", "end_date", "stripe_subscription_id", "updated_at")
+        VALUES ($1, $2, $3, $4, TRUE, $5, $6, $7, now())
+        ON CONFLICT ("user") DO UPDATE SET
+            "subscription_plan" = EXCLUDED."subscription_plan",
+            "subscription_frequency" = EXCLUDED."subscription_frequency",
+            "price" = EXCLUDED."price",
+            "is_active" = TRUE,
+            "start_date" = EXCLUDED."start_date",
+            "end_date" = EXCLUDED."end_date",
+            "stripe_subscription_id" = EXCLUDED."stripe_subscription_id",
+            "updated_at" = now()
+        RETURNING s."user"
+    ), quota AS (
+        INSERT INTO "quota" AS q
+            ("user", "total", "used", "checkpoint_at", "checkpoint_txid", "created_at", "updated_at")
+        SELECT "user", $8, 0, now(), pg_current_xact_id()::text::bigint, now(), now() FROM subscription
+        ON CONFLICT ("user") DO UPDATE SET {QUOTA_RESET}
+        RETURNING q."total", q."used"
+    ), notified AS (
+        SELECT pg_notify($9, $10)
+    )
+    SELECT "total", "used" FROM quota CROSS JOIN notified
+"""
+
+# Stripe statuses of a subscription that is being paid for
+ACTIVE_STATUSES = {"active", "trialing"}
+
+# Moves a renewed subscription's billing period forward. Only the Stripe
+# subscription the user's row points at is updated.
+RENEW_SUBSCRIPTION_SQL = """
+    WITH renewed AS (
+        UPDATE "usersubscription"
+        SET "start_date" = $3, "end_date" = $4, "is_active" = TRUE, "updated_at" = now()
+        WHERE "user" = $1 AND "stripe_subscription_id" = $2
+          AND ("end_date" IS DISTINCT FROM $4 OR NOT "is_active")
+        RETURNING "user"
+    )
+    SELECT "user", pg_notify($5, $6) FROM renewed
+"""
+
+# Sets a user's quota from their subscription's plan and frequency, given
+# the catalog's quotas as three parallel arrays
+MANAGE_QUOTA_SQL = f"""
+    WITH quota AS (
+        INSERT INTO "quota" AS q
+            ("user", "total", "used", "checkpoint_at", "checkpoint_txid", "created_at", "updated_at")
+        SELECT s."user", l."total", 0, now(), pg_current_xact_id()::text::bigint, now(), now()
+        FROM "usersubscription" AS s
+        JOIN unnest($2::varchar[], $3::varchar[], $4::int[]) AS l("plan", "frequency", "total")
+            ON l."plan" = lower(s."subscription_plan") AND l."frequency" = lower(s."subscription_frequency")
+        WHERE s."user" = $1
+        ON CONFLICT ("user") DO UPDATE SET {QUOTA_RESET}
+        RETURNING q."total", q."used"
+    ), notified AS (
+        SELECT pg_notify($5, $6) FROM quota
+    )
+    SELECT "total", "used" FROM quota CROSS JOIN notified
+"""
+
 async def create_subscription(user_id: int, plan: str, frequency: str = "monthly"):
     """
     Create a subscription for a user with the specified plan and frequency.
@@ -38,33 +138,52 @@ async def create_subscription(user_id: int, plan: str, frequency: str = "monthly
     """
     try:
         # Get the appropriate price ID based on plan and frequency
-        price_id = os.getenv(f"STRIPE_{plan.upper()}_PRICE_ID")
-        if not price_id:
+        catalog_plan = plans.get(plan, frequency)
+        if not catalog_plan or not catalog_plan.stripe_price_id:
             raise HTTPException(status_code=400, detail=f"Invalid plan: {plan}")
+        price_id = catalog_plan.stripe_price_id
             
-        # Create a Stripe checkout session
-        checkout_session = stripe.checkout.Session.create(
-            payment_method_types=['card'],
-            line_items=[{
-                'price': price_id,
-                'quantity': 1,
-            }],
-            mode='subscription',
-            success_url=f"https://summit.guide",
-            cancel_url=f"https://summit.guide/cancel",
-            metadata={
-                'user_id': str(user_id),
-                'subscription_plan': plan,
-                'subscription_frequency': frequency
-            }
-        )
-        
+        async def open_checkout_session():
+            # Create a Stripe checkout session; the idempotency key makes retries safe
+            checkout_session = await stripe_api.call(
+                stripe.checkout.Session.create,
+                payment_method_types=['card'],
+                line_items=[{
+                    'price': price_id,
+                    'quantity': 1,
+                }],
+                mode='subscription',
+                success_url=f"https://summit.guide",
+                cancel_url=f"https://summit.guide/cancel",
+                metadata={
+                    'user_id': str(user_id),
+                    'subscription_plan': plan,
+                    'subscription_frequency': frequency
+                },
+                # Copied onto the subscription so reconciliation can attribute it
+                subscription_data={
+                    'metadata': {
+                        'user_id': str(user_id),
+                        'subscription_plan': plan,
+                        'subscription_frequency': frequency
+                    }
+                },
+                idempotency_key=str(uuid.uuid4()),
+                idempotent=True,
+            )
+            return CachedSession(checkout_session.id, checkout_session.url, checkout_session.expires_at)
+
+        # Repeat clicks get the session that is already open
+        checkout_session = await checkout_sessions.get_or_create(user_id, plan, frequency, open_checkout_session)
+
         return {
             "message": "Subscription created successfully",
             "checkout_url": checkout_session.url,
-            "session_id": checkout_session.id
+            "session_id": checkout_session.session_id
         }
         
+    except resilience.DependencyUnavailable as e:
+        raise HTTPException(status_code=503, detail=str(e))
     except stripe.error.StripeError as e:
         raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
@@ -81,125 +200,137 @@ async def stripe_webhook(request: Request):
         dict: Response indicating the status of the webhook processing
     """
     try:
-        logger.info("Starting webhook processing...")
-        
         # Get the webhook payload and signature
         payload = await request.body()
         sig_header = request.headers.get("stripe-signature")
-        
-        logger.info(f"Received webhook with signature: {sig_header}")
-        
+
         if not sig_header:
             logger.error("Missing stripe-signature header")
             raise HTTPException(status_code=400, detail="Missing stripe-signature header")
             
         # Get the webhook secret from environment variables
         webhook_secret = os.getenv("STRIPE_WEBHOOK_SECRET")
-        logger.info(f"Webhook secret configured: {'Yes' if webhook_secret else 'No'}")
-        
+
         if not webhook_secret:
             logger.error("Webhook secret not configured")
             raise HTTPException(status_code=500, detail="Webhook secret not configured")
             
         try:
-            logger.info("Attempting to construct event...")
             event = stripe.Webhook.construct_event(
                 payload, sig_header, webhook_secret
             )
-            logger.info("Event constructed successfully")
         except ValueError as e:
-            logger.error(f"Invalid payload: {e}")
+            logger.error("Invalid payload: %s", e)
             raise HTTPException(status_code=400, detail="Invalid payload")
         except stripe.error.SignatureVerificationError as e:
-            logger.error(f"Invalid signature: {e}")
+            logger.error("Invalid signature: %s", e)
             raise HTTPException(status_code=400, detail="Invalid signature")
-            
-        logger.info(f"Received Stripe event type: {event.get('type')}")
-        
+
+        logger.info("Received Stripe event %s of type %s", event.get("id"), event.get("type"))
+
         if event["type"] == "checkout.session.completed":
-            logger.info("Processing checkout.session.completed event")
             session = event["data"]["object"]
             subscription_id = session.get("subscription")
-            logger.info(f"Subscription ID: {subscription_id}")
-            
+
             metadata = session.get("metadata", {})
             user_id = metadata.get("user_id")
             subscription_plan = metadata.get("subscription_plan")
             subscription_frequency = metadata.get("subscription_frequency")
-            
-            logger.info(f"Extracted metadata: user_id={user_id}, plan={subscription_plan}, frequency={subscription_frequency}")
-            
+
             if not user_id:
                 logger.error("Missing user_id in metadata")
                 raise HTTPException(status_code=400, detail="Missing user_id in metadata")
-            
-            
+
+            quota_limit = plans.quota(subscription_plan, subscription_frequency or "monthly")
+            if not quota_limit:
+                logger.error("Invalid subscription plan %s in metadata", subscription_plan)
+                raise HTTPException(status_code=400, detail=f"Invalid subscription plan: {subscription_plan}")
+
             # Fetch the Stripe subscription
             try:
-                logger.info(f"Retrieving Stripe subscription: {subscription_id}")
-                stripe_subscription = stripe.Subscription.retrieve(subscription_id)
-                logger.info("Stripe subscription retrieved successfully")
-                logger.info(f"Subscription object type: {type(stripe_subscription)}")
-                logger.info(f"Subscription data: {stripe_subscription}")
-                
+                stripe_subscription = await stripe_api.call(
+                    stripe.Subscription.retrieve, subscription_id, idempotent=True, hedge=True
+                )
+
                 # Create or update the subscription record
                 try:
-                    logger.info("Processing subscription data...")
-                    # Convert Stripe timestamps to datetime
-                    current_period_start = datetime.fromtimestamp(int(stripe_subscription['items']['data'][0]['current_period_start']))
-                    current_period_end = datetime.fromtimestamp(int(stripe_subscription['items']['data'][0]['current_period_end']))
-                    
-                    # Get the price from the subscription
-                    price = float(stripe_subscription['items']['data'][0]['price']['unit_amount']) / 100  # Convert from cents to dollars
-                    
-                    logger.info("Creating/updating subscription record...")
-
-                    # Create or update subscription
-                    await UserSubscription.update_or_create(
-                        user=user_id,
-                        defaults={
-                            "subscription_plan": subscription_plan,
-                            "subscription_frequency": subscription_frequency,
-                            "price": price,
-                            "is_active": True,
-                            "start_date": current_period_start,
-                            "end_date": current_period_end,
-                            "stripe_subscription_id": subscription_id
-                        }
+                    item = stripe_subscription['items']['data'][0]
+                    current_period_start = datetime.fromtimestamp(int(item['current_period_start']), timezone.utc)
+                    current_period_end = datetime.fromtimestamp(int(item['current_period_end']), timezone.utc)
+                    # Convert from cents to dollars
+                    price = Decimal(item['price']['unit_amount']) / 100
+
+                    # Subscription, quota and notification in one round trip
+                    rows = await shards.for_user(user_id).execute_query_dict(ACTIVATE_SUBSCRIPTION_SQL, [
+                        str(user_id), subscription_plan, subscription_frequency, price,
+                        current_period_start, current_period_end, subscription_id, quota_limit,
+                        subscription_events.CHANNEL, subscription_events.payload(user_id, "activated"),
+                    ])
+                    subscription_events.notified()
+                    usage_accumulator.invalidate(user_id)
+                    logger.info(
+                        "Activated %s %s subscription %s for user %s with quota %s",
+                        subscription_plan, subscription_frequency, subscription_id, user_id, rows[0]["total"],
                     )
-                    logger.info(f"Subscription successfully updated for user {user_id}")
-
-                    # Manage User Quota
-                    try:
-                        logger.info(f"Managing user quota for user {user_id}")
-                        await manage_quotas(user_id)
-                    except Exception as e:
-                        logger.error(f"Error managing user quota: {str(e)}")
-                        logger.exception("Full traceback:")
-                        raise HTTPException(status_code=500, detail=f"Error managing user quota: {str(e)}")
+
+                    # The checkout is done, so its session must not be handed out again
+                    await checkout_sessions.invalidate(user_id)
                     
                 except Exception as e:
-                    logger.error(f"Database update error: {str(e)}")
-                    logger.exception("Full traceback:")
+                    logger.exception("Database update error: %s", e)
                     raise HTTPException(status_code=500, detail=f"Subscription update error: {str(e)}")
                 
+            except resilience.DependencyUnavailable as e:
+                # A 503 makes Stripe deliver the event again later
+                logger.error("Stripe unavailable while retrieving subscription: %s", e)
+                raise HTTPException(status_code=503, detail=str(e))
             except stripe.error.StripeError as e:
-                logger.error(f"Stripe error while retrieving subscription: {e}")
+                logger.error("Stripe error while retrieving subscription: %s", e)
                 raise HTTPException(status_code=500, detail=f"Stripe error: {str(e)}")
                 
             return {"status": "success", "message": "Webhook processed successfully"}
-            
-        logger.warning(f"Unhandled event type: {event['type']}")
+
+        if event["type"] == "customer.subscription.updated":
+            return await _renew_subscription(event["data"]["object"])
+
+        logger.debug("Unhandled event type: %s", event["type"])
         return {"status": "ignored", "message": f"Unhandled event type: {event['type']}"}
         
     except HTTPException as he:
-        logger.error(f"HTTP Exception: {str(he)}")
+        logger.error("Webhook rejected: %s", he.detail)
         raise he
     except Exception as e:
-        logger.error(f"General webhook processing error: {str(e)}")
-        logger.exception("Full traceback:")
+        logger.exception("General webhook processing error: %s", e)
         raise HTTPException(status_code=500, detail=f"General error: {str(e)}")
 
+async def _renew_subscription(stripe_subscription) -> dict:
+    """
+    Move a subscription's end_date to the end of its current billing period.
+
+    Stripe sends customer.subscription.updated when a subscription renews,
+    so the sweeper does not deactivate subscriptions that were paid for.
+    Subscriptions that are no longer active are left to the sweeper and
+    the reconciler.
+    """
+    user_id = (stripe_subscription.get("metadata") or {}).get("user_id")
+    if not user_id or stripe_subscription.get("status") not in ACTIVE_STATUSES:
+        return {"status": "ignored", "message": "Subscription not renewed"}
+
+    item = stripe_subscription["items"]["data"][0]
+    current_period_start = datetime.fromtimestamp(int(item["current_period_start"]), timezone.utc)
+    current_period_end = datetime.fromtimestamp(int(item["current_period_end"]), timezone.utc)
+    rows = await shards.for_user(user_id).execute_query_dict(RENEW_SUBSCRIPTION_SQL, [
+        str(user_id), stripe_subscription["id"], current_period_start, current_period_end,
+        subscription_events.CHANNEL, subscription_events.payload(user_id, "renewed"),
+    ])
+    if rows:
+        subscription_events.notified()
+        logger.info(
+            "Renewed subscription %s of user %s until %s",
+            stripe_subscription["id"], user_id, current_period_end.isoformat(),
+        )
+    return {"status": "success", "message": "Webhook processed successfully"}
+
 async def cancel_subscription(user_id: int):
     """
     Cancel a user's subscription.
@@ -212,7 +343,8 @@ async def cancel_subscription(user_id: int):
     """
     try:
         # Get the subscription record for the user
-        subscription = await UserSubscription.filter(user=str(user_id)).first()
+        db = shards.for_user(user_id)
+        subscription = await UserSubscription.filter(user=str(user_id)).using_db(db).first()
         if not subscription:
             raise HTTPException(status_code=404, detail="Subscription not found")
             
@@ -220,7 +352,12 @@ async def cancel_subscription(user_id: int):
         try:
             if subscription.stripe_subscription_id:
                 try:
-                    stripe.Subscription.cancel(subscription.stripe_subscription_id)
+                    await stripe_api.call(
+                        stripe.Subscription.cancel,
+                        subscription.stripe_subscription_id,
+                        idempotency_key=f"cancel-{subscription.stripe_subscription_id}",
+                        idempotent=True,
+                    )
                 except stripe.error.InvalidRequestError as e:
                     if "No such subscription" in str(e):
                         logger.warning(f"Stripe subscription {subscription.stripe_subscription_id} not found - marking as cancelled locally")
@@ -230,16 +367,22 @@ async def cancel_subscription(user_id: int):
                 logger.warning("No Stripe subscription ID found - marking as cancelled locally")
                 
             
-            subscription.is_active=False
-            await subscription.save()
+            async with locks.user_lock(user_id) as db:
+                await UserSubscription.filter(id=subscription.id).using_db(db).update(is_active=False)
+                await subscription_events.notify(user_id, "cancelled")
             return {
                 "status": "success", 
                 "message": "Subscription cancelled successfully"
                 }
+        except resilience.DependencyUnavailable as e:
+            logger.error("Stripe unavailable while cancelling subscription: %s", e)
+            raise HTTPException(status_code=503, detail=str(e))
         except Exception as e:
             logger.error(f"Error cancelling subscription on stripe: {str(e)}")
             logger.exception("Full traceback:")
             raise HTTPException(status_code=500, detail=f"Error cancelling subscription on stripe: {str(e)}")
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Error cancelling subscription: {str(e)}")
         logger.exception("Full traceback:")
@@ -259,12 +402,12 @@ async def get_subscription_by_user_id(user_id: int):
     """
     try:
         # Get the subscription record for the user
-        subscription = await UserSubscription.filter(user=str(user_id)).first()
+        subscription = await repository.get_subscription(user_id)
         if not subscription:
             raise HTTPException(status_code=404, detail="Subscription not found")
         
         # Get the quota record for the user
-        quota = await Quota.filter(user=str(user_id)).first()
+        quota = await repository.get_quota(user_id)
         if not quota:
             raise HTTPException(status_code=404, detail="Quota not found")
             
@@ -292,61 +435,44 @@ async def manage_quotas(user_id: int):
     """
     Manage quotas for a user based on their subscription plan.
     
-    Quota limits:
+    The quota comes from the plan catalog (see app.services.plans); its
+    defaults are:
     - Light: 2000 units
     - Standard: 5000 units
-    - Premium: 12000 units
+    - Pro: 12000 units
     - Free: 100 units
     """
     try:
-        # Get the subscription record for the user
-        subscription = await UserSubscription.filter(user=str(user_id)).first()
-        if not subscription:
-            raise HTTPException(status_code=404, detail="Subscription not found")
-        
-        # Define quota limits based on subscription plan
-        quota_limits = {
-            "light": 2000,
-            "standard": 5000,
-            "premium": 12000,
-            "free": 100
-        }
-        
-        # Get the quota limit for the subscription plan
-        quota_limit = quota_limits.get(subscription.subscription_plan.lower())
-        if not quota_limit:
+        catalog = list(plans.all_plans())
+        rows = await shards.for_user(user_id).execute_query_dict(MANAGE_QUOTA_SQL, [
+            str(user_id),
+            [plan.plan for plan in catalog], [plan.frequency for plan in catalog], [plan.quota for plan in catalog],
+            subscription_events.CHANNEL, subscription_events.payload(user_id, "quota_updated"),
+        ])
+        if not rows:
+            # Nothing was written; find out why
+            subscription = await repository.get_subscription(user_id)
+            if not subscription:
+                raise HTTPException(status_code=404, detail="Subscription not found")
             raise HTTPException(status_code=400, detail=f"Invalid subscription plan: {subscription.subscription_plan}")
-        
-        # Get the quota record for the user
-        quota = await Quota.filter(user=str(user_id)).first()
-        if not quota:
-            # Create a new quota record
-            quota = Quota(
-                user=str(user_id),
-                total=quota_limit,
-                used=0
-            )
-            await quota.save()
-            logger.info(f"Created new quota for user {user_id} with limit {quota_limit}")
-        else:
-            # Update the quota
-            quota.total = quota_limit
-            # Only reset used quota if subscription plan changed
-            if quota.total != quota_limit:
-                quota.used = 0
-            await quota.save()
-            logger.info(f"Updated quota for user {user_id} to limit {quota_limit}")
-            
+
+        subscription_events.notified()
+        usage_accumulator.invalidate(user_id)
+        quota = rows[0]
+        logger.debug("Set quota of user %s to %s", user_id, quota["total"])
+
         return {
             "status": "success",
             "message": "Quota managed successfully",
             "quota": {
-                "total": quota.total,
-                "used": quota.used,
-                "remaining": quota.total - quota.used
+                "total": quota["total"],
+                "used": quota["used"],
+                "remaining": quota["total"] - quota["used"]
             }
         }
         
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Error managing quotas: {str(e)}")
         logger.exception("Full traceback:")
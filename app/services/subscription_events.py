@@ -0,0 +1,216 @@
+"""
+Push subscription changes to clients over Server-Sent Events.
+
+Writes to a user's subscription or quota call `notify`, which sends a
+NOTIFY on the user's shard with the user ID as payload. Notifications are
+transactional, so listeners only hear about committed changes.
+
+Each worker keeps one LISTEN connection per shard, taken from the pool the
+first time a client subscribes. `hub` hands every notification to the
+queues of the SSE streams open in this worker for that user, and each
+stream then sends the user's current subscription. When a LISTEN
+connection is lost, the supervisor task reconnects it and tells every
+stream to resend, since notifications sent meanwhile are gone.
+
+Other modules can also follow the notifications of every user with
+`hub.add_handler`, e.g. to drop per-worker caches. Handlers are called
+with the user ID and event, and with (None, RESYNC) after a reconnect.
+Registering one makes the worker listen from startup.
+"""
+
+import asyncio
+import json
+import logging
+import os
+from typing import Callable, Dict, List, Optional, Set
+
+from tortoise import Tortoise
+
+from app.database import SHARD_CONNECTIONS
+from app.services import background, metrics, repository, shards
+
+logger = logging.getLogger(__name__)
+
+CHANNEL = "subscription_events"
+SSE_KEEPALIVE_INTERVAL = float(os.getenv("SSE_KEEPALIVE_INTERVAL", "15"))
+SSE_QUEUE_SIZE = 16
+LISTEN_CHECK_INTERVAL = float(os.getenv("LISTEN_CHECK_INTERVAL", "5"))
+
+# Queued in place of a user ID when a stream must resend its state
+RESYNC = "*"
+
+NOTIFY_SQL = "SELECT pg_notify($1, $2)"
+
+_notified = metrics.counter("subscription_events.notified")
+_delivered = metrics.counter("subscription_events.delivered")
+_dropped = metrics.counter("subscription_events.dropped")
+_streams = metrics.gauge("subscription_events.streams")
+
+
+def payload(user_id, event: str) -> str:
+    """The NOTIFY payload, for statements that send the notification themselves."""
+    return json.dumps({"user": str(user_id), "event": event})
+
+
+def notified() -> None:
+    _notified.inc()
+
+
+async def notify(user_id, event: str) -> None:
+    """Tell every worker's listeners that a user's subscription changed."""
+    await shards.for_user(user_id).execute_query_dict(NOTIFY_SQL, [CHANNEL, payload(user_id, event)])
+    notified()
+
+
+class SubscriptionEventHub:
+    def __init__(self):
+        # user id -> queues of the streams open for that user
+        self._queues: Dict[str, Set[asyncio.Queue]] = {}
+        # shard connection name -> (pool connection wrapper, asyncpg connection)
+        self._listeners: Dict[str, tuple] = {}
+        self._handlers: List[Callable[[Optional[str], str], None]] = []
+        self._lock = asyncio.Lock()
+
+    def add_handler(self, handler: Callable[[Optional[str], str], None]) -> None:
+        """Call `handler(user_id, event)` for every notification this worker receives."""
+        self._handlers.append(handler)
+
+    def _call_handlers(self, user: Optional[str], event: str) -> None:
+        for handler in self._handlers:
+            try:
+                handler(user, event)
+            except Exception:
+                logger.exception("Subscription event handler %r failed", handler)
+
+    def subscribe(self, user_id) -> asyncio.Queue:
+        queue: asyncio.Queue = asyncio.Queue(maxsize=SSE_QUEUE_SIZE)
+        self._queues.setdefault(str(user_id), set()).add(queue)
+        self._count_streams()
+        return queue
+
+    def unsubscribe(self, user_id, queue: asyncio.Queue) -> None:
+        queues = self._queues.get(str(user_id))
+        if queues and queue in queues:
+            queues.discard(queue)
+            if not queues:
+                del self._queues[str(user_id)]
+            self._count_streams()
+
+    def _count_streams(self) -> None:
+        _streams.set(sum(len(queues) for queues in self._queues.values()))
+
+    def _put(self, queue: asyncio.Queue, item: str) -> None:
+        try:
+            queue.put_nowait(item)
+            _delivered.inc()
+        except asyncio.QueueFull:
+            # The stream already has a resend pending, which covers this one
+            _dropped.inc()
+
+    def _on_notification(self, connection, pid, channel, payload: str) -> None:
+        try:
+            message = json.loads(payload)
+            user, event = message["user"], message.get("event", "")
+        except (ValueError, KeyError, TypeError):
+            logger.warning("Ignoring malformed %s payload: %.200s", CHANNEL, payload)
+            return
+        self._call_handlers(user, event)
+        for queue in self._queues.get(user, ()):
+            self._put(queue, user)
+
+    async def ensure_listening(self) -> None:
+        """Open the LISTEN connection of every shard that does not have a live one."""
+        async with self._lock:
+            reconnected = False
+            for name in SHARD_CONNECTIONS:
+                listener = self._listeners.get(name)
+                if listener is not None and not listener[1].is_closed():
+                    continue
+                if listener is not None:
+                    await self._release(name)
+                    reconnected = True
+                wrapper = Tortoise.get_connection(name).acquire_connection()
+                connection = await wrapper.__aenter__()
+                try:
+                    await connection.add_listener(CHANNEL, self._on_notification)
+                except BaseException:
+                    await wrapper.__aexit__(None, None, None)
+                    raise
+                self._listeners[name] = (wrapper, connection)
+                logger.info("Listening for %s on %s", CHANNEL, name)
+
+        if reconnected:
+            self._call_handlers(None, RESYNC)
+            for queues in self._queues.values():
+                for queue in queues:
+                    self._put(queue, RESYNC)
+
+    async def _release(self, name: str) -> None:
+        wrapper, connection = self._listeners.pop(name)
+        try:
+            if not connection.is_closed():
+                await connection.remove_listener(CHANNEL, self._on_notification)
+        finally:
+            await wrapper.__aexit__(None, None, None)
+
+    async def check(self) -> None:
+        if self._listeners or self._handlers:
+            await self.ensure_listening()
+
+    async def close(self) -> None:
+        async with self._lock:
+            for name in list(self._listeners):
+                await self._release(name)
+
+
+hub = SubscriptionEventHub()
+
+background.periodic("subscription-events-listen", LISTEN_CHECK_INTERVAL, run_at_start=True)(hub.check)
+background.on_shutdown(hub.close)
+
+
+async def current_state(user_id) -> dict:
+    subscription = await repository.get_subscription(user_id)
+    if not subscription:
+        return {"user": str(user_id), "subscription": None}
+    quota = await repository.get_quota(user_id)
+    return {
+        "user": str(user_id),
+        "subscription": {
+            "subscription_plan": subscription.subscription_plan,
+            "subscription_frequency": subscription.subscription_frequency,
+            "is_active": subscription.is_active,
+            "start_date": subscription.start_date.isoformat() if subscription.start_date else None,
+            "end_date": subscription.end_date.isoformat() if subscription.end_date else None,
+        },
+        "quota": quota.total if quota else None,
+    }
+
+
+def _sse(data: dict, event: str = "subscription") -> str:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+async def stream(request, user_id):
+    """
+    Yield SSE messages with a user's subscription, now and after each change.
+
+    Bursts of changes are coalesced into one message. A comment line is
+    sent after SSE_KEEPALIVE_INTERVAL seconds of quiet so proxies keep the
+    connection open.
+    """
+    queue = hub.subscribe(user_id)
+    try:
+        await hub.ensure_listening()
+        yield _sse(await current_state(user_id))
+        while not await request.is_disconnected():
+            try:
+                await asyncio.wait_for(queue.get(), SSE_KEEPALIVE_INTERVAL)
+            except asyncio.TimeoutError:
+                yield ": keepalive\n\n"
+                continue
+            while not queue.empty():
+                queue.get_nowait()
+            yield _sse(await current_state(user_id))
+    finally:
+        hub.unsubscribe(user_id, queue)
@@ -0,0 +1,105 @@
+"""
+Background sweeper that deactivates expired subscriptions.
+
+Every SUBSCRIPTION_SWEEP_INTERVAL seconds, active subscriptions whose
+end_date passed more than SUBSCRIPTION_SWEEP_GRACE seconds ago are flipped
+to inactive and their quota is downgraded to the free tier, in batches of
+SUBSCRIPTION_SWEEP_BATCH_SIZE. Renewals move end_date forward through the
+customer.subscription.updated webhook; the grace period, longer than the
+reconciliation interval, leaves time for a late or lost webhook to be
+replayed from Stripe before a paying customer is downgraded. A downgrade
+starts the quota over, as every other change of total does. Each batch
+is a single statement, so deactivation and downgrade commit together. The
+batch scan uses the partial index on end_date of active subscriptions, and
+SKIP LOCKED lets several workers sweep concurrently without blocking each
+other or webhook writes. Every shard is swept, concurrently.
+"""
+
+import asyncio
+import logging
+import os
+import time
+
+from app.services import background, metrics, plans, shards
+from app.services.usage import accumulator as usage_accumulator
+
+logger = logging.getLogger(__name__)
+
+SUBSCRIPTION_SWEEP_INTERVAL = float(os.getenv("SUBSCRIPTION_SWEEP_INTERVAL", "60"))
+SUBSCRIPTION_SWEEP_BATCH_SIZE = int(os.getenv("SUBSCRIPTION_SWEEP_BATCH_SIZE", "500"))
+SUBSCRIPTION_SWEEP_GRACE = float(os.getenv("SUBSCRIPTION_SWEEP_GRACE", "3600"))
+
+SWEEP_SQL = """
+    WITH expired AS (
+        SELECT "id" FROM "usersubscription"
+        WHERE "is_active" AND "end_date" < now() - make_interval(secs => $3)
+        ORDER BY "end_date"
+        LIMIT $1
+        FOR UPDATE SKIP LOCKED
+    ), deactivated AS (
+        UPDATE "usersubscription" AS s SET "is_active" = FALSE, "updated_at" = now()
+        FROM expired WHERE s."id" = expired."id"
+        RETURNING s."user"
+    ), downgraded AS (
+        UPDATE "quota" AS q
+        SET "total" = $2,
+            "used" = CASE WHEN q."total" = $2 THEN q."used" ELSE 0 END,
+            "checkpoint_at" = CASE WHEN q."total" = $2 THEN q."checkpoint_at" ELSE now() END,
+            "checkpoint_txid" = CASE WHEN q."total" = $2 THEN q."checkpoint_txid"
+                ELSE pg_current_xact_id()::text::bigint END,
+            "updated_at" = now()
+        FROM deactivated WHERE q."user" = deactivated."user"
+        RETURNING q."id"
+    )
+    SELECT
+        (SELECT coalesce(array_agg("user"), '{}') FROM deactivated) AS "users",
+        (SELECT count(*) FROM downgraded) AS "downgraded"
+"""
+
+_deactivated = metrics.counter("sweeper.deactivated")
+_downgraded = metrics.counter("sweeper.quotas_downgraded")
+_batch_latency = metrics.summary("sweeper.batch_latency_ms")
+_throughput = metrics.gauge("sweeper.last_run_per_second")
+
+
+async def _sweep_shard(conn, batch_size: int, free_quota: int) -> int:
+    total = 0
+    while True:
+        batch_started = time.perf_counter()
+        rows = await conn.execute_query_dict(SWEEP_SQL, [batch_size, free_quota, SUBSCRIPTION_SWEEP_GRACE])
+        _batch_latency.observe((time.perf_counter() - batch_started) * 1000)
+
+        users = rows[0]["users"]
+        _deactivated.inc(len(users))
+        _downgraded.inc(rows[0]["downgraded"])
+        for user in users:
+            usage_accumulator.invalidate(user)
+
+        total += len(users)
+        if len(users) < batch_size:
+            return total
+
+
+async def sweep_expired_subscriptions(batch_size: int = SUBSCRIPTION_SWEEP_BATCH_SIZE) -> int:
+    """
+    Deactivate every expired subscription, on every shard, and downgrade its quota.
+
+    Returns:
+        int: The number of subscriptions deactivated
+    """
+    free_quota = plans.quota("free")
+    started = time.perf_counter()
+    total = sum(await asyncio.gather(
+        *(_sweep_shard(conn, batch_size, free_quota) for conn in shards.all_shards())
+    ))
+
+    elapsed = time.perf_counter() - started
+    if total:
+        _throughput.set(round(total / elapsed, 1))
+        logger.info(
+            "Deactivated %s expired subscriptions in %.2fs (%.0f/s)", total, elapsed, total / elapsed
+        )
+    return total
+
+
+background.periodic("subscription-sweeper", SUBSCRIPTION_SWEEP_INTERVAL)(sweep_expired_subscriptions)
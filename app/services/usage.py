@@ -0,0 +1,273 @@
+"""
+Write-behind aggregation of quota usage.
+
+Metered actions call `record_usage`, which admits or rejects the request
+against an in-memory view of the user's quota and buffers the increment.
+Buffered increments are appended to the usage_event ledger in a single
+multi-row INSERT every USAGE_FLUSH_INTERVAL_MS, or sooner once
+USAGE_FLUSH_MAX_UNITS have accumulated, instead of one write per action.
+Each user's rows go to the ledger on the user's shard, next to their quota,
+with one INSERT per shard.
+A user's current usage is `quota.used`, the checkpoint that
+app.services.ledger advances periodically, plus the ledger rows it has
+not rolled in yet: those whose transaction ID is at or after
+`quota.checkpoint_txid`. Units held by open reservations
+(`quota.reserved`, see app.services.reservations) count as used here, so
+metered actions cannot spend them.
+
+Over-consumption is bounded: a worker never holds more than
+USAGE_MAX_UNFLUSHED_PER_USER unwritten units for one user. When that bound
+would be crossed the increment waits for a flush, which also refreshes the
+user's stored totals, so a user can exceed their quota by at most
+(bound x worker count) units. Units in a flush that has not finished yet
+still count towards the bound and towards the user's usage. If the flush an
+increment waits for fails, the increment is rejected as if the quota were
+exhausted; the flushed units are kept for the next attempt.
+"""
+
+import asyncio
+import logging
+import os
+import time
+from typing import Dict, Optional, Tuple
+
+from fastapi import HTTPException
+from tortoise import Tortoise
+
+from app.services import background, metrics, shards
+
+logger = logging.getLogger(__name__)
+
+USAGE_FLUSH_INTERVAL_MS = int(os.getenv("USAGE_FLUSH_INTERVAL_MS", "200"))
+USAGE_FLUSH_MAX_UNITS = int(os.getenv("USAGE_FLUSH_MAX_UNITS", "1000"))
+USAGE_MAX_UNFLUSHED_PER_USER = int(os.getenv("USAGE_MAX_UNFLUSHED_PER_USER", "50"))
+# How long a cached (total, used) pair is trusted before it is re-read
+USAGE_QUOTA_CACHE_TTL = float(os.getenv("USAGE_QUOTA_CACHE_TTL", "5"))
+
+DEFAULT_FEATURE = "default"
+
+# Whether ledger row e is not yet rolled into quota q. Rows written before
+# transaction IDs were recorded have txid 0 and fall back to comparing
+# created_at with checkpoint_at.
+UNSETTLED = '(e."txid" >= q."checkpoint_txid" AND (e."txid" > 0 OR e."created_at" > q."checkpoint_at"))'
+
+# Usage since the checkpoint, summed from the ledger. The ledger index on
+# (user, txid) keeps this to the few rows written since then.
+LEDGER_SINCE_CHECKPOINT = f"""
+    LEFT JOIN LATERAL (
+        SELECT sum(e."units") AS "units" FROM "usage_event" AS e
+        WHERE e."user" = q."user" AND {UNSETTLED}
+    ) AS l ON TRUE
+"""
+
+USAGE_SQL = f"""
+    SELECT q."total", q."used" + coalesce(l."units", 0) AS "used", q."reserved"
+    FROM "quota" AS q {LEDGER_SINCE_CHECKPOINT}
+    WHERE q."user" = $1
+    LIMIT 1
+"""
+
+# Increments are passed as parallel arrays so the statement text never
+# changes with batch size and stays a single cached prepared statement.
+# The outer SELECT does not see the rows the CTE inserts, so the batch is
+# added to the usage it reports.
+FLUSH_SQL = f"""
+    WITH inserted AS (
+        INSERT INTO "usage_event" ("user", "feature", "units", "created_at")
+        SELECT v."user", v."feature", v."units", now()
+        FROM unnest($1::varchar[], $2::varchar[], $3::int[]) AS v("user", "feature", "units")
+    ), batch AS (
+        SELECT v."user", sum(v."units") AS "units"
+        FROM unnest($1::varchar[], $3::int[]) AS v("user", "units")
+        GROUP BY v."user"
+    )
+    SELECT q."user", q."total", q."used" + coalesce(l."units", 0) + b."units" AS "used", q."reserved"
+    FROM batch AS b
+    JOIN "quota" AS q ON q."user" = b."user" {LEDGER_SINCE_CHECKPOINT}
+"""
+
+
+class QuotaExceeded(Exception):
+    pass
+
+
+class UsageAccumulator:
+    def __init__(
+        self,
+        flush_max_units: int = USAGE_FLUSH_MAX_UNITS,
+        max_unflushed_per_user: int = USAGE_MAX_UNFLUSHED_PER_USER,
+        cache_ttl: float = USAGE_QUOTA_CACHE_TTL,
+    ):
+        self.flush_max_units = flush_max_units
+        self.max_unflushed_per_user = max_unflushed_per_user
+        self.cache_ttl = cache_ttl
+        self.flush_task: Optional[background.PeriodicTask] = None
+
+        # user id -> units consumed but not yet written
+        self._pending: Dict[str, int] = {}
+        # (user id, feature) -> the same units, as they will be written to the ledger
+        self._features: Dict[Tuple[str, str], int] = {}
+        self._pending_units = 0
+        # user id -> units taken out of _pending by a flush that has not finished
+        self._inflight: Dict[str, int] = {}
+        # user id -> (total, used or reserved, loaded_at) as last read from or written to the database
+        self._quotas: Dict[str, Tuple[int, int, float]] = {}
+        self._flush_lock = asyncio.Lock()
+
+        self._flush_users = metrics.summary("usage.flush.users")
+        self._flush_units = metrics.summary("usage.flush.units")
+        self._flush_latency = metrics.summary("usage.flush.latency_ms")
+        self._flush_errors = metrics.counter("usage.flush.errors")
+        self._rejected = metrics.counter("usage.rejected")
+        self._pending_gauge = metrics.gauge("usage.pending_units")
+
+    def pending(self, user_id) -> int:
+        """Units a user consumed that are not yet in the stored totals, including those being flushed."""
+        user = str(user_id)
+        return self._pending.get(user, 0) + self._inflight.get(user, 0)
+
+    def invalidate(self, user_id) -> None:
+        """Forget the cached quota of a user, e.g. after their plan changed."""
+        self._quotas.pop(str(user_id), None)
+
+    async def _load_quota(self, user: str) -> Tuple[int, int]:
+        cached = self._quotas.get(user)
+        if cached is not None and time.monotonic() - cached[2] < self.cache_ttl:
+            return cached[0], cached[1]
+
+        rows = await shards.for_user(user).execute_query_dict(USAGE_SQL, [user])
+        if not rows:
+            raise HTTPException(status_code=404, detail="Quota not found")
+        total, used = rows[0]["total"], int(rows[0]["used"]) + rows[0]["reserved"]
+        self._quotas[user] = (total, used, time.monotonic())
+        return total, used
+
+    async def add(self, user_id, units: int, feature: str = DEFAULT_FEATURE) -> int:
+        """
+        Consume `units` of a user's quota.
+
+        Returns:
+            int: Units remaining after this increment, as seen by this worker
+
+        Raises:
+            QuotaExceeded: If the increment would take the user over their
+                quota, or the flush it had to wait for failed
+        """
+        user = str(user_id)
+
+        while self.pending(user) and self.pending(user) + units > self.max_unflushed_per_user:
+            try:
+                await self.flush()
+            except Exception:
+                logger.warning("Rejecting usage of user %s; their buffered usage could not be flushed", user)
+                self._rejected.inc()
+                raise QuotaExceeded(user)
+
+        total, used = await self._load_quota(user)
+        pending = self.pending(user)
+        if used + pending + units > total:
+            self._rejected.inc()
+            raise QuotaExceeded(user)
+
+        self._pending[user] = self._pending.get(user, 0) + units
+        self._features[(user, feature)] = self._features.get((user, feature), 0) + units
+        self._pending_units += units
+        self._pending_gauge.set(self._pending_units)
+
+        if self._pending_units >= self.flush_max_units and self.flush_task is not None:
+            self.flush_task.trigger()
+        return total - used - pending - units
+
+    async def _flush_shard(self, name: str, features: Dict[Tuple[str, str], int]) -> None:
+        try:
+            rows = await Tortoise.get_connection(name).execute_query_dict(FLUSH_SQL, [
+                [user for user, _ in features],
+                [feature for _, feature in features],
+                list(features.values()),
+            ])
+        except Exception:
+            # Put the increments back so the next flush retries them
+            self._settle(features)
+            for (user, feature), units in features.items():
+                self._pending[user] = self._pending.get(user, 0) + units
+                self._features[(user, feature)] = self._features.get((user, feature), 0) + units
+                self._pending_units += units
+            self._pending_gauge.set(self._pending_units)
+            self._flush_errors.inc()
+            raise
+
+        now = time.monotonic()
+        for row in rows:
+            self._quotas[row["user"]] = (row["total"], int(row["used"]) + row["reserved"], now)
+        self._settle(features)
+
+    def _settle(self, features: Dict[Tuple[str, str], int]) -> None:
+        """Stop counting flushed units as in flight."""
+        for (user, _), units in features.items():
+            left = self._inflight.get(user, 0) - units
+            if left > 0:
+                self._inflight[user] = left
+            else:
+                self._inflight.pop(user, None)
+
+    async def flush(self) -> None:
+        """Write every buffered increment, in one statement per shard."""
+        async with self._flush_lock:
+            if not self._pending:
+                return
+            batch, self._pending = self._pending, {}
+            features, self._features = self._features, {}
+            batch_units, self._pending_units = self._pending_units, 0
+            self._inflight = dict(batch)
+            self._pending_gauge.set(0)
+
+            by_shard: Dict[str, Dict[Tuple[str, str], int]] = {}
+            for (user, feature), units in features.items():
+                by_shard.setdefault(shards.name_for_user(user), {})[(user, feature)] = units
+
+            started = time.perf_counter()
+            results = await asyncio.gather(
+                *(self._flush_shard(name, shard_features) for name, shard_features in by_shard.items()),
+                return_exceptions=True,
+            )
+            for result in results:
+                if isinstance(result, BaseException):
+                    raise result
+
+            self._flush_latency.observe((time.perf_counter() - started) * 1000)
+            self._flush_users.observe(len(batch))
+            self._flush_units.observe(batch_units)
+            logger.debug("Flushed %s usage units for %s users", batch_units, len(batch))
+
+
+accumulator = UsageAccumulator()
+accumulator.flush_task = background.register(
+    background.PeriodicTask("usage-flush", USAGE_FLUSH_INTERVAL_MS / 1000, accumulator.flush)
+)
+background.on_shutdown(accumulator.flush)
+
+
+async def record_usage(user_id: int, units: int, feature: str = DEFAULT_FEATURE):
+    """
+    Record that a user consumed units of their quota.
+
+    Args:
+        user_id (int): The ID of the user
+        units (int): The number of units consumed
+        feature (str): The feature the units were spent on
+
+    Returns:
+        dict: A dictionary containing the remaining quota
+    """
+    if units <= 0:
+        raise HTTPException(status_code=400, detail="Units must be positive")
+    if not feature or len(feature) > 50:
+        raise HTTPException(status_code=400, detail="Invalid feature")
+    try:
+        remaining = await accumulator.add(user_id, units, feature)
+    except QuotaExceeded:
+        raise HTTPException(status_code=429, detail="Quota exceeded")
+    return {
+        "status": "success",
+        "remaining": remaining
+    }
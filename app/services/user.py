@@ -1,18 +1,75 @@
 from passlib.context import CryptContext
 from fastapi import HTTPException
-from app.models.user import User, User_Pydantic, OTPSystem, OTP_Pydantic, UserRegister, OTPVerify
-from typing import List
+from app.models.user import User, User_Pydantic, OTPSystem, OTP_Pydantic, UserRegister, OTPVerify, UserDirectory
+from app.models.subscription import SyncState
+from typing import List, Optional
 from datetime import datetime, timedelta, timezone
 import random
 import string
+from tortoise import Tortoise
 from tortoise.exceptions import IntegrityError
 from app.services.smtp import send_email
+from app.services import repository, shards
 from tortoise.signals import post_save
 import logging
 from fastapi.responses import JSONResponse
 
 logger = logging.getLogger(__name__)
 
+DELETE_USER_SQL = """
+    WITH deleted AS (
+        UPDATE "users" SET "deleted_at" = $2, "is_active" = FALSE, "updated_at" = $2
+        WHERE "email" = $1 AND "deleted_at" IS NULL
+        RETURNING "id"::varchar AS "user"
+    ), subscriptions AS (
+        UPDATE "usersubscription" AS s SET "is_active" = FALSE, "updated_at" = now()
+        FROM deleted AS d WHERE s."user" = d."user"
+    ), quotas AS (
+        UPDATE "quota" AS q SET "updated_at" = now()
+        FROM deleted AS d WHERE q."user" = d."user"
+    )
+    SELECT "user" FROM deleted
+"""
+
+DIRECTORY_BACKFILLED_KEY = "user_directory.backfilled_at"
+DIRECTORY_BACKFILL_BATCH_SIZE = 1000
+
+USERS_PAGE_SQL = 'SELECT "id", "email", "username" FROM "users" WHERE "id" > $1 ORDER BY "id" LIMIT $2'
+
+BACKFILL_DIRECTORY_SQL = """
+    INSERT INTO "user_directory" ("email", "username", "user_id", "created_at")
+    SELECT v."email", v."username", v."user_id", now()
+    FROM unnest($1::varchar[], $2::varchar[], $3::int[]) AS v("email", "username", "user_id")
+    ON CONFLICT DO NOTHING
+"""
+
+# Trigram indexes cannot narrow down shorter queries
+SEARCH_MIN_QUERY_LENGTH = 3
+SEARCH_MAX_LIMIT = 100
+
+# Prefix matches rank above fuzzy ones; the pg_trgm GIN indexes on email,
+# username and full_name find the matches. The score is computed per query,
+# so no index returns them in order: every page still scores and sorts all
+# matches. Paging by keyset on (score, id) only spares deep pages the cost of
+# an OFFSET, and keeps pages stable while users are added.
+SEARCH_USERS_SQL = """
+    WITH matches AS (
+        SELECT "id", "email", "username", "full_name", "is_active", "is_superuser", "created_at",
+               ((CASE WHEN "email" ILIKE $2 OR "username" ILIKE $2 OR "full_name" ILIKE $2
+                      THEN 1 ELSE 0 END)
+                + greatest(word_similarity($1, "email"), word_similarity($1, "username"),
+                           word_similarity($1, coalesce("full_name", ''))))::real AS "score"
+        FROM "users"
+        WHERE "deleted_at" IS NULL
+          AND ("email" ILIKE $2 OR "username" ILIKE $2 OR "full_name" ILIKE $2
+               OR $1 <% "email" OR $1 <% "username" OR $1 <% "full_name")
+    )
+    SELECT * FROM matches
+    WHERE $3::real IS NULL OR "score" < $3 OR ("score" = $3 AND "id" > $4)
+    ORDER BY "score" DESC, "id"
+    LIMIT $5
+"""
+
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 
 def get_password_hash(password: str) -> str:
@@ -21,63 +78,163 @@ def get_password_hash(password: str) -> str:
 def verify_password(plain_password: str, hashed_password: str) -> bool:
     return pwd_context.verify(plain_password, hashed_password)
 
-async def get_user_by_email(email: str) -> User:
-    return await User.get_or_none(email=email)
+async def get_user_by_email(email: str) -> Optional[repository.Row]:
+    """Look up an active account by email, returning a read-only row."""
+    return await repository.get_user_by_email(email)
 
 async def get_user_by_username(username: str) -> User:
-    return await User.get_or_none(username=username)
+    return await _find_user(username=username, deleted_at__isnull=True)
+
+async def _find_user(**filters) -> Optional[User]:
+    """Find a user on whichever shard holds it"""
+    users = await shards.fan_out(lambda db: User.filter(**filters).using_db(db).first())
+    return next((user for user in users if user), None)
+
+def _duplicate_error(error: IntegrityError) -> Exception:
+    if "email" in str(error):
+        return ValueError("Email already exists")
+    if "username" in str(error):
+        return ValueError("Username already exists")
+    return error
 
 async def create_user(user_data: UserRegister) -> User_Pydantic:
     """Create a new user"""
     try:
         # Hash the password
         hashed_password = get_password_hash(user_data.password)
-        
-        # Create user with hashed password
-        user = await User.create(
-            email=user_data.email,
-            username=user_data.username,
-            hashed_password=hashed_password,
-            full_name=user_data.full_name
-        )
+
+        # Each shard only enforces unique emails and usernames among its own
+        # rows, so they are claimed in the directory first
+        entry = await UserDirectory.create(email=user_data.email, username=user_data.username)
+        try:
+            # Create user with hashed password
+            user = await User.create(
+                email=user_data.email,
+                username=user_data.username,
+                hashed_password=hashed_password,
+                full_name=user_data.full_name,
+                using_db=shards.for_new_user()
+            )
+        except BaseException:
+            await entry.delete()
+            raise
+        entry.user_id = user.id
+        await entry.save(update_fields=["user_id"])
         return await User_Pydantic.from_tortoise_orm(user)
     except IntegrityError as e:
-        if "email" in str(e):
-            raise ValueError("Email already exists")
-        elif "username" in str(e):
-            raise ValueError("Username already exists")
-        raise e
+        raise _duplicate_error(e)
+
+async def backfill_user_directory() -> None:
+    """
+    Add the users of every shard to the directory.
+
+    Runs at startup until it has completed once; users created later are
+    added by create_user.
+    """
+    if await SyncState.exists(key=DIRECTORY_BACKFILLED_KEY):
+        return
+    directory = Tortoise.get_connection("default")
+    for db in shards.all_shards():
+        last_id = 0
+        while True:
+            rows = await db.execute_query_dict(USERS_PAGE_SQL, [last_id, DIRECTORY_BACKFILL_BATCH_SIZE])
+            if not rows:
+                break
+            await directory.execute_query(BACKFILL_DIRECTORY_SQL, [
+                [row["email"] for row in rows],
+                [row["username"] for row in rows],
+                [row["id"] for row in rows],
+            ])
+            last_id = rows[-1]["id"]
+    await SyncState.update_or_create(
+        key=DIRECTORY_BACKFILLED_KEY, defaults={"value": datetime.now(timezone.utc).isoformat()}
+    )
+    logger.info("Backfilled the user directory from %s shards", shards.shard_count())
 
 async def get_all_users() -> list[User_Pydantic]:
     """Get all users"""
-    return await User_Pydantic.from_queryset(User.all())
+    per_shard = await shards.fan_out(
+        lambda db: User_Pydantic.from_queryset(User.filter(deleted_at__isnull=True).using_db(db))
+    )
+    return sorted((user for users in per_shard for user in users), key=lambda user: user.created_at)
+
+def _like_prefix(query: str) -> str:
+    escaped = query.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+    return escaped + "%"
+
+
+async def search_users(query: str, limit: int = 20, cursor: str = None) -> dict:
+    """
+    Search users by email, username or full name.
+
+    Args:
+        query (str): A prefix of, or a close match for, one of the fields
+        limit (int): The maximum number of users to return
+        cursor (str, optional): The `next_cursor` of the previous page
+
+    Returns:
+        dict: The matching users, best match first, and the cursor of the next page
+    """
+    query = query.strip().lower()
+    if len(query) < SEARCH_MIN_QUERY_LENGTH:
+        raise ValueError(f"Query must be at least {SEARCH_MIN_QUERY_LENGTH} characters")
+    if not 0 < limit <= SEARCH_MAX_LIMIT:
+        raise ValueError(f"Limit must be between 1 and {SEARCH_MAX_LIMIT}")
+
+    after_score, after_id = None, None
+    if cursor:
+        try:
+            score, user_id = cursor.split(":")
+            after_score, after_id = float(score), int(user_id)
+        except ValueError:
+            raise ValueError("Invalid cursor")
+
+    # Every shard returns its own best `limit` matches after the cursor
+    params = [query, _like_prefix(query), after_score, after_id, limit]
+    per_shard = await shards.fan_out(lambda db: db.execute_query_dict(SEARCH_USERS_SQL, params))
+    rows = sorted((row for rows in per_shard for row in rows), key=lambda row: (-row["score"], row["id"]))
+    rows = rows[:limit]
+    next_cursor = None
+    if len(rows) == limit:
+        next_cursor = f"{rows[-1]['score']!r}:{rows[-1]['id']}"
+    return {"results": rows, "next_cursor": next_cursor}
+
 
 async def get_user(user_id: int) -> User_Pydantic:
     """Get a user by ID"""
-    user = await User.get_or_none(id=user_id)
+    user = await User.filter(id=user_id, deleted_at__isnull=True).using_db(shards.for_user(user_id)).first()
     if not user:
         raise ValueError("User not found")
     return await User_Pydantic.from_tortoise_orm(user)
 
 async def update_user(user_id: int, user_data: dict) -> User_Pydantic:
     """Update a user"""
-    user = await User.get_or_none(id=user_id)
+    db = shards.for_user(user_id)
+    user = await User.filter(id=user_id, deleted_at__isnull=True).using_db(db).first()
     if not user:
         raise ValueError("User not found")
 
-    # Check for unique constraints
-    if "email" in user_data:
-        existing_user = await User.get_or_none(email=user_data["email"])
-        if existing_user and existing_user.id != user_id:
-            raise ValueError("Email already exists")
-
-    if "username" in user_data:
-        existing_user = await User.get_or_none(username=user_data["username"])
-        if existing_user and existing_user.id != user_id:
-            raise ValueError("Username already exists")
+    # Claim a new email or username in the directory, which keeps them
+    # unique across shards
+    previous = {field: getattr(user, field) for field in ("email", "username")}
+    claims = {
+        field: user_data[field]
+        for field in previous if field in user_data and user_data[field] != previous[field]
+    }
+    if claims:
+        try:
+            if not await UserDirectory.filter(user_id=user_id).update(**claims):
+                await UserDirectory.create(**{**previous, **claims}, user_id=user_id)
+        except IntegrityError as e:
+            raise _duplicate_error(e)
 
     # Update user
-    await user.update_from_dict(user_data).save()
+    try:
+        await user.update_from_dict(user_data).save(using_db=db)
+    except BaseException:
+        if claims:
+            await UserDirectory.filter(user_id=user_id).update(**previous)
+        raise
     return await User_Pydantic.from_tortoise_orm(user)
 
 
@@ -87,22 +244,23 @@ async def generate_otp(sender, instance, created, using_db=None, update_fields=N
     if created:
         try:
             # Check if user exists
-            user = await User.get_or_none(id=instance.id)
+            db = using_db or shards.for_user(instance.id)
+            user = await User.filter(id=instance.id).using_db(db).first()
             if not user:
                 raise ValueError("User not found")
             
             # Generate OTP
-            otp = await OTPSystem.create(user=user)
-            await otp.save()
+            otp = await OTPSystem.create(user=user, using_db=db)
+            await otp.save(using_db=db)
 
             # Ensure OTP is a string
             otp_str = str(otp.otp)
-            logger.info(f"Generated OTP for user {user.email}: {otp_str}")
+            logger.debug("Generated OTP for user %s", user.id)
 
             # Send email with OTP
             try:
                 await send_email(otp_str, user.username, user.email)
-                logger.info(f"OTP sent to {user.email}")
+                logger.info("OTP sent to user %s", user.id)
             except HTTPException as e:
                 logger.error(f"Error sending OTP to {user.email}: {e.detail}")
                 # Don't raise the exception, just log it
@@ -118,12 +276,13 @@ async def verify_otp(otp: str, recipient_email: str) -> dict:
     """Verify OTP for a user"""
     try:
         # Get user by email
-        user = await User.get_or_none(email=recipient_email)
+        user = await repository.get_user_by_email(recipient_email)
         if not user:
             raise ValueError("User not found")
 
         # Get the most recent OTP for the user
-        otp_record = await OTPSystem.filter(user=user).order_by('-created_at').first()
+        db = shards.for_user(user.id)
+        otp_record = await OTPSystem.filter(user_id=user.id).using_db(db).order_by('-created_at').first()
         if not otp_record:
             raise ValueError("No OTP found for this user")
 
@@ -137,16 +296,15 @@ async def verify_otp(otp: str, recipient_email: str) -> dict:
             raise ValueError("Invalid OTP")
 
         # Activate user
-        user.is_active = True
-        await user.save()
+        await User.filter(id=user.id).using_db(db).update(is_active=True, updated_at=current_time)
 
         # Delete used OTP
-        await otp_record.delete()
+        await otp_record.delete(using_db=db)
 
         return {
             "status": "success",
             "message": "OTP verified successfully",
-            "user": await User_Pydantic.from_tortoise_orm(user)
+            "user": User_Pydantic.model_validate({**dict(user), "is_active": True, "updated_at": current_time})
         }
 
     except ValueError as e:
@@ -163,10 +321,20 @@ async def verify_otp(otp: str, recipient_email: str) -> dict:
 
 
 async def delete_user(user_email: str) -> User_Pydantic:
-    """Delete a user by email"""
-    user = await User.get_or_none(email=user_email)
-    if not user:
+    """
+    Delete a user by email.
+
+    The user is only marked as deleted here; the row and everything that
+    belongs to it are removed in the background by app.services.purge.
+    Their subscription is deactivated and their quota touched in the same
+    statement, so every worker's entitlement snapshot drops them on its
+    next refresh.
+    """
+    deleted_at = datetime.now(timezone.utc)
+    deleted = sum(len(rows) for rows in await shards.fan_out(
+        lambda db: db.execute_query_dict(DELETE_USER_SQL, [user_email, deleted_at])
+    ))
+    if not deleted:
         raise ValueError("User not found")
-    await user.delete()
     return JSONResponse(content={"message": "User deleted successfully"})
     
\ No newline at end of file
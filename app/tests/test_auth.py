@@ -0,0 +1,100 @@
+import pytest
+from datetime import datetime, timedelta, timezone
+from unittest.mock import patch, AsyncMock, MagicMock
+from fastapi import HTTPException
+from tortoise.exceptions import IntegrityError
+from app.services import auth
+
+
+@pytest.fixture
+def secret():
+    with patch.object(auth, "JWT_SECRET_KEY", "test-secret"):
+        yield
+
+
+def make_user(user_id=7, is_superuser=False):
+    user = MagicMock()
+    user.id = user_id
+    user.is_superuser = is_superuser
+    return user
+
+
+def test_access_token_round_trip(secret):
+    tokens = auth.issue_tokens(make_user(is_superuser=True))
+
+    current = auth.decode_token(tokens["access_token"], "access")
+
+    assert current.id == 7
+    assert current.is_superuser is True
+    assert current.expires_at > datetime.now(timezone.utc)
+
+
+def test_refresh_token_is_not_an_access_token(secret):
+    tokens = auth.issue_tokens(make_user())
+
+    with pytest.raises(HTTPException) as exc:
+        auth.decode_token(tokens["refresh_token"], "access")
+    assert exc.value.status_code == 401
+
+
+def test_expired_token_is_rejected(secret):
+    token = auth.create_token(make_user(), "access", timedelta(seconds=-1))
+
+    with pytest.raises(HTTPException):
+        auth.decode_token(token, "access")
+
+
+def test_revoked_token_is_rejected(secret):
+    tokens = auth.issue_tokens(make_user())
+    current = auth.decode_token(tokens["access_token"], "access")
+
+    auth.revocations.add(current.jti, current.expires_at)
+
+    with pytest.raises(HTTPException):
+        auth.decode_token(tokens["access_token"], "access")
+
+
+@pytest.mark.asyncio
+@patch("app.services.auth.RevokedToken.create", new_callable=AsyncMock, side_effect=IntegrityError("duplicate"))
+@patch("app.services.auth.User.filter")
+async def test_refresh_token_is_single_use(user_filter, create, secret):
+    user = make_user()
+    user.is_active = True
+    user_filter.return_value.using_db.return_value.first = AsyncMock(return_value=user)
+    tokens = auth.issue_tokens(user)
+
+    with patch("app.services.auth.shards.for_user"), pytest.raises(HTTPException) as exc:
+        await auth.refresh(tokens["refresh_token"])
+
+    assert exc.value.status_code == 401
+
+
+@pytest.mark.asyncio
+@patch("app.services.auth.RevokedToken.create", new_callable=AsyncMock)
+async def test_logout_revokes_refresh_token(create, secret):
+    tokens = auth.issue_tokens(make_user())
+    current = auth.decode_token(tokens["access_token"], "access")
+
+    await auth.logout(current, tokens["refresh_token"])
+
+    assert create.await_count == 2
+    with pytest.raises(HTTPException):
+        auth.decode_token(tokens["refresh_token"], "refresh")
+
+
+@pytest.mark.asyncio
+@patch("app.services.auth.RevokedToken.filter")
+async def test_revocation_sync_rereads_overlap_window(revoked_filter):
+    now = datetime.now(timezone.utc)
+    late = {"jti": "late", "expires_at": now + timedelta(hours=1), "created_at": now - timedelta(seconds=2)}
+    newest = {"jti": "newest", "expires_at": now + timedelta(hours=1), "created_at": now}
+    revoked_filter.return_value.values = AsyncMock(side_effect=[[newest], [late, newest]])
+    revocations = auth.RevocationList()
+
+    await revocations.sync()
+    await revocations.sync()
+
+    # A revocation created before the newest one but committed after it is still picked up
+    assert "late" in revocations
+    since = revoked_filter.call_args.kwargs["created_at__gte"]
+    assert since == now - auth.REVOCATION_SYNC_OVERLAP
@@ -0,0 +1,67 @@
+import pytest
+from datetime import datetime, timezone
+from unittest.mock import patch, AsyncMock, MagicMock
+from app.services.entitlements import EntitlementSnapshot, PLAN_RANKS, QUOTA_DELTA_SQL
+
+
+def test_check_uses_plan_rank_and_remaining_quota():
+    snapshot = EntitlementSnapshot()
+    snapshot.plan_ranks["1"] = PLAN_RANKS["standard"]
+    snapshot.quotas["1"] = (100, 90)
+
+    assert snapshot.check(1, "light", 5) == (True, 10)
+    assert snapshot.check(1, "pro") == (False, 10)
+    assert snapshot.check(1, None, 11) == (False, 10)
+    # Users without an active subscription only get the free plan
+    assert snapshot.check(2, "free") == (True, 0)
+    assert snapshot.check(2, "light") == (False, 0)
+
+
+@pytest.mark.asyncio
+@patch("app.services.entitlements.Tortoise.get_connection")
+async def test_refresh_applies_deltas(mock_get_connection):
+    now = datetime.now(timezone.utc)
+    conn = MagicMock()
+    conn.execute_query_dict = AsyncMock(side_effect=[
+        [{"xmin": 500}],
+        [{"user": "1", "subscription_plan": "pro", "is_active": True, "updated_at": now}],
+        [{"user": "1", "total": 12000, "used": 10, "updated_at": now, "deleted": False}],
+        [{"xmin": 510}],
+        [{"user": "1", "subscription_plan": "pro", "is_active": False, "updated_at": now}],
+        [],
+    ])
+    mock_get_connection.return_value = conn
+    snapshot = EntitlementSnapshot()
+
+    assert await snapshot.refresh() == 2
+    assert snapshot.check(1, "pro", 100) == (True, 11990)
+
+    await snapshot.refresh()
+    assert snapshot.check(1, "pro") == (False, 11990)
+    assert snapshot.subscriptions_seen == {"default": now}
+    # The second refresh picks up ledger rows written since the first
+    assert conn.execute_query_dict.await_args.args[1][1] == 500
+    assert snapshot.ledger_seen == {"default": 510}
+
+
+@pytest.mark.asyncio
+@patch("app.services.entitlements.Tortoise.get_connection")
+async def test_refresh_drops_deleted_users(mock_get_connection):
+    now = datetime.now(timezone.utc)
+    conn = MagicMock()
+    conn.execute_query_dict = AsyncMock(side_effect=[
+        [{"xmin": 500}], [], [{"user": "1", "total": 100, "used": 0, "updated_at": now, "deleted": True}],
+    ])
+    mock_get_connection.return_value = conn
+    snapshot = EntitlementSnapshot()
+    snapshot.plan_ranks["1"] = PLAN_RANKS["pro"]
+    snapshot.quotas["1"] = (100, 0)
+
+    await snapshot.refresh()
+
+    assert snapshot.check(1, None, 1) == (False, 0)
+
+
+def test_quota_delta_counts_the_ledger_tail_and_tolerates_non_numeric_users():
+    assert "CASE WHEN q.\"user\" ~ '^[0-9]{1,9}$' THEN q.\"user\"::int END" in QUOTA_DELTA_SQL
+    assert 'coalesce(l."units", 0) AS "used"' in QUOTA_DELTA_SQL
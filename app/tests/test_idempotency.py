@@ -0,0 +1,84 @@
+import asyncio
+import pytest
+from unittest.mock import patch, AsyncMock, MagicMock
+from fastapi import FastAPI
+from httpx import AsyncClient, ASGITransport
+from app.services import idempotency
+
+
+def make_app(calls):
+    app = FastAPI()
+
+    @app.post("/api/v1/register")
+    async def register(payload: dict):
+        calls.append(payload)
+        await asyncio.sleep(0.01)
+        return {"id": len(calls)}
+
+    app.add_middleware(idempotency.IdempotencyMiddleware)
+    return app
+
+
+def connection(claimed=True, lookup=()):
+    conn = MagicMock()
+
+    async def execute_query_dict(sql, params=None):
+        if sql == idempotency.CLAIM_SQL:
+            return [{"key": params[0]}] if claimed else []
+        return list(lookup)
+
+    conn.execute_query_dict = AsyncMock(side_effect=execute_query_dict)
+    conn.execute_query = AsyncMock()
+    return conn
+
+
+@pytest.fixture(autouse=True)
+def fresh_store(monkeypatch):
+    monkeypatch.setattr(idempotency, "store", idempotency.IdempotencyStore())
+
+
+@pytest.mark.asyncio
+@patch("app.services.idempotency.Tortoise.get_connection")
+async def test_repeats_are_replayed_from_one_execution(get_connection):
+    conn = connection()
+    get_connection.return_value = conn
+    calls = []
+    headers = {"Idempotency-Key": "abc"}
+
+    async with AsyncClient(transport=ASGITransport(app=make_app(calls)), base_url="http://test") as client:
+        first, second = await asyncio.gather(
+            client.post("/api/v1/register", json={"email": "a@b.c"}, headers=headers),
+            client.post("/api/v1/register", json={"email": "a@b.c"}, headers=headers),
+        )
+        third = await client.post("/api/v1/register", json={"email": "a@b.c"}, headers=headers)
+
+    assert len(calls) == 1
+    assert first.json() == second.json() == third.json() == {"id": 1}
+    assert third.headers["idempotent-replayed"] == "true"
+    conn.execute_query_dict.assert_awaited_once()
+
+
+@pytest.mark.asyncio
+@patch("app.services.idempotency.Tortoise.get_connection")
+async def test_key_reused_with_other_body(get_connection):
+    get_connection.return_value = connection()
+    headers = {"Idempotency-Key": "abc"}
+
+    async with AsyncClient(transport=ASGITransport(app=make_app([])), base_url="http://test") as client:
+        await client.post("/api/v1/register", json={"email": "a@b.c"}, headers=headers)
+        response = await client.post("/api/v1/register", json={"email": "x@y.z"}, headers=headers)
+
+    assert response.status_code == 422
+
+
+@pytest.mark.asyncio
+@patch("app.services.idempotency.Tortoise.get_connection")
+async def test_claim_held_by_another_worker(get_connection):
+    get_connection.return_value = connection(claimed=False)
+    calls = []
+
+    async with AsyncClient(transport=ASGITransport(app=make_app(calls)), base_url="http://test") as client:
+        response = await client.post("/api/v1/register", json={}, headers={"Idempotency-Key": "abc"})
+
+    assert response.status_code == 409
+    assert calls == []
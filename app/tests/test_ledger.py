@@ -0,0 +1,108 @@
+from contextlib import asynccontextmanager
+from datetime import date, datetime, timezone
+
+import pytest
+from unittest.mock import patch, AsyncMock, MagicMock
+from app.services import ledger
+from app.services.ledger import partition_name, partition_sql
+
+
+def test_partition_sql_covers_one_calendar_month():
+    assert partition_name(date(2026, 12, 1)) == "usage_event_p2026_12"
+    assert partition_sql(date(2026, 12, 15)) == (
+        'CREATE TABLE IF NOT EXISTS "usage_event_p2026_12" PARTITION OF "usage_event" '
+        "FOR VALUES FROM ('2026-12-01 00:00:00+00') TO ('2027-01-01 00:00:00+00')"
+    )
+
+
+def test_checkpoint_settles_by_transaction_watermark():
+    assert "pg_snapshot_xmin(pg_current_snapshot())" in ledger.CHECKPOINT_SQL
+    assert 'e."txid" >= b."since" AND e."txid" < b."until"' in ledger.CHECKPOINT_SQL
+
+
+@pytest.mark.asyncio
+@patch("app.services.ledger.SyncState.update_or_create", new_callable=AsyncMock)
+@patch("app.services.ledger.SyncState.get_or_none", new_callable=AsyncMock)
+async def test_checkpoint_advances_the_stored_watermark(get_or_none, update_or_create):
+    conn = MagicMock()
+    conn.execute_query_dict = AsyncMock(side_effect=[[{"locked": True}], [{"until": 9001, "users": 3}]])
+
+    @asynccontextmanager
+    async def transaction(name):
+        yield conn
+
+    get_or_none.return_value = MagicMock(value="8000")
+    with patch("app.services.ledger.in_transaction", transaction):
+        assert await ledger.checkpoint() == 3
+
+    sql, params = conn.execute_query_dict.await_args.args
+    assert sql == ledger.CHECKPOINT_SQL
+    assert params == [8000]
+    assert update_or_create.await_args.kwargs["defaults"] == {"value": "9001"}
+
+
+@pytest.mark.asyncio
+@patch("app.services.ledger.SyncState.update_or_create", new_callable=AsyncMock)
+async def test_checkpoint_skips_while_another_worker_runs_it(update_or_create):
+    conn = MagicMock()
+    conn.execute_query_dict = AsyncMock(return_value=[{"locked": False}])
+
+    @asynccontextmanager
+    async def transaction(name):
+        yield conn
+
+    with patch("app.services.ledger.in_transaction", transaction):
+        assert await ledger.checkpoint() == 0
+
+    conn.execute_query_dict.assert_awaited_once()
+    update_or_create.assert_not_awaited()
+
+
+def retention_connection(partitions, unsettled):
+    conn = MagicMock()
+    conn.execute_script = AsyncMock()
+
+    async def execute_query_dict(sql, params=None):
+        if sql == ledger.PARTITIONS_SQL:
+            return [{"relname": partition_name(month)} for month in partitions]
+        partition = sql.split('"')[1]
+        return [{"unsettled": partition in unsettled}]
+
+    conn.execute_query_dict = AsyncMock(side_effect=execute_query_dict)
+    return conn
+
+
+def dropped(conn):
+    return [call.args[0] for call in conn.execute_script.await_args_list if call.args[0].startswith("DROP")]
+
+
+@pytest.mark.asyncio
+@patch("app.services.ledger.datetime")
+@patch("app.services.ledger.Tortoise.get_connection")
+@patch("app.services.ledger.SyncState.get_or_none", new_callable=AsyncMock)
+async def test_retention_keeps_partitions_with_unsettled_rows(get_or_none, get_connection, now):
+    now.now.return_value = datetime(2026, 10, 19, tzinfo=timezone.utc)
+    get_or_none.return_value = MagicMock(value="9001")
+    old, stuck, kept = date(2025, 7, 1), date(2025, 8, 1), date(2025, 10, 1)
+    conn = retention_connection([old, stuck, kept], {partition_name(stuck)})
+    get_connection.return_value = conn
+
+    await ledger.maintain_partitions()
+
+    assert dropped(conn) == [f'DROP TABLE IF EXISTS "{partition_name(old)}"']
+    params = [call.args[1] for call in conn.execute_query_dict.await_args_list if len(call.args) > 1]
+    assert params == [[9001], [9001]]
+
+
+@pytest.mark.asyncio
+@patch("app.services.ledger.datetime")
+@patch("app.services.ledger.Tortoise.get_connection")
+@patch("app.services.ledger.SyncState.get_or_none", new_callable=AsyncMock, return_value=None)
+async def test_retention_drops_nothing_before_the_first_checkpoint(get_or_none, get_connection, now):
+    now.now.return_value = datetime(2026, 10, 19, tzinfo=timezone.utc)
+    conn = retention_connection([date(2024, 1, 1)], set())
+    get_connection.return_value = conn
+
+    await ledger.maintain_partitions()
+
+    assert dropped(conn) == []
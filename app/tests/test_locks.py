@@ -0,0 +1,36 @@
+import asyncio
+from contextlib import asynccontextmanager
+
+import pytest
+from unittest.mock import patch, AsyncMock, MagicMock
+from app.services import locks
+
+
+@asynccontextmanager
+async def fake_transaction(name):
+    conn = MagicMock()
+    conn.execute_query_dict = AsyncMock(return_value=[])
+    yield conn
+
+
+@pytest.mark.asyncio
+@patch("app.services.locks.in_transaction", fake_transaction)
+async def test_writes_for_one_user_are_serialised_and_others_run_alongside():
+    running = set()
+    seen_together = []
+
+    async def write(user_id, name):
+        async with locks.user_lock(user_id) as conn:
+            # A nested lock for the same user reuses the transaction
+            async with locks.user_lock(user_id) as inner:
+                assert inner is conn
+            running.add(name)
+            await asyncio.sleep(0.01)
+            seen_together.append(set(running))
+            running.discard(name)
+
+    with patch.object(locks, "_stripes", locks.StripedLock(1024)):
+        await asyncio.gather(write(1, "a"), write(1, "b"), write(2, "c"))
+
+    assert not any({"a", "b"} <= seen for seen in seen_together)
+    assert any({"a", "c"} <= seen for seen in seen_together)
@@ -0,0 +1,32 @@
+import logging
+from unittest.mock import patch
+from app.services.logs import RateLimitFilter, parse_sample_rates, redact
+
+
+def make_record(name="app.services.usage", level=logging.INFO):
+    return logging.LogRecord(name, level, __file__, 1, "message", None, None)
+
+
+def test_redact_masks_secrets_and_emails():
+    text = redact("key sk_test_123abc for jane@example.com, Authorization: Bearer abc.def")
+
+    assert text == "key sk_test_[REDACTED] for j***@example.com, Authorization: Bearer [REDACTED]"
+
+
+def test_sampling_keeps_warnings_and_inherits_parent_rates():
+    log_filter = RateLimitFilter(parse_sample_rates("app.services=0"), rate=0)
+
+    assert not log_filter.filter(make_record())
+    assert log_filter.filter(make_record(level=logging.WARNING))
+    assert log_filter.filter(make_record(name="uvicorn.access"))
+
+
+def test_rate_limit_reports_suppressed_records():
+    log_filter = RateLimitFilter({}, rate=2)
+    with patch("app.services.logs.time.monotonic", return_value=100.0):
+        assert [log_filter.filter(make_record()) for _ in range(4)] == [True, True, False, False]
+    with patch("app.services.logs.time.monotonic", return_value=101.0):
+        record = make_record()
+        assert log_filter.filter(record)
+
+    assert record.suppressed == 2
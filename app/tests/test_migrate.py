@@ -0,0 +1,111 @@
+import asyncpg
+import pytest
+from unittest.mock import AsyncMock, MagicMock, patch
+
+import migrate
+
+
+def connection(execute_errors, validity):
+    conn = MagicMock()
+    conn.execute = AsyncMock(side_effect=execute_errors)
+    # relkind check, then indisvalid lookups in order
+    conn.fetchval = AsyncMock(side_effect=validity)
+    return conn
+
+
+@pytest.mark.asyncio
+@patch("migrate.asyncio.sleep", new_callable=AsyncMock)
+async def test_timed_out_index_build_is_dropped_before_retry(sleep):
+    statement = 'CREATE UNIQUE INDEX IF NOT EXISTS "uid_quota_user" ON "quota" ("user")'
+    # before: no index; partitioned: no; after timeout: invalid; after build: valid
+    conn = connection([asyncpg.exceptions.LockNotAvailableError(), None, None], [None, False, False, True])
+
+    await migrate.run_online_statement(conn, statement)
+
+    statements = [call.args[0] for call in conn.execute.await_args_list]
+    assert statements[0].startswith("CREATE UNIQUE INDEX CONCURRENTLY")
+    assert statements[1] == 'DROP INDEX CONCURRENTLY IF EXISTS "uid_quota_user"'
+    assert statements[2] == statements[0]
+
+
+@pytest.mark.asyncio
+async def test_invalid_index_after_build_raises():
+    statement = 'CREATE INDEX IF NOT EXISTS "idx_quota_user" ON "quota" ("user")'
+    conn = connection([None], [None, False, False])
+
+    with pytest.raises(RuntimeError):
+        await migrate.run_online_statement(conn, statement)
+
+
+def test_split_sql_ignores_semicolons_in_quotes_comments_and_bodies():
+    script = """
+        -- backfill; then index
+        UPDATE "quota" SET "note" = 'a;b' WHERE "id" = 1;
+        /* not; a statement */
+        CREATE FUNCTION f() RETURNS trigger AS $$ BEGIN RETURN NEW; END $$ LANGUAGE plpgsql;
+        CREATE INDEX "idx;odd" ON "quota" ("user")
+    """
+
+    assert migrate.split_sql(script) == [
+        'UPDATE "quota" SET "note" = \'a;b\' WHERE "id" = 1',
+        "CREATE FUNCTION f() RETURNS trigger AS $$ BEGIN RETURN NEW; END $$ LANGUAGE plpgsql",
+        'CREATE INDEX "idx;odd" ON "quota" ("user")',
+    ]
+
+
+def migration(sql, replaces=None):
+    header = f"REPLACES = {replaces!r}\n" if replaces else ""
+    return f'{header}\n\nasync def upgrade(db):\n    return """{sql}"""\n'
+
+
+def aerich_records(applied=()):
+    records = MagicMock()
+    records.exists = AsyncMock(return_value=False)
+    records.create = AsyncMock()
+    query = MagicMock()
+    query.first = AsyncMock(return_value=MagicMock(content={}))
+    query.delete = AsyncMock()
+    query.values_list = AsyncMock(return_value=list(applied))
+    records.filter.return_value = query
+    return records
+
+
+@pytest.mark.asyncio
+async def test_squash_folds_history_into_a_baseline(tmp_path):
+    (tmp_path / "0_20260101000000_init.py").write_text(migration(
+        'CREATE TABLE "quota" ("id" INT); CREATE TABLE "scratch" ("id" INT);'
+    ))
+    (tmp_path / "1_20260102000000_update.py").write_text(migration(
+        'ALTER TABLE "quota" ADD "user" VARCHAR(255); DROP TABLE "scratch";'
+    ))
+    aerich = MagicMock(heads=AsyncMock(return_value=[]))
+    records = aerich_records()
+
+    with patch.object(migrate.Migrate, "migrate_location", tmp_path, create=True), \
+            patch("migrate.get_app_connection"), patch("migrate.in_transaction"), \
+            patch("migrate.Aerich", records):
+        await migrate.squash(aerich)
+
+    [baseline] = list(tmp_path.glob("*.py"))
+    assert baseline.name.startswith("1_") and baseline.name.endswith("_squashed.py")
+    module = migrate.import_py_file(baseline)
+    assert module.REPLACES == ["0_20260101000000_init.py", "1_20260102000000_update.py"]
+    assert migrate.split_sql(await module.upgrade(None)) == [
+        'CREATE TABLE "quota" ("id" INT)',
+        'ALTER TABLE "quota" ADD "user" VARCHAR(255)',
+    ]
+    assert records.create.await_args.kwargs["version"] == baseline.name
+
+
+@pytest.mark.asyncio
+async def test_partly_migrated_database_refuses_squashed_baseline(tmp_path):
+    replaces = ["0_20260101000000_init.py", "1_20260102000000_update.py"]
+    (tmp_path / "1_20260103000000_squashed.py").write_text(migration('CREATE TABLE "quota" ("id" INT);', replaces))
+    records = aerich_records(applied=replaces[:1])
+
+    with patch.object(migrate.Migrate, "migrate_location", tmp_path, create=True), \
+            patch("migrate.Aerich", records):
+        with pytest.raises(SystemExit):
+            await migrate.record_squashed_baselines()
+
+    records.create.assert_not_awaited()
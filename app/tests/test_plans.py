@@ -0,0 +1,63 @@
+import pytest
+from datetime import datetime, timezone
+from unittest.mock import patch, AsyncMock, MagicMock
+from app.services import plans
+
+
+def catalog_rows(quota=2000):
+    return [
+        {"plan": plan, "frequency": frequency, "stripe_price_id": f"price_{plan}_{frequency}",
+         "quota": quota if plan == "light" else 100, "features": '["export"]'}
+        for plan in ("free", "light", "standard", "pro") for frequency in ("monthly", "yearly")
+    ]
+
+
+def database(rows, updated_at):
+    db = MagicMock()
+
+    async def execute_query_dict(sql, params=None):
+        if sql == plans.VERSION_SQL:
+            return [{"rows": len(rows), "updated_at": updated_at}]
+        return rows
+
+    db.execute_query_dict = AsyncMock(side_effect=execute_query_dict)
+    return db
+
+
+@pytest.fixture(autouse=True)
+def restore_catalog():
+    current = plans.catalog
+    yield
+    plans.catalog = current
+
+
+def test_defaults_cover_every_plan():
+    assert plans.defaults().missing() == []
+    assert plans.quota("pro", "yearly") == 12000
+
+
+@pytest.mark.asyncio
+@patch("app.services.plans.Tortoise.get_connection")
+async def test_refresh_loads_only_on_change(get_connection):
+    updated_at = datetime(2026, 10, 19, tzinfo=timezone.utc)
+    db = database(catalog_rows(), updated_at)
+    get_connection.return_value = db
+
+    assert await plans.refresh() is True
+    assert plans.get("Light", "monthly").features == ("export",)
+    assert plans.plan_for_price("price_pro_yearly").plan == "pro"
+    assert plans.price_plans()["price_standard_monthly"] == "standard"
+
+    assert await plans.refresh() is False
+    assert db.execute_query_dict.await_count == 3
+
+
+@pytest.mark.asyncio
+@patch("app.services.plans.Tortoise.get_connection")
+async def test_refresh_rejects_incomplete_catalog(get_connection):
+    rows = [row for row in catalog_rows(quota=3000) if row["plan"] != "pro"]
+    get_connection.return_value = database(rows, datetime.now(timezone.utc))
+    current = plans.catalog
+
+    assert await plans.refresh() is False
+    assert plans.catalog is current
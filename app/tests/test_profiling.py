@@ -0,0 +1,24 @@
+import threading
+import time
+from app.services.profiling import collapsed, sample_stacks
+
+
+def busy_loop(stop):
+    while not stop.is_set():
+        sum(range(1000))
+
+
+def test_sampler_collects_collapsed_stacks_of_another_thread():
+    stop = threading.Event()
+    worker = threading.Thread(target=busy_loop, args=(stop,))
+    worker.start()
+    try:
+        stacks = sample_stacks(worker.ident, 0.1, 0.005)
+    finally:
+        stop.set()
+        worker.join()
+
+    assert sum(stacks.values()) > 5
+    assert all("busy_loop (test_profiling.py" in stack for stack in stacks)
+    line = collapsed(stacks).splitlines()[0]
+    assert line.rsplit(" ", 1)[1].isdigit()
@@ -0,0 +1,55 @@
+import pytest
+from unittest.mock import AsyncMock, patch
+from app.services import query_stats
+from app.services.query_stats import QueryAccountingMiddleware, QueryStats
+
+
+@pytest.mark.asyncio
+async def test_middleware_counts_queries_into_server_timing():
+    async def app(scope, receive, send):
+        # What the wrapped Tortoise client does for each statement
+        query_stats.current.get().add("SELECT 1", 0.002)
+        query_stats.current.get().add("SELECT 2", 0.003)
+        await send({"type": "http.response.start", "status": 200, "headers": []})
+        await send({"type": "http.response.body", "body": b"{}"})
+
+    sent = []
+
+    async def send(message):
+        sent.append(message)
+
+    scope = {"type": "http", "method": "GET", "path": "/"}
+    with patch.object(query_stats, "SLOW_REQUEST_QUERY_COUNT", 1), \
+            patch.object(query_stats.logger, "warning") as warning:
+        await QueryAccountingMiddleware(app)(scope, None, send)
+
+    header = dict(sent[0]["headers"])[b"server-timing"].decode()
+    assert header.startswith('db;desc="2 queries";dur=5.00, total;dur=')
+    assert query_stats.current.get() is None
+    warning.assert_called_once()
+
+
+def test_stats_keep_slowest_query():
+    stats = QueryStats()
+    stats.add("fast", 0.001)
+    stats.add("slow", 0.010)
+    stats.add("medium", 0.005)
+
+    assert (stats.count, stats.slowest_query) == (3, "slow")
+
+
+@pytest.mark.asyncio
+@patch.object(query_stats, "_original_translate_exceptions", new_callable=AsyncMock)
+async def test_only_calls_carrying_sql_are_counted(translate):
+    stats = QueryStats()
+    token = query_stats.current.set(stats)
+    try:
+        # A transaction start, then statements passed positionally and by keyword
+        await query_stats._counted_translate_exceptions(None, None)
+        await query_stats._counted_translate_exceptions(None, None, "SELECT 1", [])
+        await query_stats._counted_translate_exceptions(None, None, query="SELECT 2")
+    finally:
+        query_stats.current.reset(token)
+
+    assert translate.await_count == 3
+    assert stats.count == 2
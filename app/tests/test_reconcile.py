@@ -0,0 +1,64 @@
+import pytest
+from decimal import Decimal
+from unittest.mock import patch, AsyncMock, MagicMock
+from app.services.plans import Plan
+from app.services.reconcile import Reconciler, UPSERT_SQL, subscription_row
+
+
+def stripe_subscription(**overrides):
+    subscription = {
+        "id": "sub_1",
+        "status": "active",
+        "created": 1700000000,
+        "metadata": {},
+        "items": {"data": [{
+            "current_period_start": 1700000000,
+            "current_period_end": 1731536000,
+            "price": {"id": "price_light", "unit_amount": 19999, "recurring": {"interval": "year"}},
+        }]},
+    }
+    subscription.update(overrides)
+    return subscription
+
+
+def test_subscription_row_falls_back_to_price_and_local_user():
+    row = subscription_row(stripe_subscription(), "7", {"price_light": "light"})
+
+    assert row["user"] == "7"
+    assert row["subscription_plan"] == "light"
+    assert row["subscription_frequency"] == "yearly"
+    assert row["is_active"] is True
+    assert row["end_date"].timestamp() == 1731536000
+    assert row["price"] == Decimal("199.99")
+
+
+def test_subscription_row_prefers_metadata_and_skips_unknown():
+    metadata = {"user_id": "3", "subscription_plan": "standard", "subscription_frequency": "monthly"}
+    row = subscription_row(stripe_subscription(metadata=metadata, status="canceled"), None, {})
+
+    assert (row["user"], row["subscription_plan"], row["is_active"]) == ("3", "standard", False)
+    # Neither metadata nor a local row says whose subscription this is
+    assert subscription_row(stripe_subscription(), None, {"price_light": "light"}) is None
+    assert subscription_row(stripe_subscription(), "7", {}) is None
+
+
+@pytest.mark.asyncio
+@patch("app.services.reconcile.plans.all_plans")
+async def test_write_passes_quotas_per_plan_and_frequency(all_plans):
+    all_plans.return_value = [
+        Plan("free", "monthly", None, 100),
+        Plan("light", "monthly", "price_light", 2000),
+        Plan("light", "yearly", "price_light_year", 30000),
+    ]
+    conn = MagicMock()
+    conn.execute_query_dict = AsyncMock(return_value=[{"users": [], "updated": 0, "inserted": 0, "quotas": 0}])
+    row = subscription_row(stripe_subscription(), "7", {"price_light": "light"})
+
+    await Reconciler()._write_shard(conn, [row])
+
+    sql, params = conn.execute_query_dict.await_args.args
+    assert sql == UPSERT_SQL
+    assert list(zip(params[7], params[11], params[8])) == [
+        ("free", "monthly", 100), ("light", "monthly", 2000), ("light", "yearly", 30000),
+    ]
+    assert 'l."frequency" = lower(c."subscription_frequency")' in UPSERT_SQL
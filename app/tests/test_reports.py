@@ -0,0 +1,44 @@
+import pytest
+from datetime import date
+from decimal import Decimal
+from unittest.mock import patch, AsyncMock, MagicMock
+from app.services.reports import get_daily_usage, get_subscription_summary
+
+
+@pytest.mark.asyncio
+@patch("app.services.reports.SyncState.get_or_none", new_callable=AsyncMock, return_value=None)
+@patch("app.services.reports.shards.all_shards")
+async def test_subscription_summary_sums_mrr_per_frequency(all_shards, _):
+    conn = MagicMock()
+    conn.execute_query_dict = AsyncMock(return_value=[
+        {"subscription_plan": "light", "subscription_frequency": "monthly", "active": 3, "total": 4, "mrr": Decimal("30.00")},
+        {"subscription_plan": "light", "subscription_frequency": "yearly", "active": 1, "total": 1, "mrr": Decimal("8.25")},
+        {"subscription_plan": "pro", "subscription_frequency": "monthly", "active": 2, "total": 2, "mrr": Decimal("99.98")},
+    ])
+    all_shards.return_value = [conn]
+
+    summary = await get_subscription_summary()
+
+    assert summary["plans"]["light"]["monthly"] == {"active": 3, "total": 4}
+    assert summary["active"] == 6
+    assert summary["mrr"] == {"monthly": 129.98, "yearly": 8.25}
+    assert summary["mrr_total"] == 138.23
+
+
+@pytest.mark.asyncio
+@patch("app.services.reports.shards.all_shards")
+async def test_daily_usage_sums_shards(all_shards):
+    first, second = MagicMock(), MagicMock()
+    first.execute_query_dict = AsyncMock(return_value=[
+        {"day": date(2026, 10, 18), "plan": "pro", "units": 40},
+        {"day": date(2026, 10, 19), "plan": "pro", "units": 10},
+    ])
+    second.execute_query_dict = AsyncMock(return_value=[
+        {"day": date(2026, 10, 18), "plan": "pro", "units": 2},
+        {"day": date(2026, 10, 18), "plan": "free", "units": 5},
+    ])
+    all_shards.return_value = [first, second]
+
+    usage = await get_daily_usage(date(2026, 10, 1), date(2026, 10, 19))
+
+    assert usage["days"] == {"2026-10-18": {"pro": 42, "free": 5}, "2026-10-19": {"pro": 10}}
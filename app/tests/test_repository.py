@@ -0,0 +1,28 @@
+import pytest
+from unittest.mock import patch, AsyncMock, MagicMock
+from app.services import query_stats, repository
+
+
+@pytest.mark.asyncio
+@patch("app.services.shards.Tortoise.get_connection")
+async def test_fetch_one_runs_prepared_statement_and_counts_it(mock_get_connection):
+    connection = MagicMock()
+    connection.fetchrow = AsyncMock(return_value={"id": 7, "total": 2000})
+    acquired = MagicMock()
+    acquired.__aenter__ = AsyncMock(return_value=connection)
+    acquired.__aexit__ = AsyncMock(return_value=False)
+    mock_get_connection.return_value.acquire_connection.return_value = acquired
+
+    stats = query_stats.QueryStats()
+    token = query_stats.current.set(stats)
+    try:
+        row = await repository.get_quota(42)
+    finally:
+        query_stats.current.reset(token)
+
+    assert row["total"] == 2000
+    sql, user = connection.fetchrow.await_args.args
+    assert sql == repository.STATEMENTS["quota_by_user"]
+    assert user == "42"
+    assert connection.fetchrow.await_args.kwargs == {"record_class": repository.Row}
+    assert stats.count == 1
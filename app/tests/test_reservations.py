@@ -0,0 +1,77 @@
+import pytest
+import uuid
+from datetime import datetime, timezone
+from unittest.mock import patch, AsyncMock, MagicMock
+from fastapi import HTTPException
+from app.services import reservations
+
+
+def connection(*results):
+    conn = MagicMock()
+    conn.execute_query_dict = AsyncMock(side_effect=list(results))
+    return conn
+
+
+@pytest.mark.asyncio
+@patch("app.services.reservations.shards.for_user")
+async def test_reserve_is_one_statement(for_user):
+    reservation_id = uuid.uuid4()
+    expires_at = datetime(2026, 10, 19, 21, tzinfo=timezone.utc)
+    conn = connection([{"id": reservation_id, "expires_at": expires_at}])
+    for_user.return_value = conn
+
+    result = await reservations.reserve(42, 500, ttl=60)
+
+    for_user.assert_called_once_with(42)
+    conn.execute_query_dict.assert_awaited_once()
+    sql, params = conn.execute_query_dict.await_args.args
+    assert sql == reservations.RESERVE_SQL
+    assert params[:2] == ["42", 500]
+    assert result["reservation_id"] == str(reservation_id)
+
+
+@pytest.mark.asyncio
+@patch("app.services.reservations.shards.for_user")
+async def test_reserve_over_quota_is_rejected(for_user):
+    for_user.return_value = connection([], [{"total": 100, "used": 90, "reserved": 0}])
+
+    with pytest.raises(HTTPException) as error:
+        await reservations.reserve(42, 500)
+
+    assert error.value.status_code == 429
+
+
+@pytest.mark.asyncio
+@patch("app.services.reservations.shards.for_user")
+async def test_commit_releases_the_rest(for_user):
+    for_user.return_value = connection([{"units": 500}])
+
+    result = await reservations.commit(42, uuid.uuid4(), 120)
+
+    assert (result["charged"], result["released"]) == (120, 380)
+
+
+@pytest.mark.asyncio
+@patch("app.services.reservations.shards.for_user")
+async def test_commit_of_expired_reservation(for_user):
+    for_user.return_value = connection([], [{"units": 500, "live": False}])
+
+    with pytest.raises(HTTPException) as error:
+        await reservations.commit(42, uuid.uuid4(), 120)
+
+    assert error.value.status_code == 410
+
+
+@pytest.mark.asyncio
+@patch("app.services.reservations.shards.all_shards")
+async def test_reap_runs_batches_on_every_shard(all_shards):
+    first = connection(
+        [{"reclaimed": 2, "users": ["1", "2"]}],
+        [{"reclaimed": 1, "users": ["3"]}],
+    )
+    second = connection([{"reclaimed": 1, "users": ["4"]}])
+    all_shards.return_value = [first, second]
+
+    assert await reservations.reap_expired(batch_size=2) == 4
+    assert first.execute_query_dict.await_count == 2
+    assert second.execute_query_dict.await_count == 1
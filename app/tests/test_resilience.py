@@ -0,0 +1,90 @@
+import asyncio
+
+import pytest
+from app.services.resilience import OPEN, Dependency, DependencyUnavailable
+
+
+@pytest.mark.asyncio
+async def test_breaker_opens_after_consecutive_failures():
+    dep = Dependency("test-breaker", timeout=1, deadline=1, retries=0, failure_threshold=2, reset_timeout=60)
+
+    async def fail():
+        raise ConnectionError("refused")
+
+    for _ in range(2):
+        with pytest.raises(DependencyUnavailable) as raised:
+            await dep.call(fail)
+        assert isinstance(raised.value.__cause__, ConnectionError)
+
+    assert dep.breaker.state == OPEN
+    with pytest.raises(DependencyUnavailable):
+        await dep.call(fail)
+
+
+@pytest.mark.asyncio
+async def test_client_errors_do_not_clear_counted_failures():
+    dep = Dependency("test-client-error", timeout=1, deadline=1, retries=0, failure_threshold=2, reset_timeout=60)
+
+    async def fail():
+        raise ConnectionError("refused")
+
+    async def bad_request():
+        raise ValueError("invalid")
+
+    with pytest.raises(DependencyUnavailable):
+        await dep.call(fail)
+    with pytest.raises(ValueError):
+        await dep.call(bad_request)
+    assert dep.breaker.failures == 1
+
+    with pytest.raises(DependencyUnavailable):
+        await dep.call(fail)
+    assert dep.breaker.state == OPEN
+
+
+@pytest.mark.asyncio
+async def test_idempotent_calls_are_retried_but_client_errors_are_not():
+    dep = Dependency("test-retry", timeout=1, deadline=5, retries=2, backoff=0)
+    calls = []
+
+    async def flaky():
+        calls.append(1)
+        if len(calls) < 3:
+            raise ConnectionError("reset")
+        return "ok"
+
+    assert await dep.call(flaky, idempotent=True) == "ok"
+    assert len(calls) == 3
+
+    async def bad_request():
+        calls.append(1)
+        raise ValueError("invalid")
+
+    with pytest.raises(ValueError):
+        await dep.call(bad_request, idempotent=True)
+    assert len(calls) == 4
+    assert dep.breaker.failures == 0
+
+
+@pytest.mark.asyncio
+async def test_timeout_raises_dependency_unavailable():
+    dep = Dependency("test-timeout", timeout=0.05, deadline=0.05, retries=0)
+
+    async def hang():
+        await asyncio.sleep(1)
+
+    with pytest.raises(DependencyUnavailable):
+        await dep.call(hang)
+
+
+@pytest.mark.asyncio
+async def test_hedged_call_takes_the_faster_attempt():
+    dep = Dependency("test-hedge", timeout=1, deadline=1, hedge_after=0.02)
+    delays = [0.5, 0.0]
+
+    async def lookup():
+        await asyncio.sleep(delays.pop(0))
+        return "fast"
+
+    assert await dep.call(lookup, hedge=True) == "fast"
+    assert dep._hedges.value == 1
@@ -0,0 +1,76 @@
+import pytest
+from unittest.mock import patch, AsyncMock, MagicMock
+from tortoise.exceptions import IntegrityError
+from app.models.user import UserRegister
+from app.services import shards, user as user_service
+
+SHARDS = ["default", "shard_1", "shard_2"]
+
+
+@patch.object(shards, "SHARD_CONNECTIONS", SHARDS)
+@patch("app.services.shards.Tortoise.get_connection", side_effect=lambda name: name)
+def test_users_map_to_shards_by_id(mock_get_connection):
+    assert [shards.shard_index(user_id) for user_id in (3, 4, "5")] == [0, 1, 2]
+    assert shards.for_user(7) == "shard_1"
+    assert shards.all_shards() == SHARDS
+
+
+@pytest.mark.asyncio
+@patch.object(shards, "SHARD_CONNECTIONS", SHARDS)
+@patch("app.services.shards.Tortoise.get_connection")
+async def test_search_merges_every_shard_by_score(mock_get_connection):
+    results = {
+        "default": [{"id": 3, "score": 1.0}, {"id": 6, "score": 0.5}],
+        "shard_1": [{"id": 4, "score": 1.0}],
+        "shard_2": [{"id": 2, "score": 0.9}],
+    }
+
+    def connection(name):
+        conn = MagicMock()
+        conn.execute_query_dict = AsyncMock(return_value=results[name])
+        return conn
+
+    mock_get_connection.side_effect = connection
+
+    page = await user_service.search_users("jon", limit=3)
+
+    assert [row["id"] for row in page["results"]] == [3, 4, 2]
+    assert page["next_cursor"] == "0.9:2"
+
+
+def registration():
+    return UserRegister(
+        email="jon@example.com", username="jon", password="SecurePass123!", full_name="Jon"
+    )
+
+
+@pytest.mark.asyncio
+@patch("app.services.user.shards.for_new_user")
+@patch("app.services.user.get_password_hash", return_value="hashed")
+@patch("app.services.user.User.create", new_callable=AsyncMock)
+@patch("app.services.user.UserDirectory.create", new_callable=AsyncMock)
+async def test_create_user_claims_the_email_in_the_directory_first(directory_create, user_create, *_):
+    directory_create.side_effect = IntegrityError(
+        'duplicate key value violates unique constraint "user_directory_email_key"'
+    )
+
+    with pytest.raises(ValueError, match="Email already exists"):
+        await user_service.create_user(registration())
+
+    user_create.assert_not_awaited()
+
+
+@pytest.mark.asyncio
+@patch("app.services.user.shards.for_new_user")
+@patch("app.services.user.get_password_hash", return_value="hashed")
+@patch("app.services.user.User.create", new_callable=AsyncMock, side_effect=ConnectionError("shard down"))
+@patch("app.services.user.UserDirectory.create", new_callable=AsyncMock)
+async def test_create_user_releases_the_claim_when_the_shard_fails(directory_create, *_):
+    entry = MagicMock()
+    entry.delete = AsyncMock()
+    directory_create.return_value = entry
+
+    with pytest.raises(ConnectionError):
+        await user_service.create_user(registration())
+
+    entry.delete.assert_awaited_once()
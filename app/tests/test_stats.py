@@ -0,0 +1,34 @@
+import pytest
+from unittest.mock import patch, AsyncMock, MagicMock
+from app.services import stats
+
+
+def shard(rows):
+    db = MagicMock()
+    db.execute_query_dict = AsyncMock(return_value=rows)
+    return db
+
+
+@pytest.mark.asyncio
+@patch("app.services.stats.shards.all_shards")
+async def test_stats_sum_counter_slots_across_shards(all_shards):
+    all_shards.return_value = [
+        shard([
+            {"name": "users.total", "value": 10},
+            {"name": "users.active", "value": 7},
+            {"name": "subscribers.pro.monthly", "value": 3},
+        ]),
+        shard([
+            {"name": "users.total", "value": 5},
+            {"name": "subscribers.pro.monthly", "value": 1},
+            {"name": "subscribers.light.yearly", "value": 2},
+        ]),
+    ]
+
+    result = await stats.get_stats()
+
+    assert result["users"] == {"total": 15, "active": 7}
+    assert result["subscribers"]["pro"]["monthly"] == 4
+    assert result["subscribers"]["light"]["yearly"] == 2
+    assert result["subscribers"]["standard"]["monthly"] == 0
+    assert result["subscribers_total"] == 6
@@ -0,0 +1,60 @@
+import json
+
+import pytest
+from unittest.mock import patch, AsyncMock, MagicMock
+from app.services import subscription_events
+from app.services.subscription_events import SubscriptionEventHub
+
+
+def test_notifications_reach_only_that_users_streams():
+    hub = SubscriptionEventHub()
+    mine, other = hub.subscribe(7), hub.subscribe(8)
+
+    hub._on_notification(None, 1, subscription_events.CHANNEL, json.dumps({"user": "7", "event": "activated"}))
+    hub._on_notification(None, 1, subscription_events.CHANNEL, "not json")
+
+    assert mine.get_nowait() == "7"
+    assert other.empty()
+    hub.unsubscribe(7, mine)
+    hub.unsubscribe(8, other)
+    assert hub._queues == {}
+
+
+@pytest.mark.asyncio
+async def test_stream_sends_state_then_coalesced_changes():
+    hub = SubscriptionEventHub()
+    hub.ensure_listening = AsyncMock()
+    request = MagicMock()
+    request.is_disconnected = AsyncMock(side_effect=[False, True])
+    states = [{"subscription": None}, {"subscription": {"is_active": True}}]
+
+    with patch.object(subscription_events, "hub", hub), \
+            patch.object(subscription_events, "current_state", AsyncMock(side_effect=states)):
+        stream = subscription_events.stream(request, 7)
+        first = await stream.__anext__()
+        # Two changes land before the stream reads its queue
+        for _ in range(2):
+            hub._on_notification(None, 1, subscription_events.CHANNEL, json.dumps({"user": "7"}))
+        second = await stream.__anext__()
+        with pytest.raises(StopAsyncIteration):
+            await stream.__anext__()
+
+    assert first == 'event: subscription\ndata: {"subscription": null}\n\n'
+    assert '"is_active": true' in second
+    assert hub._queues == {}
+
+
+def test_checkout_invalidation_reaches_other_workers_caches():
+    from app.services.checkout_cache import CachedSession, CheckoutSessionCache, INVALIDATED_EVENT
+
+    hub = SubscriptionEventHub()
+    cache = CheckoutSessionCache()
+    hub.add_handler(cache._on_event)
+    cache._sessions[("7", "pro", "monthly")] = CachedSession("cs_1", "https://checkout", 2e9)
+    cache._sessions[("8", "pro", "monthly")] = CachedSession("cs_2", "https://checkout", 2e9)
+
+    hub._on_notification(None, 1, subscription_events.CHANNEL, json.dumps({"user": "7", "event": "activated"}))
+    assert len(cache._sessions) == 2
+
+    hub._on_notification(None, 1, subscription_events.CHANNEL, json.dumps({"user": "7", "event": INVALIDATED_EVENT}))
+    assert list(cache._sessions) == [("8", "pro", "monthly")]
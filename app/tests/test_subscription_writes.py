@@ -0,0 +1,124 @@
+import pytest
+from decimal import Decimal
+from unittest.mock import patch, AsyncMock, MagicMock
+from fastapi import HTTPException
+from app.services import sub_process
+
+
+def completed_checkout():
+    return {
+        "id": "evt_1",
+        "type": "checkout.session.completed",
+        "data": {"object": {
+            "subscription": "sub_1",
+            "metadata": {"user_id": "42", "subscription_plan": "light", "subscription_frequency": "monthly"},
+        }},
+    }
+
+
+STRIPE_SUBSCRIPTION = {"items": {"data": [{
+    "current_period_start": 1760000000,
+    "current_period_end": 1762600000,
+    "price": {"unit_amount": 999},
+}]}}
+
+
+@pytest.mark.asyncio
+@patch("app.services.sub_process.checkout_sessions.invalidate", new_callable=AsyncMock)
+@patch("app.services.sub_process.shards.for_user")
+@patch("app.services.sub_process.stripe_api.call", new_callable=AsyncMock, return_value=STRIPE_SUBSCRIPTION)
+@patch("app.services.sub_process.stripe.Webhook.construct_event", side_effect=lambda *args: completed_checkout())
+async def test_webhook_activates_in_one_statement(construct_event, stripe_call, for_user, invalidate, monkeypatch):
+    monkeypatch.setenv("STRIPE_WEBHOOK_SECRET", "whsec_test")
+    db = MagicMock()
+    db.execute_query_dict = AsyncMock(return_value=[{"total": 2000, "used": 0}])
+    for_user.return_value = db
+    request = MagicMock()
+    request.body = AsyncMock(return_value=b"{}")
+    request.headers = {"stripe-signature": "t=1,v1=x"}
+
+    result = await sub_process.stripe_webhook(request)
+
+    assert result["status"] == "success"
+    db.execute_query_dict.assert_awaited_once()
+    sql, params = db.execute_query_dict.await_args.args
+    assert sql == sub_process.ACTIVATE_SUBSCRIPTION_SQL
+    assert params[:4] == ["42", "light", "monthly", Decimal("9.99")]
+    assert params[7] == sub_process.plans.quota("light", "monthly")
+    invalidate.assert_awaited_once_with("42")
+
+
+@pytest.mark.asyncio
+@patch("app.services.sub_process.stripe_api.call", new_callable=AsyncMock)
+@patch("app.services.sub_process.stripe.Webhook.construct_event")
+async def test_webhook_rejects_unknown_plan_with_400(construct_event, stripe_call, monkeypatch):
+    monkeypatch.setenv("STRIPE_WEBHOOK_SECRET", "whsec_test")
+    event = completed_checkout()
+    event["data"]["object"]["metadata"]["subscription_plan"] = "platinum"
+    construct_event.return_value = event
+    request = MagicMock()
+    request.body = AsyncMock(return_value=b"{}")
+    request.headers = {"stripe-signature": "t=1,v1=x"}
+
+    with pytest.raises(HTTPException) as error:
+        await sub_process.stripe_webhook(request)
+
+    assert error.value.status_code == 400
+    stripe_call.assert_not_awaited()
+
+
+@pytest.mark.asyncio
+@patch("app.services.sub_process.repository.get_subscription", new_callable=AsyncMock, return_value=None)
+@patch("app.services.sub_process.shards.for_user")
+async def test_manage_quotas_without_subscription(for_user, get_subscription):
+    for_user.return_value.execute_query_dict = AsyncMock(return_value=[])
+
+    with pytest.raises(HTTPException) as error:
+        await sub_process.manage_quotas(42)
+
+    assert error.value.status_code == 404
+
+
+def test_quota_upserts_reset_usage_when_the_total_changes():
+    for sql in (sub_process.ACTIVATE_SUBSCRIPTION_SQL, sub_process.MANAGE_QUOTA_SQL):
+        assert f'ON CONFLICT ("user") DO UPDATE SET {sub_process.QUOTA_RESET}' in sql
+    assert '"used" = CASE WHEN q."total" = EXCLUDED."total" THEN q."used" ELSE 0 END' in sub_process.QUOTA_RESET
+
+
+def renewed_subscription(status="active"):
+    return {
+        "id": "evt_2",
+        "type": "customer.subscription.updated",
+        "data": {"object": {
+            "id": "sub_1",
+            "status": status,
+            "metadata": {"user_id": "42"},
+            **STRIPE_SUBSCRIPTION,
+        }},
+    }
+
+
+@pytest.mark.asyncio
+@patch("app.services.sub_process.shards.for_user")
+async def test_webhook_renewal_moves_end_date_forward(for_user, monkeypatch):
+    monkeypatch.setenv("STRIPE_WEBHOOK_SECRET", "whsec_test")
+    db = MagicMock()
+    db.execute_query_dict = AsyncMock(return_value=[{"user": "42"}])
+    for_user.return_value = db
+    request = MagicMock()
+    request.body = AsyncMock(return_value=b"{}")
+    request.headers = {"stripe-signature": "t=1,v1=x"}
+
+    with patch("app.services.sub_process.stripe.Webhook.construct_event", return_value=renewed_subscription()):
+        result = await sub_process.stripe_webhook(request)
+
+    assert result["status"] == "success"
+    sql, params = db.execute_query_dict.await_args.args
+    assert sql == sub_process.RENEW_SUBSCRIPTION_SQL
+    assert params[:2] == ["42", "sub_1"]
+    assert params[3].timestamp() == 1762600000
+
+    db.execute_query_dict.reset_mock()
+    with patch("app.services.sub_process.stripe.Webhook.construct_event", return_value=renewed_subscription("past_due")):
+        assert (await sub_process.stripe_webhook(request))["status"] == "ignored"
+    db.execute_query_dict.assert_not_awaited()
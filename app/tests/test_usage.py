@@ -0,0 +1,143 @@
+import asyncio
+import pytest
+from unittest.mock import patch, AsyncMock, MagicMock
+from app.services.usage import UsageAccumulator, QuotaExceeded
+
+
+def make_accumulator(total=100, used=0, **kwargs):
+    accumulator = UsageAccumulator(**kwargs)
+    accumulator._load_quota = AsyncMock(return_value=(total, used))
+    return accumulator
+
+
+@pytest.mark.asyncio
+async def test_add_buffers_until_quota_is_reached():
+    accumulator = make_accumulator(total=10, used=4, max_unflushed_per_user=100)
+
+    assert await accumulator.add(1, 3) == 3
+    assert await accumulator.add(1, 3) == 0
+    assert accumulator.pending(1) == 6
+
+    with pytest.raises(QuotaExceeded):
+        await accumulator.add(1, 1)
+
+
+@pytest.mark.asyncio
+@patch("app.services.usage.Tortoise.get_connection")
+async def test_flush_writes_one_batch_and_refreshes_cache(mock_get_connection):
+    conn = MagicMock()
+    conn.execute_query_dict = AsyncMock(return_value=[
+        {"user": "1", "total": 100, "used": 7, "reserved": 0},
+        {"user": "2", "total": 50, "used": 2, "reserved": 0},
+    ])
+    mock_get_connection.return_value = conn
+    accumulator = make_accumulator(max_unflushed_per_user=100)
+
+    await accumulator.add(1, 5)
+    await accumulator.add(2, 2)
+    await accumulator.add(1, 2)
+    await accumulator.add(1, 1, "export")
+    await accumulator.flush()
+
+    conn.execute_query_dict.assert_awaited_once()
+    _, params = conn.execute_query_dict.await_args.args
+    assert list(zip(*params)) == [("1", "default", 7), ("2", "default", 2), ("1", "export", 1)]
+    assert accumulator.pending(1) == 0
+    assert accumulator._quotas["1"][:2] == (100, 7)
+
+
+@pytest.mark.asyncio
+@patch("app.services.usage.Tortoise.get_connection")
+async def test_failed_flush_keeps_increments(mock_get_connection):
+    conn = MagicMock()
+    conn.execute_query_dict = AsyncMock(side_effect=ConnectionError("db down"))
+    mock_get_connection.return_value = conn
+    accumulator = make_accumulator(max_unflushed_per_user=100)
+
+    await accumulator.add(1, 5)
+    with pytest.raises(ConnectionError):
+        await accumulator.flush()
+
+    assert accumulator.pending(1) == 5
+
+
+@pytest.mark.asyncio
+async def test_per_user_bound_forces_flush():
+    accumulator = make_accumulator(max_unflushed_per_user=5)
+    flushed = []
+
+    async def fake_flush():
+        flushed.append(dict(accumulator._pending))
+        accumulator._pending.clear()
+
+    accumulator.flush = fake_flush
+
+    await accumulator.add(1, 4)
+    await accumulator.add(1, 4)
+
+    assert flushed == [{"1": 4}]
+    assert accumulator.pending(1) == 4
+
+
+@pytest.mark.asyncio
+@patch("app.services.usage.shards.name_for_user", side_effect=lambda user: f"shard_{int(user) % 2}")
+@patch("app.services.usage.Tortoise.get_connection")
+async def test_flush_writes_each_users_rows_on_their_shard(mock_get_connection, _):
+    connections = {}
+    for name, user in (("shard_0", "2"), ("shard_1", "1")):
+        connections[name] = MagicMock()
+        connections[name].execute_query_dict = AsyncMock(
+            return_value=[{"user": user, "total": 100, "used": 5, "reserved": 0}]
+        )
+    connections["shard_1"].execute_query_dict.side_effect = ConnectionError("shard down")
+    mock_get_connection.side_effect = connections.get
+    accumulator = make_accumulator(max_unflushed_per_user=100)
+
+    await accumulator.add(1, 5)
+    await accumulator.add(2, 3)
+    with pytest.raises(ConnectionError):
+        await accumulator.flush()
+
+    _, params = connections["shard_0"].execute_query_dict.await_args.args
+    assert list(zip(*params)) == [("2", "default", 3)]
+    # Only the failed shard's increments are kept for the next flush
+    assert (accumulator.pending(1), accumulator.pending(2)) == (5, 0)
+
+
+@pytest.mark.asyncio
+@patch("app.services.usage.Tortoise.get_connection")
+async def test_units_being_flushed_still_count_against_the_quota(mock_get_connection):
+    release = asyncio.Event()
+
+    async def slow_flush(sql, params):
+        await release.wait()
+        return [{"user": "1", "total": 10, "used": 8, "reserved": 0}]
+
+    conn = MagicMock()
+    conn.execute_query_dict = AsyncMock(side_effect=slow_flush)
+    mock_get_connection.return_value = conn
+    accumulator = make_accumulator(total=10, used=0, max_unflushed_per_user=100)
+
+    await accumulator.add(1, 8)
+    flushing = asyncio.create_task(accumulator.flush())
+    await asyncio.sleep(0)
+
+    assert accumulator.pending(1) == 8
+    with pytest.raises(QuotaExceeded):
+        await accumulator.add(1, 5)
+
+    release.set()
+    await flushing
+    assert accumulator.pending(1) == 0
+
+
+@pytest.mark.asyncio
+async def test_failed_flush_in_add_rejects_the_increment():
+    accumulator = make_accumulator(max_unflushed_per_user=5)
+    accumulator.flush = AsyncMock(side_effect=ConnectionError("db down"))
+
+    await accumulator.add(1, 4)
+    with pytest.raises(QuotaExceeded):
+        await accumulator.add(1, 4)
+
+    assert accumulator.pending(1) == 4
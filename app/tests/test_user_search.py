@@ -0,0 +1,32 @@
+import pytest
+from unittest.mock import patch, AsyncMock, MagicMock
+from app.services.user import search_users
+
+
+@pytest.mark.asyncio
+@patch("app.services.shards.Tortoise.get_connection")
+async def test_search_pages_by_score_and_id(mock_get_connection):
+    conn = MagicMock()
+    conn.execute_query_dict = AsyncMock(return_value=[
+        {"id": 4, "email": "jo_doe@example.com", "score": 1.5},
+        {"id": 9, "email": "john@example.com", "score": 0.75},
+    ])
+    mock_get_connection.return_value = conn
+
+    page = await search_users(" Jo_D ", limit=2)
+
+    _, params = conn.execute_query_dict.await_args.args
+    assert params == ["jo_d", "jo\\_d%", None, None, 2]
+    assert page["next_cursor"] == "0.75:9"
+
+    await search_users("jo_d", limit=2, cursor=page["next_cursor"])
+    _, params = conn.execute_query_dict.await_args.args
+    assert params[2:4] == [0.75, 9]
+
+
+@pytest.mark.asyncio
+async def test_search_rejects_short_queries_and_bad_cursors():
+    with pytest.raises(ValueError):
+        await search_users("jo")
+    with pytest.raises(ValueError):
+        await search_users("john", cursor="nope")
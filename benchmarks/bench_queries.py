@@ -0,0 +1,85 @@
+"""
+Compare the ORM and the asyncpg fast path for the hottest lookups.
+
+Runs the subscription, quota and user-by-email lookups for existing rows,
+first through the Tortoise querysets the services used to run and then
+through app.services.repository. Reports the latency per lookup and the CPU
+time this process spent per lookup, which is the part the fast path saves.
+Needs the database configured in app/.env.
+
+Usage:
+    python benchmarks/bench_queries.py --lookups 5000
+"""
+
+import argparse
+import asyncio
+import statistics
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from tortoise import Tortoise  # noqa: E402
+
+from app.database import TORTOISE_ORM  # noqa: E402
+from app.models.subscription import Quota, UserSubscription  # noqa: E402
+from app.models.user import User  # noqa: E402
+from app.services import repository  # noqa: E402
+
+
+async def measure(lookup, keys, lookups: int):
+    latencies = []
+    cpu_started = time.process_time()
+    for i in range(lookups):
+        started = time.perf_counter()
+        await lookup(keys[i % len(keys)])
+        latencies.append(time.perf_counter() - started)
+    cpu = time.process_time() - cpu_started
+    latencies.sort()
+    return {
+        "p50": statistics.median(latencies) * 1e6,
+        "p99": latencies[int(len(latencies) * 0.99) - 1] * 1e6,
+        "cpu": cpu / lookups * 1e6,
+    }
+
+
+async def run(lookups: int, sample: int) -> None:
+    await Tortoise.init(config=TORTOISE_ORM)
+    try:
+        users = await UserSubscription.all().limit(sample).values_list("user", flat=True)
+        emails = await User.filter(deleted_at__isnull=True).limit(sample).values_list("email", flat=True)
+        if not users or not emails:
+            sys.exit("Needs at least one subscription and one user in the database")
+
+        cases = [
+            ("subscription", users,
+             lambda user: UserSubscription.filter(user=user).first(), repository.get_subscription),
+            ("quota", users,
+             lambda user: Quota.filter(user=user).first(), repository.get_quota),
+            ("user_by_email", emails,
+             lambda email: User.get_or_none(email=email, deleted_at__isnull=True), repository.get_user_by_email),
+        ]
+
+        print(f"{'lookup':<15}{'path':<6}{'p50 us':>10}{'p99 us':>10}{'cpu us':>10}")
+        for name, keys, orm_lookup, fast_lookup in cases:
+            # Warm both paths up so every pooled connection has its statements prepared
+            await measure(orm_lookup, keys, min(lookups, 200))
+            await measure(fast_lookup, keys, min(lookups, 200))
+            for path, lookup in (("orm", orm_lookup), ("fast", fast_lookup)):
+                result = await measure(lookup, keys, lookups)
+                print(f"{name:<15}{path:<6}{result['p50']:>10.1f}{result['p99']:>10.1f}{result['cpu']:>10.1f}")
+    finally:
+        await Tortoise.close_connections()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--lookups", type=int, default=5000)
+    parser.add_argument("--sample", type=int, default=1000, help="Distinct rows to look up")
+    args = parser.parse_args()
+    asyncio.run(run(args.lookups, args.sample))
+
+
+if __name__ == "__main__":
+    main()
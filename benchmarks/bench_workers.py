@@ -0,0 +1,120 @@
+"""
+Measure how request throughput scales with the number of server workers.
+
+Starts `server.py` once per worker count, drives it with concurrent
+keep-alive clients for a fixed duration and prints requests per second,
+latency percentiles and the speed-up relative to the first worker count.
+
+The app connects to the database on startup, so the usual DB_* settings
+must point at a reachable Postgres instance.
+
+Usage:
+    python benchmarks/bench_workers.py --workers 1 2 4 --duration 10 --path /
+"""
+
+import argparse
+import asyncio
+import os
+import signal
+import statistics
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+import httpx
+
+ROOT = Path(__file__).resolve().parent.parent
+
+
+async def wait_until_ready(url: str, timeout: float = 30.0) -> None:
+    deadline = time.monotonic() + timeout
+    async with httpx.AsyncClient() as client:
+        while time.monotonic() < deadline:
+            try:
+                await client.get(url)
+                return
+            except httpx.TransportError:
+                await asyncio.sleep(0.2)
+    raise RuntimeError(f"server at {url} did not come up within {timeout}s")
+
+
+async def drive(url: str, concurrency: int, duration: float):
+    latencies = []
+    errors = 0
+    stop_at = time.monotonic() + duration
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+
+    async with httpx.AsyncClient(limits=limits, timeout=10.0) as client:
+        async def client_loop():
+            nonlocal errors
+            while time.monotonic() < stop_at:
+                started = time.perf_counter()
+                try:
+                    response = await client.get(url)
+                    if response.status_code >= 500:
+                        errors += 1
+                except httpx.HTTPError:
+                    errors += 1
+                latencies.append(time.perf_counter() - started)
+
+        await asyncio.gather(*(client_loop() for _ in range(concurrency)))
+
+    return latencies, errors
+
+
+def run_one(workers: int, port: int, path: str, concurrency: int, duration: float) -> dict:
+    env = dict(os.environ, WEB_CONCURRENCY=str(workers))
+    server = subprocess.Popen(
+        [sys.executable, "server.py", "--workers", str(workers), "--host", "127.0.0.1", "--port", str(port)],
+        cwd=ROOT,
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    url = f"http://127.0.0.1:{port}{path}"
+    try:
+        asyncio.run(wait_until_ready(url))
+        # Short warm-up so every worker has its pool and caches populated
+        asyncio.run(drive(url, concurrency, 1.0))
+        latencies, errors = asyncio.run(drive(url, concurrency, duration))
+    finally:
+        server.send_signal(signal.SIGTERM)
+        server.wait(timeout=60)
+
+    latencies.sort()
+    return {
+        "workers": workers,
+        "rps": len(latencies) / duration,
+        "p50_ms": statistics.median(latencies) * 1000,
+        "p99_ms": latencies[int(len(latencies) * 0.99) - 1] * 1000,
+        "errors": errors,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--concurrency", type=int, default=64)
+    parser.add_argument("--duration", type=float, default=10.0)
+    parser.add_argument("--path", default="/")
+    parser.add_argument("--port", type=int, default=8011)
+    args = parser.parse_args()
+
+    results = [
+        run_one(workers, args.port, args.path, args.concurrency, args.duration)
+        for workers in args.workers
+    ]
+
+    baseline = results[0]["rps"]
+    print(f"{'workers':>7} {'req/s':>10} {'p50 ms':>8} {'p99 ms':>8} {'errors':>7} {'speedup':>8}")
+    for row in results:
+        speedup = row["rps"] / baseline if baseline else 0.0
+        print(
+            f"{row['workers']:>7} {row['rps']:>10.0f} {row['p50_ms']:>8.2f} "
+            f"{row['p99_ms']:>8.2f} {row['errors']:>7} {speedup:>7.2f}x"
+        )
+
+
+if __name__ == "__main__":
+    main()
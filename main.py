@@ -1,10 +1,31 @@
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
+from app.services import logs
+
+# Before anything logs, so every record goes through the queue
+logs.configure_logging()
+
 from app.routes import user
 from app.database import register_db
 from app.routes import subscription_route
+from app.routes import metrics_route
+from app.routes import reports_route
+from app.routes import debug_route
+from app.services import background
+from app.services import idempotency
+from app.services import query_stats
+from app.services import profiling
+from app.services import shards
+from app.services import user as user_service
+from app.services import sweeper  # noqa: F401  registers the expiry sweeper task
+from app.services import purge  # noqa: F401  registers the deleted-user purge task
+from app.services import reconcile  # noqa: F401  registers the Stripe reconciliation task
 app = FastAPI(title="Summit API")
 
+# Replay responses for repeated Idempotency-Keys; added before CORS so it
+# runs inside it and replayed responses get the CORS headers of the retry
+app.add_middleware(idempotency.IdempotencyMiddleware)
+
 # Configure CORS
 app.add_middleware(
     CORSMiddleware,
@@ -14,12 +35,34 @@ app.add_middleware(
     allow_headers=["*"],  # Allows all headers
 )
 
+# Profiling hooks are only mounted when asked for, so they cost nothing otherwise
+if profiling.PROFILING_ENABLED:
+    app.add_middleware(profiling.RequestProfilerMiddleware)
+
+# Count the queries of every request; added last so it is outermost and times
+# the whole request, including the profiler's superuser check
+query_stats.install()
+app.add_middleware(query_stats.QueryAccountingMiddleware)
+
+# Background tasks flush buffered writes when they stop, so their shutdown
+# handler has to run before the one register_db installs to close the
+# database connections.
+app.add_event_handler("shutdown", background.shutdown)
+
 # Register database
 register_db(app)
 
+app.add_event_handler("startup", shards.align_user_sequences)
+app.add_event_handler("startup", user_service.backfill_user_directory)
+app.add_event_handler("startup", background.startup)
+
 # Include routers
 app.include_router(user.router, prefix="/api/v1")
 app.include_router(subscription_route.router, prefix="/api/v1")
+app.include_router(metrics_route.router, prefix="/api/v1")
+app.include_router(reports_route.router, prefix="/api/v1")
+if profiling.PROFILING_ENABLED:
+    app.include_router(debug_route.router, prefix="/api/v1")
 
 @app.get("/")
 async def root():
@@ -1,11 +1,57 @@
 import os
 import sys
 import asyncio
+import random
+import re
 import shutil
+from datetime import datetime
 from pathlib import Path
+import asyncpg
 from tortoise import Tortoise
-from app.database import TORTOISE_ORM
+from tortoise.transactions import in_transaction
+from app.database import SHARD_CONNECTIONS, TORTOISE_ORM, config_for_shard
 from aerich import Command
+from aerich.migrate import Migrate
+from aerich.models import Aerich
+from aerich.utils import get_app_connection, get_models_describe, import_py_file
+
+APP = "models"
+# Commands that apply or inspect migrations, and so can target each shard
+SHARD_COMMANDS = {"init-db", "upgrade", "history", "downgrade"}
+
+# Online upgrades give up waiting for a table lock after this long and retry
+# later, rather than queueing behind a long transaction and blocking every
+# query that arrives after them.
+MIGRATION_LOCK_TIMEOUT = os.getenv("MIGRATION_LOCK_TIMEOUT", "3s")
+MIGRATION_LOCK_RETRIES = int(os.getenv("MIGRATION_LOCK_RETRIES", "10"))
+
+CREATE_INDEX_RE = re.compile(
+    r'^\s*CREATE\s+(UNIQUE\s+)?INDEX\s+(CONCURRENTLY\s+)?(IF\s+NOT\s+EXISTS\s+)?"?(\w+)"?',
+    re.IGNORECASE,
+)
+INDEX_TABLE_RE = re.compile(r'\sON\s+(ONLY\s+)?"?(\w+)"?', re.IGNORECASE)
+DROP_INDEX_RE = re.compile(r"^\s*DROP\s+INDEX\s+(?!CONCURRENTLY)", re.IGNORECASE)
+CREATE_TABLE_RE = re.compile(r'^\s*CREATE\s+TABLE\s+(IF\s+NOT\s+EXISTS\s+)?"?(\w+)"?', re.IGNORECASE)
+DROP_TABLE_RE = re.compile(r'^\s*DROP\s+TABLE\s+(IF\s+EXISTS\s+)?"?(\w+)"?', re.IGNORECASE)
+
+SQUASHED_TEMPLATE = '''from tortoise import BaseDBAsyncClient
+
+# Migrations folded into this baseline by `python migrate.py squash`.
+# Databases that already applied all of them record this file as applied
+# without running it.
+REPLACES = {replaces!r}
+
+
+async def upgrade(db: BaseDBAsyncClient) -> str:
+    return """
+        {upgrade_sql}"""
+
+
+async def downgrade(db: BaseDBAsyncClient) -> str:
+    return """
+        """
+'''
+
 
 def clean_migrations():
     """Clean up existing migrations directory"""
@@ -20,42 +66,304 @@ async def init_tortoise():
 async def close_tortoise():
     await Tortoise.close_connections()
 
-async def run_migration(command: str):
+
+def split_sql(script: str) -> list:
+    """Split a migration script into statements, respecting quotes, comments and $$ bodies"""
+    statements, current = [], []
+    quote = None
+    i = 0
+    while i < len(script):
+        char = script[i]
+        if quote:
+            if script.startswith(quote, i):
+                current.append(quote)
+                i += len(quote)
+                quote = None
+                continue
+        elif script.startswith("--", i):
+            # Comments are left out, so a semicolon in one cannot end a statement
+            end = script.find("\n", i)
+            i = len(script) if end == -1 else end
+            continue
+        elif script.startswith("/*", i):
+            end = script.find("*/", i + 2)
+            i = len(script) if end == -1 else end + 2
+            continue
+        elif char in "'\"":
+            quote = char
+        elif char == "$":
+            match = re.match(r"\$\w*\$", script[i:])
+            if match:
+                quote = match.group(0)
+                current.append(quote)
+                i += len(quote)
+                continue
+        elif char == ";":
+            statement = "".join(current).strip()
+            if statement:
+                statements.append(statement)
+            current = []
+            i += 1
+            continue
+        current.append(char)
+        i += 1
+    statement = "".join(current).strip()
+    if statement:
+        statements.append(statement)
+    return statements
+
+
+def remove_dropped_tables(statements: list) -> list:
+    """Drop statements for tables that a later statement drops for good"""
+    dropped = {}
+    for index, statement in enumerate(statements):
+        match = DROP_TABLE_RE.match(statement)
+        if match:
+            dropped[match.group(2)] = index
+    for index, statement in enumerate(statements):
+        match = CREATE_TABLE_RE.match(statement)
+        if match and dropped.get(match.group(2), -1) < index:
+            # Recreated after its last drop, so it is part of the final schema
+            dropped.pop(match.group(2), None)
+
+    def touches(statement, table):
+        return re.search(rf'(?<![\w"])"?{table}"?(?![\w"])', statement) is not None
+
+    return [
+        statement for statement in statements
+        if not any(touches(statement, table) for table in dropped)
+    ]
+
+
+async def load_upgrade_sql(connection, version_file: str) -> str:
+    module = import_py_file(Path(Migrate.migrate_location, version_file))
+    return await module.upgrade(connection)
+
+
+def replaced_versions(version_file: str) -> list:
+    module = import_py_file(Path(Migrate.migrate_location, version_file))
+    return list(getattr(module, "REPLACES", []))
+
+
+async def record_squashed_baselines() -> None:
+    """
+    Mark squashed baselines as applied where everything they replace was applied.
+
+    A database that applied only some of the replaced migrations cannot be
+    upgraded past the baseline: the baseline would recreate what it already
+    has, and the migrations it is missing no longer exist on their own. The
+    upgrade is refused; apply the missing migrations from a release before
+    the squash first.
+    """
+    for version_file in Migrate.get_all_version_files():
+        replaces = replaced_versions(version_file)
+        if not replaces or await Aerich.exists(version=version_file, app=APP):
+            continue
+        applied = await Aerich.filter(app=APP, version__in=replaces).values_list("version", flat=True)
+        if not applied:
+            continue
+        if len(applied) != len(replaces):
+            missing = [version for version in replaces if version not in applied]
+            print(
+                f"❌ {version_file} replaces migrations this database only partly applied. "
+                f"Upgrade with a release from before the squash to apply {', '.join(missing)} first."
+            )
+            sys.exit(1)
+        async with in_transaction():
+            latest = await Aerich.filter(app=APP).first()
+            await Aerich.filter(app=APP, version__in=replaces).delete()
+            await Aerich.create(version=version_file, app=APP, content=latest.content)
+        print(f"✅ Recorded squashed baseline {version_file}")
+
+
+async def squash(aerich: Command):
+    """Merge the whole migration history into a single baseline migration"""
+    pending = await aerich.heads()
+    if pending:
+        print(f"❌ Apply pending migrations before squashing: {', '.join(pending)}")
+        sys.exit(1)
+
+    versions = Migrate.get_all_version_files()
+    if len(versions) < 2:
+        print("Nothing to squash")
+        return
+
+    connection = get_app_connection(TORTOISE_ORM, APP)
+    statements = []
+    for version_file in versions:
+        statements.extend(split_sql(await load_upgrade_sql(connection, version_file)))
+    statements = remove_dropped_tables(statements)
+
+    replaces = []
+    for version_file in versions:
+        replaces.extend(replaced_versions(version_file) or [version_file])
+
+    number = int(versions[-1].split("_")[0])
+    baseline = f"{number}_{datetime.now().strftime('%Y%m%d%H%M%S')}_squashed.py"
+    content = SQUASHED_TEMPLATE.format(
+        replaces=replaces,
+        upgrade_sql=";\n        ".join(statements) + ";",
+    )
+
+    async with in_transaction():
+        latest = await Aerich.filter(app=APP).first()
+        await Aerich.filter(app=APP).delete()
+        await Aerich.create(version=baseline, app=APP, content=latest.content)
+
+    for version_file in versions:
+        Path(Migrate.migrate_location, version_file).unlink()
+    Path(Migrate.migrate_location, baseline).write_text(content, encoding="utf-8")
+    print(f"✅ Squashed {len(versions)} migrations into {baseline}")
+
+
+async def execute_with_lock_retries(conn, statement: str, before_retry=None) -> None:
+    for attempt in range(1, MIGRATION_LOCK_RETRIES + 1):
+        try:
+            await conn.execute(statement)
+            return
+        except asyncpg.exceptions.LockNotAvailableError:
+            if attempt == MIGRATION_LOCK_RETRIES:
+                raise
+            delay = min(30.0, 0.5 * 2 ** attempt) * random.uniform(0.5, 1.0)
+            print(f"⏳ Lock not available, retrying in {delay:.1f}s ({attempt}/{MIGRATION_LOCK_RETRIES})")
+            await asyncio.sleep(delay)
+            if before_retry is not None:
+                await before_retry()
+
+
+async def index_valid(conn, name: str):
+    """Whether the index is valid, or None if it does not exist."""
+    return await conn.fetchval(
+        "SELECT i.indisvalid FROM pg_class c JOIN pg_index i ON i.indexrelid = c.oid WHERE c.relname = $1",
+        name,
+    )
+
+
+async def drop_invalid_index(conn, name: str) -> None:
+    # A failed concurrent build leaves an INVALID index behind that
+    # IF NOT EXISTS would silently accept, so it has to go first.
+    if await index_valid(conn, name) is False:
+        await execute_with_lock_retries(conn, f'DROP INDEX CONCURRENTLY IF EXISTS "{name}"')
+
+
+async def run_online_statement(conn, statement: str) -> None:
+    index = CREATE_INDEX_RE.match(statement)
+    if index:
+        name = index.group(4)
+        await drop_invalid_index(conn, name)
+        table = INDEX_TABLE_RE.search(statement)
+        # Partitioned tables do not support concurrent index builds
+        partitioned = table and await conn.fetchval(
+            "SELECT relkind = 'p' FROM pg_class WHERE relname = $1", table.group(2)
+        )
+        if not index.group(2) and not partitioned:
+            statement = re.sub(r"INDEX\s+", "INDEX CONCURRENTLY ", statement, count=1, flags=re.IGNORECASE)
+
+        # A build that times out waiting for older transactions also leaves
+        # an INVALID index, so drop it before every retry
+        await execute_with_lock_retries(conn, statement, lambda: drop_invalid_index(conn, name))
+        if not await index_valid(conn, name):
+            raise RuntimeError(f'Index "{name}" is not valid after "{statement.strip()[:200]}"')
+        return
+
+    if DROP_INDEX_RE.match(statement):
+        statement = re.sub(r"INDEX\s+", "INDEX CONCURRENTLY ", statement, count=1, flags=re.IGNORECASE)
+
+    await execute_with_lock_retries(conn, statement)
+
+
+async def upgrade_online(aerich: Command):
+    """
+    Apply pending migrations without long blocking locks.
+
+    Indexes are built and dropped CONCURRENTLY, and every other statement
+    runs with a short lock_timeout and is retried, so a statement never sits
+    in the lock queue in front of application queries. Statements run in
+    autocommit mode, so a failed migration can be partially applied; every
+    statement aerich generates is safe to re-run once fixed.
+    """
+    connection = get_app_connection(TORTOISE_ORM, APP)
+    pending = await aerich.heads()
+    if not pending:
+        print("No pending migrations")
+        return
+
+    async with connection.acquire_connection() as conn:
+        await conn.execute(f"SET lock_timeout = '{MIGRATION_LOCK_TIMEOUT}'")
+        await conn.execute("SET statement_timeout = 0")
+        for version_file in pending:
+            for statement in split_sql(await load_upgrade_sql(connection, version_file)):
+                await run_online_statement(conn, statement)
+            await Aerich.create(version=version_file, app=APP, content=get_models_describe(APP))
+            print(f"✅ Applied {version_file} online")
+
+
+async def run_migration(command: str, options: set):
     await init_tortoise()
     try:
-        aerich = Command(tortoise_config=TORTOISE_ORM, app="models")
-        
+        aerich = Command(tortoise_config=TORTOISE_ORM, app=APP)
+
         if command == "init":
             clean_migrations()
             await aerich.init()
-        elif command == "init-db":
+            return
+
+        await aerich.init()
+        if command == "init-db":
             await aerich.init_db(safe=True)
         elif command == "migrate":
             await aerich.migrate()
         elif command == "upgrade":
-            await aerich.upgrade()
+            await record_squashed_baselines()
+            if "--online" in options:
+                await upgrade_online(aerich)
+            else:
+                await aerich.upgrade(run_in_transaction=True)
+        elif command == "squash":
+            await squash(aerich)
         elif command == "history":
             await aerich.history()
         elif command == "downgrade":
-            await aerich.downgrade()
+            await aerich.downgrade(version=-1, delete=False)
     finally:
         await close_tortoise()
 
 
+def use_shard(index: int) -> None:
+    """Point the "default" connection at another shard"""
+    global TORTOISE_ORM
+    TORTOISE_ORM = config_for_shard(index)
+    print(f"Shard {index} ({SHARD_CONNECTIONS[index]})")
+
+
 async def main():
     if len(sys.argv) < 2:
-        print("Usage: python migrate.py [init|migrate|upgrade|history|downgrade]")
+        print("Usage: python migrate.py [init|migrate|upgrade [--online]|squash|history|downgrade] "
+              "[--shard=N|--all-shards]")
         sys.exit(1)
 
     command = sys.argv[1].lower()
-    valid_commands = {"init", "init-db", "migrate", "upgrade", "history", "downgrade"}
+    options = set(sys.argv[2:])
+    valid_commands = {"init", "init-db", "migrate", "upgrade", "squash", "history", "downgrade"}
 
     if command not in valid_commands:
         print(f"❌ Unknown command: {command}")
-        print("Available commands: init, migrate, upgrade, history, downgrade")
+        print("Available commands: init, migrate, upgrade [--online], squash, history, downgrade")
         sys.exit(1)
 
-    await run_migration(command)
+    # Every shard has the full schema and its own migration history
+    shard = next((option.split("=", 1)[1] for option in options if option.startswith("--shard=")), None)
+    if "--all-shards" in options or shard is not None:
+        if command not in SHARD_COMMANDS:
+            print(f"❌ {command} does not run per shard")
+            sys.exit(1)
+        indexes = range(len(SHARD_CONNECTIONS)) if shard is None else [int(shard)]
+        for index in indexes:
+            use_shard(index)
+            await run_migration(command, options)
+        return
+
+    await run_migration(command, options)
 
 if __name__ == "__main__":
     asyncio.run(main())
@@ -0,0 +1,15 @@
+from tortoise import BaseDBAsyncClient
+
+
+async def upgrade(db: BaseDBAsyncClient) -> str:
+    return """
+        ALTER TABLE "usersubscription" ADD "updated_at" TIMESTAMPTZ NOT NULL  DEFAULT CURRENT_TIMESTAMP;
+        CREATE INDEX IF NOT EXISTS "idx_usersubscr_updated_at" ON "usersubscription" ("updated_at");
+        CREATE INDEX IF NOT EXISTS "idx_quota_updated_at" ON "quota" ("updated_at");"""
+
+
+async def downgrade(db: BaseDBAsyncClient) -> str:
+    return """
+        DROP INDEX IF EXISTS "idx_quota_updated_at";
+        DROP INDEX IF EXISTS "idx_usersubscr_updated_at";
+        ALTER TABLE "usersubscription" DROP COLUMN "updated_at";"""
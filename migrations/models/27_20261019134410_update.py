@@ -0,0 +1,19 @@
+from tortoise import BaseDBAsyncClient
+
+
+async def upgrade(db: BaseDBAsyncClient) -> str:
+    return """
+        ALTER TABLE "users" ADD "deleted_at" TIMESTAMPTZ;
+        CREATE INDEX IF NOT EXISTS "idx_users_deleted_at" ON "users" ("deleted_at") WHERE "deleted_at" IS NOT NULL;
+        CREATE INDEX IF NOT EXISTS "idx_otp_system_user_id" ON "otp_system" ("user_id");
+        CREATE INDEX IF NOT EXISTS "idx_usersubscr_user" ON "usersubscription" ("user");
+        CREATE INDEX IF NOT EXISTS "idx_quota_user" ON "quota" ("user");"""
+
+
+async def downgrade(db: BaseDBAsyncClient) -> str:
+    return """
+        DROP INDEX IF EXISTS "idx_quota_user";
+        DROP INDEX IF EXISTS "idx_usersubscr_user";
+        DROP INDEX IF EXISTS "idx_otp_system_user_id";
+        DROP INDEX IF EXISTS "idx_users_deleted_at";
+        ALTER TABLE "users" DROP COLUMN "deleted_at";"""
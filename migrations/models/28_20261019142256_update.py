@@ -0,0 +1,22 @@
+from tortoise import BaseDBAsyncClient
+
+
+async def upgrade(db: BaseDBAsyncClient) -> str:
+    return """
+        CREATE TABLE IF NOT EXISTS "checkout_session" (
+    "id" SERIAL NOT NULL PRIMARY KEY,
+    "user" VARCHAR(255) NOT NULL,
+    "subscription_plan" VARCHAR(10) NOT NULL,
+    "subscription_frequency" VARCHAR(7) NOT NULL,
+    "session_id" VARCHAR(255) NOT NULL,
+    "url" TEXT NOT NULL,
+    "expires_at" TIMESTAMPTZ NOT NULL,
+    "created_at" TIMESTAMPTZ NOT NULL  DEFAULT CURRENT_TIMESTAMP,
+    CONSTRAINT "uid_checkout_se_user_2c3f1a" UNIQUE ("user", "subscription_plan", "subscription_frequency")
+);
+CREATE INDEX IF NOT EXISTS "idx_checkout_se_expires_5b7e0d" ON "checkout_session" ("expires_at");"""
+
+
+async def downgrade(db: BaseDBAsyncClient) -> str:
+    return """
+        DROP TABLE IF EXISTS "checkout_session";"""
@@ -0,0 +1,17 @@
+from tortoise import BaseDBAsyncClient
+
+
+async def upgrade(db: BaseDBAsyncClient) -> str:
+    return """
+        CREATE TABLE IF NOT EXISTS "sync_state" (
+    "key" VARCHAR(100) NOT NULL PRIMARY KEY,
+    "value" TEXT NOT NULL,
+    "updated_at" TIMESTAMPTZ NOT NULL  DEFAULT CURRENT_TIMESTAMP
+);
+CREATE INDEX IF NOT EXISTS "idx_usersubscr_stripe__8d41c2" ON "usersubscription" ("stripe_subscription_id");"""
+
+
+async def downgrade(db: BaseDBAsyncClient) -> str:
+    return """
+        DROP INDEX IF EXISTS "idx_usersubscr_stripe__8d41c2";
+        DROP TABLE IF EXISTS "sync_state";"""
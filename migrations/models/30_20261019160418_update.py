@@ -0,0 +1,36 @@
+from tortoise import BaseDBAsyncClient
+
+
+async def upgrade(db: BaseDBAsyncClient) -> str:
+    return """
+        ALTER TABLE "quota" ADD "checkpoint_at" TIMESTAMPTZ NOT NULL  DEFAULT CURRENT_TIMESTAMP;
+        CREATE TABLE IF NOT EXISTS "usage_event" (
+    "id" BIGSERIAL NOT NULL,
+    "user" VARCHAR(255) NOT NULL,
+    "feature" VARCHAR(50) NOT NULL,
+    "units" INT NOT NULL,
+    "created_at" TIMESTAMPTZ NOT NULL  DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY ("id", "created_at")
+) PARTITION BY RANGE ("created_at");
+CREATE INDEX IF NOT EXISTS "idx_usage_event_user_created" ON "usage_event" ("user", "created_at");
+DO $$
+DECLARE
+    month DATE;
+BEGIN
+    FOR i IN 0..2 LOOP
+        month := date_trunc('month', now() AT TIME ZONE 'UTC')::date + make_interval(months => i);
+        EXECUTE format(
+            'CREATE TABLE IF NOT EXISTS %I PARTITION OF "usage_event" FOR VALUES FROM (%L) TO (%L)',
+            'usage_event_p' || to_char(month, 'YYYY_MM'),
+            month::text || ' 00:00:00+00',
+            (month + interval '1 month')::date::text || ' 00:00:00+00'
+        );
+    END LOOP;
+END
+$$;"""
+
+
+async def downgrade(db: BaseDBAsyncClient) -> str:
+    return """
+        DROP TABLE IF EXISTS "usage_event";
+        ALTER TABLE "quota" DROP COLUMN "checkpoint_at";"""
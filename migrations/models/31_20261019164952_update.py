@@ -0,0 +1,39 @@
+from tortoise import BaseDBAsyncClient
+
+
+async def upgrade(db: BaseDBAsyncClient) -> str:
+    return """
+        ALTER TABLE "usersubscription" ADD "price" DECIMAL(10,2);
+        CREATE TABLE IF NOT EXISTS "usage_daily_user" (
+    "id" SERIAL NOT NULL PRIMARY KEY,
+    "day" DATE NOT NULL,
+    "user" VARCHAR(255) NOT NULL,
+    "units" BIGINT NOT NULL  DEFAULT 0,
+    CONSTRAINT "uid_usage_daily_day_8c1f3e" UNIQUE ("day", "user")
+);
+CREATE INDEX IF NOT EXISTS "idx_usage_daily_user_5e2a7b" ON "usage_daily_user" ("user");
+        CREATE TABLE IF NOT EXISTS "usage_daily_plan" (
+    "id" SERIAL NOT NULL PRIMARY KEY,
+    "day" DATE NOT NULL,
+    "plan" VARCHAR(10) NOT NULL,
+    "units" BIGINT NOT NULL  DEFAULT 0,
+    CONSTRAINT "uid_usage_daily_day_3b9d40" UNIQUE ("day", "plan")
+);
+        CREATE MATERIALIZED VIEW IF NOT EXISTS "subscription_rollup" AS
+    SELECT "subscription_plan", "subscription_frequency",
+           count(*) FILTER (WHERE "is_active") AS "active",
+           count(*) AS "total",
+           coalesce(sum(
+               CASE WHEN "subscription_frequency" = 'yearly' THEN "price" / 12 ELSE "price" END
+           ) FILTER (WHERE "is_active"), 0)::numeric(12,2) AS "mrr"
+    FROM "usersubscription"
+    GROUP BY "subscription_plan", "subscription_frequency";
+        CREATE UNIQUE INDEX IF NOT EXISTS "uid_subscription_rollup" ON "subscription_rollup" ("subscription_plan", "subscription_frequency");"""
+
+
+async def downgrade(db: BaseDBAsyncClient) -> str:
+    return """
+        DROP MATERIALIZED VIEW IF EXISTS "subscription_rollup";
+        DROP TABLE IF EXISTS "usage_daily_plan";
+        DROP TABLE IF EXISTS "usage_daily_user";
+        ALTER TABLE "usersubscription" DROP COLUMN "price";"""
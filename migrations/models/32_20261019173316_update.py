@@ -0,0 +1,16 @@
+from tortoise import BaseDBAsyncClient
+
+
+async def upgrade(db: BaseDBAsyncClient) -> str:
+    return """
+        CREATE EXTENSION IF NOT EXISTS pg_trgm;
+        CREATE INDEX IF NOT EXISTS "idx_users_email_trgm" ON "users" USING GIN ("email" gin_trgm_ops) WHERE "deleted_at" IS NULL;
+        CREATE INDEX IF NOT EXISTS "idx_users_username_trgm" ON "users" USING GIN ("username" gin_trgm_ops) WHERE "deleted_at" IS NULL;
+        CREATE INDEX IF NOT EXISTS "idx_users_full_name_trgm" ON "users" USING GIN ("full_name" gin_trgm_ops) WHERE "deleted_at" IS NULL;"""
+
+
+async def downgrade(db: BaseDBAsyncClient) -> str:
+    return """
+        DROP INDEX IF EXISTS "idx_users_full_name_trgm";
+        DROP INDEX IF EXISTS "idx_users_username_trgm";
+        DROP INDEX IF EXISTS "idx_users_email_trgm";"""
@@ -0,0 +1,18 @@
+from tortoise import BaseDBAsyncClient
+
+
+async def upgrade(db: BaseDBAsyncClient) -> str:
+    return """
+        DELETE FROM "usersubscription" AS s USING "usersubscription" AS keep
+        WHERE s."user" = keep."user"
+          AND (s."is_active", s."updated_at", s."id") < (keep."is_active", keep."updated_at", keep."id");
+        DELETE FROM "quota" AS q USING "quota" AS keep
+        WHERE q."user" = keep."user" AND (q."updated_at", q."id") < (keep."updated_at", keep."id");
+        CREATE UNIQUE INDEX IF NOT EXISTS "uid_usersubscri_user_c1e852" ON "usersubscription" ("user");
+        CREATE UNIQUE INDEX IF NOT EXISTS "uid_quota_user_aad140" ON "quota" ("user");"""
+
+
+async def downgrade(db: BaseDBAsyncClient) -> str:
+    return """
+        DROP INDEX IF EXISTS "uid_quota_user_aad140";
+        DROP INDEX IF EXISTS "uid_usersubscri_user_c1e852";"""
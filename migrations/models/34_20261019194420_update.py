@@ -0,0 +1,35 @@
+from tortoise import BaseDBAsyncClient
+
+
+async def upgrade(db: BaseDBAsyncClient) -> str:
+    return """
+        CREATE TABLE IF NOT EXISTS "plan_catalog" (
+    "id" SERIAL NOT NULL PRIMARY KEY,
+    "plan" VARCHAR(10) NOT NULL,
+    "frequency" VARCHAR(7) NOT NULL,
+    "stripe_price_id" VARCHAR(255),
+    "quota" INT NOT NULL,
+    "features" JSONB NOT NULL,
+    "updated_at" TIMESTAMPTZ NOT NULL  DEFAULT CURRENT_TIMESTAMP,
+    CONSTRAINT "uid_plan_catalo_plan_36ab01" UNIQUE ("plan", "frequency")
+);
+        CREATE OR REPLACE FUNCTION "plan_catalog_touch"() RETURNS trigger AS $$
+        BEGIN
+            NEW."updated_at" = now();
+            RETURN NEW;
+        END;
+        $$ LANGUAGE plpgsql;
+        DROP TRIGGER IF EXISTS "plan_catalog_touch" ON "plan_catalog";
+        CREATE TRIGGER "plan_catalog_touch" BEFORE UPDATE ON "plan_catalog"
+            FOR EACH ROW EXECUTE FUNCTION "plan_catalog_touch"();
+        INSERT INTO "plan_catalog" ("plan", "frequency", "quota", "features")
+        SELECT p."plan", f."frequency", p."quota", '[]'::jsonb
+        FROM (VALUES ('free', 100), ('light', 2000), ('standard', 5000), ('pro', 12000)) AS p("plan", "quota")
+        CROSS JOIN (VALUES ('monthly'), ('yearly')) AS f("frequency")
+        ON CONFLICT ("plan", "frequency") DO NOTHING;"""
+
+
+async def downgrade(db: BaseDBAsyncClient) -> str:
+    return """
+        DROP TABLE IF EXISTS "plan_catalog";
+        DROP FUNCTION IF EXISTS "plan_catalog_touch"();"""
@@ -0,0 +1,22 @@
+from tortoise import BaseDBAsyncClient
+
+
+async def upgrade(db: BaseDBAsyncClient) -> str:
+    return """
+        ALTER TABLE "quota" ADD COLUMN IF NOT EXISTS "reserved" INT NOT NULL  DEFAULT 0;
+        CREATE TABLE IF NOT EXISTS "quota_reservation" (
+    "id" UUID NOT NULL  PRIMARY KEY,
+    "user" VARCHAR(255) NOT NULL,
+    "feature" VARCHAR(50) NOT NULL,
+    "units" INT NOT NULL,
+    "expires_at" TIMESTAMPTZ NOT NULL,
+    "created_at" TIMESTAMPTZ NOT NULL  DEFAULT CURRENT_TIMESTAMP
+);
+        CREATE INDEX IF NOT EXISTS "idx_quota_reser_user_4fe03f" ON "quota_reservation" ("user");
+        CREATE INDEX IF NOT EXISTS "idx_quota_reser_expires_1578d3" ON "quota_reservation" ("expires_at");"""
+
+
+async def downgrade(db: BaseDBAsyncClient) -> str:
+    return """
+        DROP TABLE IF EXISTS "quota_reservation";
+        ALTER TABLE "quota" DROP COLUMN IF EXISTS "reserved";"""
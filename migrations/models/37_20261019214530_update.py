@@ -0,0 +1,94 @@
+from tortoise import BaseDBAsyncClient
+
+
+async def upgrade(db: BaseDBAsyncClient) -> str:
+    return """
+        CREATE TABLE IF NOT EXISTS "stat_counter" (
+    "id" SERIAL NOT NULL PRIMARY KEY,
+    "name" VARCHAR(100) NOT NULL,
+    "slot" SMALLINT NOT NULL  DEFAULT 0,
+    "value" BIGINT NOT NULL  DEFAULT 0,
+    CONSTRAINT "uid_stat_counte_name_bf2cdb" UNIQUE ("name", "slot")
+);
+        CREATE OR REPLACE FUNCTION "stat_counter_add"(counter VARCHAR, delta BIGINT) RETURNS void AS $$
+        BEGIN
+            IF delta <> 0 THEN
+                INSERT INTO "stat_counter" ("name", "slot", "value")
+                VALUES (counter, pg_backend_pid() % 8, delta)
+                ON CONFLICT ("name", "slot") DO UPDATE SET "value" = "stat_counter"."value" + EXCLUDED."value";
+            END IF;
+        END;
+        $$ LANGUAGE plpgsql;
+        CREATE OR REPLACE FUNCTION "stat_counter_users"() RETURNS trigger AS $$
+        DECLARE
+            total_delta BIGINT := 0;
+            active_delta BIGINT := 0;
+        BEGIN
+            IF TG_OP IN ('UPDATE', 'DELETE') AND OLD."deleted_at" IS NULL THEN
+                total_delta := total_delta - 1;
+                IF OLD."is_active" THEN
+                    active_delta := active_delta - 1;
+                END IF;
+            END IF;
+            IF TG_OP IN ('INSERT', 'UPDATE') AND NEW."deleted_at" IS NULL THEN
+                total_delta := total_delta + 1;
+                IF NEW."is_active" THEN
+                    active_delta := active_delta + 1;
+                END IF;
+            END IF;
+            PERFORM "stat_counter_add"('users.total', total_delta);
+            PERFORM "stat_counter_add"('users.active', active_delta);
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql;
+        CREATE OR REPLACE FUNCTION "stat_counter_subscribers"() RETURNS trigger AS $$
+        BEGIN
+            IF TG_OP IN ('UPDATE', 'DELETE') AND OLD."is_active" THEN
+                PERFORM "stat_counter_add"(
+                    'subscribers.' || OLD."subscription_plan" || '.' || OLD."subscription_frequency", -1
+                );
+            END IF;
+            IF TG_OP IN ('INSERT', 'UPDATE') AND NEW."is_active" THEN
+                PERFORM "stat_counter_add"(
+                    'subscribers.' || NEW."subscription_plan" || '.' || NEW."subscription_frequency", 1
+                );
+            END IF;
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql;
+        DO $$
+        BEGIN
+            -- Writes to either table wait until the counters are filled and the
+            -- triggers are in place, so none is counted twice or missed. Filling
+            -- them from scratch keeps a re-run of this block exact.
+            LOCK TABLE "users", "usersubscription" IN SHARE ROW EXCLUSIVE MODE;
+            DELETE FROM "stat_counter";
+            INSERT INTO "stat_counter" ("name", "slot", "value")
+            SELECT 'users.total', 0, count(*) FROM "users" WHERE "deleted_at" IS NULL
+            UNION ALL
+            SELECT 'users.active', 0, count(*) FROM "users" WHERE "deleted_at" IS NULL AND "is_active"
+            UNION ALL
+            SELECT 'subscribers.' || "subscription_plan" || '.' || "subscription_frequency", 0, count(*)
+            FROM "usersubscription" WHERE "is_active"
+            GROUP BY "subscription_plan", "subscription_frequency";
+
+            DROP TRIGGER IF EXISTS "stat_counter_users" ON "users";
+            CREATE TRIGGER "stat_counter_users" AFTER INSERT OR DELETE OR UPDATE OF "is_active", "deleted_at" ON "users"
+                FOR EACH ROW EXECUTE FUNCTION "stat_counter_users"();
+            DROP TRIGGER IF EXISTS "stat_counter_subscribers" ON "usersubscription";
+            CREATE TRIGGER "stat_counter_subscribers"
+                AFTER INSERT OR DELETE OR UPDATE OF "is_active", "subscription_plan", "subscription_frequency"
+                ON "usersubscription"
+                FOR EACH ROW EXECUTE FUNCTION "stat_counter_subscribers"();
+        END;
+        $$;"""
+
+
+async def downgrade(db: BaseDBAsyncClient) -> str:
+    return """
+        DROP TRIGGER IF EXISTS "stat_counter_subscribers" ON "usersubscription";
+        DROP TRIGGER IF EXISTS "stat_counter_users" ON "users";
+        DROP FUNCTION IF EXISTS "stat_counter_subscribers"();
+        DROP FUNCTION IF EXISTS "stat_counter_users"();
+        DROP FUNCTION IF EXISTS "stat_counter_add"(VARCHAR, BIGINT);
+        DROP TABLE IF EXISTS "stat_counter";"""
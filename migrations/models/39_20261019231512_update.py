@@ -0,0 +1,20 @@
+from tortoise import BaseDBAsyncClient
+
+
+async def upgrade(db: BaseDBAsyncClient) -> str:
+    return """
+        ALTER TABLE "usage_event" ADD COLUMN IF NOT EXISTS "txid" BIGINT NOT NULL DEFAULT 0;
+        ALTER TABLE "usage_event" ALTER COLUMN "txid" SET DEFAULT (pg_current_xact_id()::text::bigint);
+        CREATE INDEX IF NOT EXISTS "idx_usage_event_user_txid" ON "usage_event" ("user", "txid");
+        CREATE INDEX IF NOT EXISTS "idx_usage_event_txid" ON "usage_event" ("txid");
+        ALTER TABLE "quota" ADD COLUMN IF NOT EXISTS "checkpoint_txid" BIGINT NOT NULL DEFAULT 0;
+        DELETE FROM "sync_state" WHERE "key" = 'usage_ledger.checkpointed_through';"""
+
+
+async def downgrade(db: BaseDBAsyncClient) -> str:
+    return """
+        DROP INDEX IF EXISTS "idx_usage_event_txid";
+        DROP INDEX IF EXISTS "idx_usage_event_user_txid";
+        ALTER TABLE "usage_event" DROP COLUMN IF EXISTS "txid";
+        ALTER TABLE "quota" DROP COLUMN IF EXISTS "checkpoint_txid";
+        DELETE FROM "sync_state" WHERE "key" = 'usage_ledger.checkpointed_txid';"""
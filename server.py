@@ -0,0 +1,179 @@
+"""
+Production server entry point.
+
+Runs the API under uvicorn, either as a single process or as a supervised
+pool of worker processes that share one listening socket. The event loop
+and HTTP parser default to uvloop/httptools when they are installed.
+
+Usage:
+    python server.py [--workers N] [--host HOST] [--port PORT]
+"""
+
+import argparse
+import logging
+import os
+import signal
+import threading
+import time
+from pathlib import Path
+from typing import List, Optional
+
+from uvicorn import Config, Server
+from uvicorn._subprocess import get_subprocess
+
+logger = logging.getLogger("uvicorn.error")
+
+APP = "main:app"
+HOST = os.getenv("HOST", "0.0.0.0")
+PORT = int(os.getenv("PORT", "8001"))
+# Seconds a worker waits for in-flight requests to finish after SIGTERM
+GRACEFUL_TIMEOUT = int(os.getenv("GRACEFUL_TIMEOUT", "30"))
+# Minimum seconds between restarts of a worker slot that keeps crashing
+RESPAWN_BACKOFF = float(os.getenv("WORKER_RESPAWN_BACKOFF", "1.0"))
+
+
+def cpu_count() -> int:
+    """Number of CPUs this process may use, honouring cgroup quotas."""
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cpus = os.cpu_count() or 1
+
+    # Containers usually limit CPU with a cgroup v2 quota rather than affinity
+    cpu_max = Path("/sys/fs/cgroup/cpu.max")
+    try:
+        quota, period = cpu_max.read_text().split()
+        if quota != "max":
+            cpus = min(cpus, max(1, int(int(quota) / int(period))))
+    except (OSError, ValueError):
+        pass
+    return cpus
+
+
+def default_workers() -> int:
+    """Worker count from WEB_CONCURRENCY, falling back to the CPU count."""
+    configured = os.getenv("WEB_CONCURRENCY")
+    if configured:
+        return max(1, int(configured))
+    return cpu_count()
+
+
+def select_loop() -> str:
+    try:
+        import uvloop  # noqa: F401
+        return "uvloop"
+    except ImportError:
+        return "asyncio"
+
+
+def select_http() -> str:
+    try:
+        import httptools  # noqa: F401
+        return "httptools"
+    except ImportError:
+        return "h11"
+
+
+class Supervisor:
+    """
+    Keeps a fixed number of uvicorn worker processes running.
+
+    Workers that exit unexpectedly are restarted. On SIGTERM or SIGINT every
+    worker receives SIGTERM, which makes uvicorn stop accepting connections,
+    drain in-flight requests and run the application shutdown handlers.
+    Workers still alive after the graceful timeout are killed.
+    """
+
+    def __init__(self, config: Config, workers: int):
+        self.config = config
+        self.workers = workers
+        self.processes: List = []
+        self.last_spawn: List[float] = []
+        self.should_exit = threading.Event()
+
+    def handle_exit(self, sig: int, frame) -> None:
+        self.should_exit.set()
+
+    def spawn(self, sockets):
+        server = Server(config=self.config)
+        process = get_subprocess(config=self.config, target=server.run, sockets=sockets)
+        process.start()
+        return process
+
+    def run(self) -> None:
+        sock = self.config.bind_socket()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            signal.signal(sig, self.handle_exit)
+
+        logger.info("Starting %s workers (pid %s)", self.workers, os.getpid())
+        for _ in range(self.workers):
+            self.processes.append(self.spawn([sock]))
+            self.last_spawn.append(time.monotonic())
+
+        while not self.should_exit.wait(0.5):
+            for slot, process in enumerate(self.processes):
+                if process.is_alive():
+                    continue
+                if time.monotonic() - self.last_spawn[slot] < RESPAWN_BACKOFF:
+                    continue
+                logger.warning(
+                    "Worker %s exited with code %s, restarting", process.pid, process.exitcode
+                )
+                self.processes[slot] = self.spawn([sock])
+                self.last_spawn[slot] = time.monotonic()
+
+        self.shutdown()
+        sock.close()
+
+    def shutdown(self) -> None:
+        logger.info("Draining %s workers", len(self.processes))
+        for process in self.processes:
+            if process.is_alive():
+                process.terminate()
+
+        deadline = time.monotonic() + GRACEFUL_TIMEOUT + 5
+        for process in self.processes:
+            process.join(max(0.0, deadline - time.monotonic()))
+            if process.is_alive():
+                logger.error("Worker %s did not drain in time, killing it", process.pid)
+                process.kill()
+                process.join()
+        logger.info("All workers stopped")
+
+
+def run(workers: Optional[int] = None, host: str = HOST, port: int = PORT) -> None:
+    workers = workers or default_workers()
+
+    # Workers are spawned processes, so settings that app.database reads at
+    # import time (pool sizing) have to be passed down through the environment.
+    os.environ["WEB_CONCURRENCY"] = str(workers)
+
+    config = Config(
+        APP,
+        host=host,
+        port=port,
+        workers=workers,
+        loop=select_loop(),
+        http=select_http(),
+        proxy_headers=True,
+        timeout_graceful_shutdown=GRACEFUL_TIMEOUT,
+    )
+
+    if workers == 1:
+        Server(config=config).run()
+    else:
+        config.configure_logging()
+        Supervisor(config, workers).run()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the Summit API server")
+    parser.add_argument("--workers", type=int, default=None, help="number of worker processes")
+    parser.add_argument("--host", default=HOST)
+    parser.add_argument("--port", type=int, default=PORT)
+    args = parser.parse_args()
+    run(workers=args.workers, host=args.host, port=args.port)
+
+
+if __name__ == "__main__":
+    main()
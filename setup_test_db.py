@@ -9,7 +9,10 @@ from app.database import (
     TEST_DB_NAME
 )
 
-async def create_test_database():
+# Extra databases to create for trying out sharding locally
+TEST_DB_SHARDS = int(os.getenv("TEST_DB_SHARDS", "0"))
+
+async def create_test_database(name: str = TEST_DB_NAME):
     """Create test database if it doesn't exist"""
     # Connect to default postgres database
     sys_conn = await asyncpg.connect(
@@ -24,15 +27,15 @@ async def create_test_database():
         # Check if database exists
         exists = await sys_conn.fetchval(
             "SELECT 1 FROM pg_database WHERE datname = $1",
-            TEST_DB_NAME
+            name
         )
         
         if not exists:
-            print(f"Creating test database: {TEST_DB_NAME}")
-            await sys_conn.execute(f'CREATE DATABASE {TEST_DB_NAME}')
+            print(f"Creating test database: {name}")
+            await sys_conn.execute(f'CREATE DATABASE {name}')
             print("Test database created successfully!")
         else:
-            print(f"Test database {TEST_DB_NAME} already exists")
+            print(f"Test database {name} already exists")
             
     except Exception as e:
         print(f"Error creating test database: {e}")
@@ -43,6 +46,16 @@ async def create_test_database():
 async def main():
     try:
         await create_test_database()
+        shard_urls = []
+        for index in range(1, TEST_DB_SHARDS + 1):
+            name = f"{TEST_DB_NAME}_shard_{index}"
+            await create_test_database(name)
+            shard_urls.append(
+                f"postgres://{TEST_DB_USER}:{TEST_DB_PASSWORD}@{TEST_DB_HOST}:{TEST_DB_PORT}/{name}"
+            )
+        if shard_urls:
+            print("Run with DB_SHARD_URLS=" + ",".join(shard_urls))
+            print("and apply migrations with: python migrate.py upgrade --all-shards")
     except Exception as e:
         print(f"Failed to set up test database: {e}")
         exit(1)